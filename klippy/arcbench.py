@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+# Benchmark of G2/G3 arcs against the same path as linear G1 moves
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, tempfile, shutil, json, logging, math, random
+import time, ConfigParser
+import klippy, fusecheck
+
+GCODE_HEADER = "G28\nM83\nG1 Z0.3 F3000\n"
+
+# Build a path of arcs around a common center (with a short radial
+# move between them) and return it as arc and as linear gcode
+def arc_paths(rand, arcs, segment, center=(100., 100.)):
+    arc_lines = [GCODE_HEADER]
+    linear_lines = [GCODE_HEADER]
+    radius = 5. + 30. * rand.random()
+    angle = 0.
+    pos = (center[0] + radius, center[1])
+    move = "G1 X%.3f Y%.3f F6000\n" % pos
+    arc_lines.append(move)
+    linear_lines.append(move)
+    for i in range(arcs):
+        # Arc from the current position
+        clockwise = rand.random() < .5
+        sweep = math.radians(90. + 270. * rand.random())
+        if clockwise:
+            sweep = -sweep
+        end_angle = angle + sweep
+        end_pos = (center[0] + radius * math.cos(end_angle),
+                   center[1] + radius * math.sin(end_angle))
+        extrude = .05 * abs(sweep) * radius
+        arc_lines.append("G%d X%.3f Y%.3f I%.3f J%.3f E%.5f F3000\n" % (
+            2 if clockwise else 3, end_pos[0], end_pos[1],
+            center[0] - pos[0], center[1] - pos[1], extrude))
+        count = max(1, int(math.ceil(abs(sweep) * radius / segment)))
+        for j in range(1, count + 1):
+            a = angle + sweep * j / count
+            linear_lines.append("G1 X%.3f Y%.3f E%.5f F3000\n" % (
+                center[0] + radius * math.cos(a),
+                center[1] + radius * math.sin(a), extrude / count))
+        # Radial move to the radius of the next arc
+        angle = end_angle
+        radius = 5. + 30. * rand.random()
+        pos = (center[0] + radius * math.cos(angle),
+               center[1] + radius * math.sin(angle))
+        move = "G1 X%.3f Y%.3f F6000\n" % pos
+        arc_lines.append(move)
+        linear_lines.append(move)
+    return "".join(arc_lines), "".join(linear_lines)
+
+def write_file(tmpdir, name, data):
+    filename = os.path.join(tmpdir, name)
+    f = open(filename, 'wb')
+    f.write(data)
+    f.close()
+    return filename
+
+# Return the best host cpu time and the planned moves of a gcode file
+def run_gcode(conffile, gcodefile, dictionary, repeat):
+    times = []
+    for i in range(repeat):
+        start_cpu = os.times()
+        moves = fusecheck.plan_moves(conffile, gcodefile, dictionary)
+        end_cpu = os.times()
+        times.append((end_cpu[0] + end_cpu[1]) - (start_cpu[0] + start_cpu[1]))
+    return min(times), moves
+
+def main():
+    usage = "%prog [options] <config file> <dictionary file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--arcs", type="int", dest="arcs", default=500,
+                    help="number of arcs")
+    opts.add_option("-s", "--segment", type="float", dest="segment",
+                    help="length of the linear moves of the G1 path"
+                    " (default is the arc_resolution of the config)")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of timed runs (the best run is reported)")
+    opts.add_option("--seed", type="int", dest="seed", default=1,
+                    help="random seed of the arc path")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    conffile = os.path.abspath(args[0])
+    dictionary = klippy.read_dictionary(args[1])
+    segment = options.segment
+    if segment is None:
+        fileconfig = ConfigParser.RawConfigParser()
+        fileconfig.read(conffile)
+        segment = 1.
+        if fileconfig.has_option('printer', 'arc_resolution'):
+            segment = fileconfig.getfloat('printer', 'arc_resolution')
+    logging.basicConfig(level=logging.WARN)
+    arc_gcode, linear_gcode = arc_paths(
+        random.Random(options.seed), options.arcs, segment)
+    tmpdir = tempfile.mkdtemp(prefix='arcbench')
+    try:
+        # The time of a run with only the gcode header is subtracted
+        base_time, moves = run_gcode(
+            conffile, write_file(tmpdir, 'base.gcode', GCODE_HEADER),
+            dictionary, options.repeat)
+        result = {'arcs': options.arcs, 'segment': segment}
+        for name, data in (('arc', arc_gcode), ('linear', linear_gcode)):
+            gcodefile = write_file(tmpdir, name + '.gcode', data)
+            cpu_time, moves = run_gcode(
+                conffile, gcodefile, dictionary, options.repeat)
+            result[name + '_gcode_lines'] = data.count('\n')
+            result[name + '_planner_moves'] = len(moves)
+            result[name + '_us_per_arc'] = round(
+                (cpu_time - base_time) * 1000000. / options.arcs, 1)
+    finally:
+        shutil.rmtree(tmpdir)
+    sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main()
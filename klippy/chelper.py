@@ -14,13 +14,29 @@ import cffi
 COMPILE_CMD = "gcc -Wall -g -O2 -shared -fPIC -o %s %s"
 SOURCE_FILES = ['stepcompress.c', 'serialqueue.c', 'pyhelper.c']
 DEST_LIB = "c_helper.so"
-OTHER_FILES = ['list.h', 'serialqueue.h', 'pyhelper.h']
+OTHER_FILES = ['list.h', 'minheap.h', 'serialqueue.h', 'pyhelper.h']
 
 defs_stepcompress = """
     struct stepcompress *stepcompress_alloc(uint32_t max_error
         , uint32_t queue_step_msgid, uint32_t set_next_step_dir_msgid
         , uint32_t invert_sdir, uint32_t oid);
     void stepcompress_free(struct stepcompress *sc);
+    void stepcompress_set_cubic(struct stepcompress *sc
+        , uint32_t queue_step_cubic_msgid);
+    void stepcompress_set_delta_approx(struct stepcompress *sc
+        , uint32_t enable);
+    struct steptrace *steptrace_alloc(const char *filename, double mcu_freq);
+    void steptrace_free(struct steptrace *st);
+    void stepcompress_set_trace(struct stepcompress *sc, struct steptrace *st);
+    struct stepcompress_stats {
+        uint64_t step_count, queue_step_count, queue_step_cubic_count;
+        uint64_t msg_bytes, error_sum;
+        uint32_t error_max, dir_changes;
+        uint32_t add_hist[17];
+        double delta_error_max;
+    };
+    void stepcompress_get_stats(struct stepcompress *sc
+        , struct stepcompress_stats *stats);
     int stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock);
     int stepcompress_set_homing(struct stepcompress *sc, uint64_t homing_clock);
     int stepcompress_queue_msg(struct stepcompress *sc, uint32_t *data, int len);
@@ -32,11 +48,41 @@ defs_stepcompress = """
     int32_t stepcompress_push_delta(struct stepcompress *sc
         , double clock_offset, double move_sd, double start_sv, double accel
         , double height, double startxy_sd, double arm_d, double movez_r);
+    void stepcompress_set_factors(struct stepcompress *sc, double mcu_freq
+        , double inv_step_dist, double velocity_factor, double accel_factor);
+    int32_t stepcompress_push_trapezoid(struct stepcompress *sc
+        , int64_t commanded_pos, double mcu_time, double start_pos
+        , double accel_d, double cruise_d, double decel_d
+        , double accel_t, double cruise_t
+        , double start_v, double cruise_v, double decel_v, double accel);
+    int32_t stepcompress_push_delta_trapezoid(struct stepcompress *sc
+        , int64_t commanded_pos, double mcu_time
+        , double accel_d, double cruise_d, double decel_d
+        , double accel_t, double cruise_t
+        , double start_v, double cruise_v, double accel
+        , double startz, double startxy_d, double arm_d
+        , double movez_r, double movexy_r);
 
     struct steppersync *steppersync_alloc(struct serialqueue *sq
         , struct stepcompress **sc_list, int sc_num, int move_num);
     void steppersync_free(struct steppersync *ss);
+    int steppersync_set_threads(struct steppersync *ss, int num_threads);
     int steppersync_flush(struct steppersync *ss, uint64_t move_clock);
+
+    struct block_move {
+        double start_pos[3], end_pos[2], axes_d[3], move_d;
+        double accel_r, cruise_r, decel_r, accel_t, cruise_t, decel_t;
+        double start_v, cruise_v, accel;
+        double e_start_pos, e_accel_d, e_cruise_d, e_decel_d;
+        double e_accel_t, e_cruise_t, e_decel_t;
+        double e_start_v, e_cruise_v, e_decel_v, e_accel;
+        double e_retract_d, e_retract_v;
+    };
+    int steppersync_push_moves(struct steppersync *ss, int kin_type
+        , struct stepcompress **kin_sc, struct stepcompress *ext_sc
+        , int64_t *commanded_pos, struct block_move *moves, int move_count
+        , double *print_time, double print_start_time
+        , double move_flush_time, double mcu_freq);
 """
 
 defs_serialqueue = """
@@ -58,12 +104,24 @@ defs_serialqueue = """
         , struct command_queue *cq, uint32_t *data, int len
         , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
+    void serialqueue_set_record(struct serialqueue *sq, int record);
     void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
+    void serialqueue_set_ext_window(struct serialqueue *sq, int window);
     void serialqueue_set_clock_est(struct serialqueue *sq, double est_clock
         , double last_ack_time, uint64_t last_ack_clock);
+    void serialqueue_set_response_format(struct serialqueue *sq, int msgid
+        , uint8_t *types, int num_types, int oid_param);
+    void serialqueue_set_response_handler(struct serialqueue *sq, int msgid
+        , int oid, int enable);
+    int serialqueue_get_ready_bytes(struct serialqueue *sq);
     void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
     int serialqueue_extract_old(struct serialqueue *sq, int sentq
         , struct pull_queue_message *q, int max);
+
+    uint16_t msgproto_crc16(uint8_t *buf, int len);
+    int msgproto_check_block(uint8_t *buf, int buf_len);
 """
 
 defs_pyhelper = """
@@ -77,6 +77,18 @@ class CoreXYKinematics:
         for i in StepList:
             need_motor_enable |= self.steppers[i].need_motor_enable
         self.need_motor_enable = need_motor_enable
+    def get_move_block(self):
+        return 'corexy', [s.mcu_stepper for s in self.steppers]
+    def is_motor_enable_move(self, move):
+        # Check if the move requires a stepper motor to be enabled
+        if not self.need_motor_enable:
+            return False
+        steppers = self.steppers
+        if ((move.axes_d[0] or move.axes_d[1])
+            and (steppers[0].need_motor_enable
+                 or steppers[1].need_motor_enable)):
+            return True
+        return not not (move.axes_d[2] and steppers[2].need_motor_enable)
     def query_endstops(self, print_time):
         endstops = [(s, s.query_endstop(print_time)) for s in self.steppers]
         return [(s.name, es.query_endstop_wait()) for s, es in endstops]
@@ -119,28 +131,12 @@ class CoreXYKinematics:
             if not axis_d:
                 continue
             mcu_stepper = self.steppers[i].mcu_stepper
-            mcu_time = mcu_stepper.print_to_mcu_time(move_time)
-            start_pos = move_start_pos[i]
             axis_r = abs(axis_d) / move.move_d
-            accel = move.accel * axis_r
             cruise_v = move.cruise_v * axis_r
-
-            # Acceleration steps
-            if move.accel_r:
-                accel_d = move.accel_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, accel_d, move.start_v * axis_r, accel)
-                start_pos += accel_d
-                mcu_time += move.accel_t
-            # Cruising steps
-            if move.cruise_r:
-                cruise_d = move.cruise_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, cruise_d, cruise_v, 0.)
-                start_pos += cruise_d
-                mcu_time += move.cruise_t
-            # Deceleration steps
-            if move.decel_r:
-                decel_d = move.decel_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, decel_d, cruise_v, -accel)
+            # Generate the acceleration, cruising, and deceleration steps
+            mcu_stepper.step_trapezoid(
+                mcu_stepper.print_to_mcu_time(move_time), move_start_pos[i],
+                move.accel_r * axis_d, move.cruise_r * axis_d,
+                move.decel_r * axis_d, move.accel_t, move.cruise_t,
+                move.start_v * axis_r, cruise_v, cruise_v,
+                move.accel * axis_r)
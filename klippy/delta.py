@@ -19,6 +19,11 @@ class DeltaKinematics:
                          for n in ['a', 'b', 'c']]
         self.need_motor_enable = self.need_home = True
         self.max_velocity = self.max_z_velocity = self.max_accel = 0.
+        step_generation = config.getchoice(
+            'delta_step_generation', {'exact': False, 'approximate': True},
+            'exact')
+        for s in self.steppers:
+            s.mcu_stepper.set_delta_approximation(step_generation)
         radius = config.getfloat('delta_radius', above=0.)
         arm_length = config.getfloat('delta_arm_length', above=radius)
         self.arm_length2 = arm_length**2
@@ -197,29 +202,14 @@ class DeltaKinematics:
             vt_startxy_d = (towerx_d*axes_d[0] + towery_d*axes_d[1])*inv_movexy_d
             tangentxy_d2 = towerx_d**2 + towery_d**2 - vt_startxy_d**2
             vt_arm_d = math.sqrt(self.arm_length2 - tangentxy_d2)
-            vt_startz = origz
 
             # Generate steps
             mcu_stepper = self.steppers[i].mcu_stepper
-            mcu_time = mcu_stepper.print_to_mcu_time(move_time)
-            if accel_d:
-                mcu_stepper.step_delta(
-                    mcu_time, accel_d, move.start_v, accel,
-                    vt_startz, vt_startxy_d, vt_arm_d, movez_r)
-                vt_startz += accel_d * movez_r
-                vt_startxy_d -= accel_d * movexy_r
-                mcu_time += move.accel_t
-            if cruise_d:
-                mcu_stepper.step_delta(
-                    mcu_time, cruise_d, cruise_v, 0.,
-                    vt_startz, vt_startxy_d, vt_arm_d, movez_r)
-                vt_startz += cruise_d * movez_r
-                vt_startxy_d -= cruise_d * movexy_r
-                mcu_time += move.cruise_t
-            if decel_d:
-                mcu_stepper.step_delta(
-                    mcu_time, decel_d, cruise_v, -accel,
-                    vt_startz, vt_startxy_d, vt_arm_d, movez_r)
+            mcu_stepper.step_delta_trapezoid(
+                mcu_stepper.print_to_mcu_time(move_time),
+                accel_d, cruise_d, decel_d, move.accel_t, move.cruise_t,
+                move.start_v, cruise_v, accel,
+                origz, vt_startxy_d, vt_arm_d, movez_r, movexy_r)
 
 
 ######################################################################
@@ -114,10 +114,9 @@ class PrinterExtruder:
                     return i
             move.extrude_max_corner_v = max_corner_v
         return flush_count
-    def move(self, move_time, move):
-        if self.need_motor_enable:
-            self.stepper.motor_enable(move_time, 1)
-            self.need_motor_enable = False
+    def calc_move_steps(self, move):
+        # Determine the extruder step phases of a move (and note the
+        # new extruder position)
         axis_d = move.axes_d[3]
         axis_r = abs(axis_d) / move.move_d
         accel = move.accel * axis_r
@@ -171,31 +170,39 @@ class PrinterExtruder:
                         # There is still only a decel phase (no retraction)
                         decel_d -= extra_decel_d
 
-        # Prepare for steps
+        end_pos = start_pos
+        for phase_d in (accel_d, cruise_d, decel_d):
+            if phase_d:
+                end_pos += phase_d
+        if retract_d:
+            end_pos -= retract_d
+        self.extrude_pos = end_pos
+        return (start_pos, accel_d, cruise_d, decel_d, accel_t, cruise_t,
+                decel_t, start_v, cruise_v, decel_v, accel,
+                retract_d, retract_v)
+    def move(self, move_time, move):
+        if self.need_motor_enable:
+            self.stepper.motor_enable(move_time, 1)
+            self.need_motor_enable = False
+        (start_pos, accel_d, cruise_d, decel_d, accel_t, cruise_t, decel_t,
+         start_v, cruise_v, decel_v, accel,
+         retract_d, retract_v) = self.calc_move_steps(move)
         mcu_stepper = self.stepper.mcu_stepper
         mcu_time = mcu_stepper.print_to_mcu_time(move_time)
 
-        # Acceleration steps
-        if accel_d:
-            mcu_stepper.step_const(mcu_time, start_pos, accel_d, start_v, accel)
-            start_pos += accel_d
-            mcu_time += accel_t
-        # Cruising steps
-        if cruise_d:
-            mcu_stepper.step_const(mcu_time, start_pos, cruise_d, cruise_v, 0.)
-            start_pos += cruise_d
-            mcu_time += cruise_t
-        # Deceleration steps
-        if decel_d:
-            mcu_stepper.step_const(mcu_time, start_pos, decel_d, decel_v, -accel)
-            start_pos += decel_d
-            mcu_time += decel_t
+        # Acceleration, cruising, and deceleration steps
+        mcu_stepper.step_trapezoid(
+            mcu_time, start_pos, accel_d, cruise_d, decel_d, accel_t, cruise_t,
+            start_v, cruise_v, decel_v, accel)
         # Retraction steps
         if retract_d:
+            for phase_d, phase_t in ((accel_d, accel_t), (cruise_d, cruise_t),
+                                     (decel_d, decel_t)):
+                if phase_d:
+                    start_pos += phase_d
+                    mcu_time += phase_t
             mcu_stepper.step_const(
                 mcu_time, start_pos, -retract_d, retract_v, accel)
-            start_pos -= retract_d
-        self.extrude_pos = start_pos
 
 # Dummy extruder class used when a printer has no extruder at all
 class DummyExtruder:
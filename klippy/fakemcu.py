@@ -0,0 +1,442 @@
+#!/usr/bin/env python2
+# Stand-in for a micro-controller on the other end of a pseudo-tty
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, json, zlib, random, select, errno, signal
+import tty, heapq, collections
+import msgproto
+
+BITS_PER_BYTE = 10.
+RECEIVE_BUFFER_SIZE = 192
+MESSAGE_EXT_SEQ = 0x80
+MESSAGE_EXT_SEQ_MASK = 0x7f
+MESSAGE_SYNC = ord(msgproto.MESSAGE_SYNC)
+
+class ShutdownError(Exception):
+    pass
+
+# The step timing of a stepper (only the time of the last queued step
+# is tracked)
+class FakeStepper:
+    def __init__(self):
+        self.next_step_time = 0
+        self.position = 0
+        self.next_dir = self.last_dir = 0
+
+class FakeMCU:
+    def __init__(self, fd, dictionary, baud=250000, move_count=512,
+                 noise=0., seed=1):
+        # Report the modeled baud rate so that the host paces its writes
+        data = json.loads(dictionary)
+        data.setdefault('config', {})['SERIAL_BAUD'] = str(baud)
+        dictionary = json.dumps(data)
+        self.identify_data = zlib.compress(dictionary)
+        self.msgparser = msgproto.MessageParser()
+        self.msgparser.process_identify(dictionary, decompress=False)
+        self.mcu_freq = self.msgparser.get_constant_float('CLOCK_FREQ')
+        self.ext_window = int(
+            self.msgparser.config.get('SERIAL_EXT_WINDOW', 0))
+        self.fd = fd
+        self.byte_time = BITS_PER_BYTE / baud
+        self.move_count = move_count
+        self.noise = noise
+        self.rand = random.Random(seed)
+        self.start_time = time.time()
+        self.is_running = True
+        # Serial port state
+        self.rx_pending = bytearray()
+        self.rx_time = 0.
+        self.input = bytearray()
+        self.need_sync = self.need_valid = False
+        self.tx_queue = collections.deque()
+        self.tx_time = 0.
+        self.next_sequence = 0
+        self.seq_is_ext = False
+        self.reorder = {}
+        self.reorder_need_nak = False
+        # Command state
+        self.oids = None
+        self.config_crc = 0
+        self.is_config = 0
+        self.shutdown_msg = None
+        self.move_heap = []
+        self.steppers = {}
+        self.handlers = {
+            'identify': self.cmd_identify, 'get_uptime': self.cmd_get_uptime,
+            'get_status': self.cmd_get_status,
+            'get_config': self.cmd_get_config,
+            'allocate_oids': self.cmd_allocate_oids,
+            'finalize_config': self.cmd_finalize_config,
+            'config_stepper': self.cmd_config_stepper,
+            'queue_step': self.cmd_queue_step,
+            'queue_step_cubic': self.cmd_queue_step,
+            'set_next_step_dir': self.cmd_set_next_step_dir,
+            'reset_step_clock': self.cmd_reset_step_clock,
+            'stepper_get_position': self.cmd_stepper_get_position,
+            'debug_ping': self.cmd_debug_ping,
+            'emergency_stop': self.cmd_emergency_stop,
+            'clear_shutdown': self.cmd_clear_shutdown,
+        }
+        self.stats = {
+            'blocks': 0, 'naks_sent': 0, 'invalid_bytes': 0,
+            'corrupt_bytes': 0, 'queue_step': 0, 'steps': 0,
+            'bytes_read': 0, 'bytes_write': 0, 'max_move_queue': 0,
+            'min_step_lead': None, 'first_step_cmd_time': 0.,
+            'last_step_cmd_time': 0., 'shutdown': None}
+    # Clock handling
+    def get_clock(self, eventtime):
+        return int((eventtime - self.start_time) * self.mcu_freq)
+    def extend_clock(self, clock):
+        # Convert a 32bit clock from the host to a 64bit clock
+        cur = self.get_clock(time.time())
+        return cur + ((clock - cur + 0x80000000) & 0xffffffff) - 0x80000000
+    # Response transmission
+    def sendf(self, msgformat, *params):
+        cmd = []
+        if msgformat is not None:
+            mp = self.msgparser.messages_by_name[msgformat.split()[0]]
+            cmd = mp.encode(*params)
+        msglen = msgproto.MESSAGE_MIN + len(cmd)
+        if self.seq_is_ext:
+            seq = MESSAGE_EXT_SEQ | self.next_sequence
+        else:
+            seq = msgproto.MESSAGE_DEST | (
+                self.next_sequence & msgproto.MESSAGE_SEQ_MASK)
+        out = chr(msglen) + chr(seq) + str(bytearray(cmd))
+        out += msgproto.crc16_ccitt(out) + msgproto.MESSAGE_SYNC
+        # Model the transmit time of the block
+        self.tx_time = max(self.tx_time, time.time()) + len(out)*self.byte_time
+        self.tx_queue.append((self.tx_time, out))
+    def send_nak(self):
+        # An empty message with a duplicate sequence number is a nak
+        self.stats['naks_sent'] += 1
+        self.sendf(None)
+    def shutdown(self, msg):
+        raise ShutdownError(msg)
+    def do_shutdown(self, msg):
+        if self.shutdown_msg is None:
+            self.shutdown_msg = self.stats['shutdown'] = msg
+        static_strings = self.msgparser.static_strings
+        sid = 0
+        if msg in static_strings:
+            sid = static_strings.index(msg)
+        self.sendf("shutdown clock=%u static_string_id=%hu",
+                   self.get_clock(time.time()) & 0xffffffff, sid)
+    # Message block handling (modeled on src/command.c)
+    def check_sequence(self, block):
+        msgseq = block[msgproto.MESSAGE_POS_SEQ]
+        if not self.ext_window or not msgseq & MESSAGE_EXT_SEQ:
+            self.seq_is_ext = False
+            self.reorder.clear()
+            return not ((msgseq ^ self.next_sequence)
+                        & msgproto.MESSAGE_SEQ_MASK)
+        msgseq &= MESSAGE_EXT_SEQ_MASK
+        if not self.seq_is_ext:
+            if (msgseq ^ self.next_sequence) & msgproto.MESSAGE_SEQ_MASK:
+                return False
+            self.seq_is_ext = True
+            self.next_sequence = msgseq
+            return True
+        delta = (msgseq - self.next_sequence) & MESSAGE_EXT_SEQ_MASK
+        if not delta:
+            return True
+        if delta <= self.ext_window:
+            self.reorder.setdefault(msgseq, block)
+        return False
+    def ack_sequence(self):
+        mask = MESSAGE_EXT_SEQ_MASK
+        if not self.seq_is_ext:
+            mask = msgproto.MESSAGE_SEQ_MASK
+        self.next_sequence = (self.next_sequence + 1) & mask
+        self.reorder_need_nak = True
+        self.stats['blocks'] += 1
+        # An empty message with a new sequence number is an ack
+        self.sendf(None)
+    def get_reordered(self):
+        block = self.reorder.pop(self.next_sequence, None)
+        for seq in list(self.reorder):
+            delta = (seq - self.next_sequence) & MESSAGE_EXT_SEQ_MASK
+            if delta > self.ext_window:
+                # Block was already received again - discard it
+                del self.reorder[seq]
+        if block is None and self.reorder and self.reorder_need_nak:
+            # Still waiting for an earlier block - request it
+            self.reorder_need_nak = False
+            self.send_nak()
+        return block
+    def get_message(self):
+        if self.seq_is_ext:
+            block = self.get_reordered()
+            if block is not None:
+                self.ack_sequence()
+                return block
+        buf = self.input
+        if buf and self.need_sync:
+            return self.find_sync()
+        if len(buf) < msgproto.MESSAGE_MIN:
+            return None
+        msglen = buf[msgproto.MESSAGE_POS_LEN]
+        msgseq = buf[msgproto.MESSAGE_POS_SEQ]
+        if (msglen < msgproto.MESSAGE_MIN or msglen > msgproto.MESSAGE_MAX
+            or ((msgseq & ~msgproto.MESSAGE_SEQ_MASK) != msgproto.MESSAGE_DEST
+                and not (self.ext_window and msgseq & MESSAGE_EXT_SEQ))):
+            return self.handle_error()
+        if len(buf) < msglen:
+            return None
+        block = buf[:msglen]
+        if self.msgparser.check_packet(str(block)) != msglen:
+            # Invalid sync byte or crc
+            return self.handle_error()
+        self.need_valid = False
+        del buf[:msglen]
+        if not self.check_sequence(block):
+            # Lost message - discard messages until it is retransmitted
+            self.send_nak()
+            return None
+        self.ack_sequence()
+        return block
+    def handle_error(self):
+        if self.input[0] == MESSAGE_SYNC:
+            # Ignore (do not nak) leading SYNC bytes
+            del self.input[:1]
+            return None
+        self.need_sync = True
+        return self.find_sync()
+    def find_sync(self):
+        # Discard bytes until next SYNC found
+        pos = self.input.find(msgproto.MESSAGE_SYNC)
+        if pos >= 0:
+            self.need_sync = False
+            del self.input[:pos+1]
+            self.stats['invalid_bytes'] += pos + 1
+        else:
+            self.stats['invalid_bytes'] += len(self.input)
+            del self.input[:]
+        if not self.need_valid:
+            self.need_valid = True
+            self.send_nak()
+        return None
+    def process_block(self, block):
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        end = len(block) - msgproto.MESSAGE_TRAILER_SIZE
+        while pos < end:
+            mp = self.msgparser.messages_by_id.get(block[pos])
+            if not isinstance(mp, msgproto.MessageFormat):
+                self.do_shutdown("Invalid command")
+                return
+            params, pos = mp.parse(block, pos)
+            func = self.handlers.get(mp.name)
+            if func is None:
+                continue
+            try:
+                func(params)
+            except ShutdownError, e:
+                self.do_shutdown(str(e))
+    # Serial port handling
+    def read_input(self, eventtime):
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError, e:
+            if e.errno not in (errno.EIO, errno.EAGAIN):
+                raise
+            # The host does not have the pseudo-tty open
+            return False
+        data = bytearray(data)
+        if self.noise:
+            for i in range(len(data)):
+                if self.rand.random() < self.noise:
+                    data[i] ^= 1 << self.rand.randrange(8)
+                    self.stats['corrupt_bytes'] += 1
+        # Model the receive time of the data
+        self.rx_time = max(self.rx_time, eventtime) + len(data)*self.byte_time
+        self.rx_pending.extend(data)
+        self.stats['bytes_read'] += len(data)
+        return True
+    def update_input(self, eventtime):
+        # Move the bytes that have arrived into the receive buffer
+        count = len(self.rx_pending)
+        if eventtime < self.rx_time:
+            count -= int((self.rx_time - eventtime) / self.byte_time) + 1
+        count = min(count, RECEIVE_BUFFER_SIZE - len(self.input))
+        if count > 0:
+            self.input.extend(self.rx_pending[:count])
+            del self.rx_pending[:count]
+    def write_output(self, eventtime):
+        while self.tx_queue and self.tx_queue[0][0] <= eventtime:
+            tx_time, data = self.tx_queue.popleft()
+            try:
+                os.write(self.fd, data)
+            except OSError, e:
+                if e.errno not in (errno.EIO, errno.EAGAIN):
+                    raise
+            self.stats['bytes_write'] += len(data)
+    def run(self):
+        while self.is_running:
+            eventtime = time.time()
+            self.write_output(eventtime)
+            self.update_input(eventtime)
+            while 1:
+                block = self.get_message()
+                if block is None:
+                    break
+                self.process_block(block)
+            timeout = 0.100
+            if self.tx_queue:
+                timeout = min(timeout, self.tx_queue[0][0] - eventtime)
+            if self.rx_pending:
+                timeout = min(timeout, self.byte_time)
+            rlist = [self.fd]
+            if len(self.rx_pending) >= RECEIVE_BUFFER_SIZE:
+                # Leave the data in the pseudo-tty (flow control)
+                rlist = []
+            try:
+                res = select.select(rlist, [], [], max(0., timeout))
+            except select.error:
+                continue
+            if res[0] and not self.read_input(time.time()):
+                time.sleep(0.010)
+    def stop(self, *args):
+        self.is_running = False
+    def get_stats(self):
+        return dict(self.stats)
+    # Command handlers
+    def cmd_identify(self, params):
+        offset = params['offset']
+        data = self.identify_data[offset:offset+params['count']]
+        self.sendf("identify_response offset=%u data=%.*s", offset, data)
+    def cmd_get_uptime(self, params):
+        clock = self.get_clock(time.time())
+        self.sendf("uptime high=%u clock=%u", clock >> 32, clock & 0xffffffff)
+    def cmd_get_status(self, params):
+        self.sendf("status clock=%u status=%c",
+                   self.get_clock(time.time()) & 0xffffffff,
+                   self.shutdown_msg is not None)
+    def cmd_get_config(self, params):
+        self.sendf("config is_config=%c crc=%u move_count=%hu",
+                   self.is_config, self.config_crc, self.move_count)
+    def cmd_allocate_oids(self, params):
+        if self.oids is not None:
+            self.shutdown("oids already allocated")
+        self.oids = params['count']
+    def cmd_finalize_config(self, params):
+        if self.oids is None or self.is_config:
+            self.shutdown("Can't finalize")
+        self.is_config = 1
+        self.config_crc = params['crc']
+        self.cmd_get_config(params)
+    def cmd_config_stepper(self, params):
+        if self.oids is None or params['oid'] >= self.oids:
+            self.shutdown("Can't assign oid")
+        self.steppers[params['oid']] = FakeStepper()
+    def lookup_stepper(self, oid):
+        s = self.steppers.get(oid)
+        if s is None:
+            self.shutdown("Invalid oid type")
+        return s
+    def move_alloc(self, eventtime, load_clock):
+        # Each move holds a slot in the move queue until it is started
+        heap = self.move_heap
+        cur = self.get_clock(eventtime)
+        while heap and heap[0] <= cur:
+            heapq.heappop(heap)
+        if len(heap) >= self.move_count:
+            self.shutdown("Move queue empty")
+        if load_clock > cur:
+            heapq.heappush(heap, load_clock)
+            self.stats['max_move_queue'] = max(
+                self.stats['max_move_queue'], len(heap))
+    def cmd_queue_step(self, params):
+        if self.shutdown_msg is not None:
+            return
+        s = self.lookup_stepper(params['oid'])
+        count = params['count']
+        if not count:
+            self.shutdown("Invalid count parameter")
+        interval, add = params['interval'], params['add']
+        add2 = params.get('add2', 0)
+        eventtime = time.time()
+        # The move is started once the previous move completes
+        cur = self.get_clock(eventtime)
+        load_clock = max(s.next_step_time, cur)
+        first_step = s.next_step_time + interval
+        lead = (first_step - load_clock) / self.mcu_freq
+        if first_step + self.mcu_freq * .001 < load_clock:
+            self.shutdown("stepper too far in past")
+        self.move_alloc(eventtime, load_clock)
+        # Find the time of the last step of the move
+        addfactor = count * (count - 1) // 2
+        s.next_step_time += (interval * count + add * addfactor
+                             + add2 * count*(count-1)*(count-2) // 6)
+        if s.next_dir != s.last_dir:
+            s.last_dir = s.next_dir
+        s.position += count if s.last_dir else -count
+        stats = self.stats
+        if stats['min_step_lead'] is None or lead < stats['min_step_lead']:
+            stats['min_step_lead'] = lead
+        if not stats['queue_step']:
+            stats['first_step_cmd_time'] = eventtime
+        stats['last_step_cmd_time'] = eventtime
+        stats['queue_step'] += 1
+        stats['steps'] += count
+    def cmd_set_next_step_dir(self, params):
+        self.lookup_stepper(params['oid']).next_dir = params['dir']
+    def cmd_reset_step_clock(self, params):
+        s = self.lookup_stepper(params['oid'])
+        if s.next_step_time > self.get_clock(time.time()):
+            self.shutdown("Can't reset time when stepper active")
+        s.next_step_time = self.extend_clock(params['clock'])
+    def cmd_stepper_get_position(self, params):
+        s = self.lookup_stepper(params['oid'])
+        self.sendf("stepper_position oid=%c pos=%i", params['oid'], s.position)
+    def cmd_debug_ping(self, params):
+        self.sendf("pong data=%*s", params['data'])
+    def cmd_emergency_stop(self, params):
+        self.shutdown("command request")
+    def cmd_clear_shutdown(self, params):
+        self.shutdown_msg = None
+
+# Create a pseudo-tty and return the (master fd, name of the slave)
+def create_pty(ptyname=None):
+    mfd, sfd = os.openpty()
+    tty.setraw(mfd)
+    tty.setraw(sfd)
+    filename = os.ttyname(sfd)
+    if ptyname is not None:
+        try:
+            os.unlink(ptyname)
+        except os.error:
+            pass
+        os.symlink(filename, ptyname)
+        filename = ptyname
+    return mfd, sfd, filename
+
+def main():
+    usage = "%prog [options] <dictionary file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-p", "--pty", type="string", dest="pty",
+                    default="/tmp/fakemcu",
+                    help="name of the pseudo-tty to create")
+    opts.add_option("-b", "--baud", type="int", dest="baud", default=250000,
+                    help="modeled serial baud rate")
+    opts.add_option("-m", "--move-count", type="int", dest="move_count",
+                    default=512, help="size of the move queue")
+    opts.add_option("-n", "--noise", type="float", dest="noise", default=0.,
+                    help="probability of corrupting each received byte")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    dictionary = open(args[0], 'rb').read()
+    mfd, sfd, ptyname = create_pty(options.pty)
+    fm = FakeMCU(mfd, dictionary, options.baud, options.move_count,
+                 options.noise)
+    signal.signal(signal.SIGINT, fm.stop)
+    signal.signal(signal.SIGTERM, fm.stop)
+    sys.stdout.write("Fake micro-controller on %s\n" % (ptyname,))
+    sys.stdout.flush()
+    fm.run()
+    sys.stdout.write(json.dumps(fm.get_stats(), sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+# Check that merged (fused) moves stay within fuse_deviation of the path
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, tempfile, shutil, json, logging, math
+import ConfigParser
+import klippy
+
+class error(Exception):
+    pass
+
+# Run a gcode file through the gcode and toolhead code (in the print
+# time analysis mode) and return the moves sent to the look-ahead queue
+def plan_moves(conffile, gcodefile, dictionary):
+    moves = []
+    debuginput = open(gcodefile, 'rb')
+    printer = klippy.Printer(conffile, debuginput.fileno(), 'startup',
+                             is_fileinput=True)
+    printer.set_fileoutput(open(os.devnull, 'wb'), dictionary)
+    printer.set_analysis()
+    def record_moves(eventtime):
+        analysis = printer.objects.get('analysis')
+        if analysis is None:
+            if printer.get_state_message() != klippy.message_startup:
+                return printer.reactor.NEVER
+            return eventtime + .001
+        generate_moves = analysis.toolhead.move_queue.generate_moves
+        def note_moves(queued_moves):
+            moves.extend([(m.start_pos, m.end_pos) for m in queued_moves])
+            generate_moves(queued_moves)
+        analysis.toolhead.move_queue.generate_moves = note_moves
+        return printer.reactor.NEVER
+    printer.reactor.register_timer(record_moves, printer.reactor.NOW)
+    res = printer.run()
+    printer.disconnect()
+    debuginput.close()
+    if res != 'exit_eof':
+        raise error("Klippy run failed: %s" % (printer.get_state_message(),))
+    return moves
+
+# Distance from point 'pos' to the segment from 'start' to 'end'
+def segment_distance(pos, start, end):
+    line_d = [end[i] - start[i] for i in (0, 1, 2)]
+    pos_d = [pos[i] - start[i] for i in (0, 1, 2)]
+    line_len2 = sum([d*d for d in line_d])
+    t = 0.
+    if line_len2:
+        t = sum([pos_d[i] * line_d[i] for i in (0, 1, 2)]) / line_len2
+        t = max(0., min(1., t))
+    return math.sqrt(sum([(pos_d[i] - t * line_d[i])**2 for i in (0, 1, 2)]))
+
+# Find the largest distance between a commanded position and the
+# fused move that replaced it.  Fused moves start and end at commanded
+# positions, so checking the positions bounds the distance between
+# the two (piecewise linear) paths.
+def max_deviation(path_moves, fused_moves):
+    max_dev = 0.
+    pos = 0
+    for start_pos, end_pos in fused_moves:
+        while 1:
+            if pos >= len(path_moves):
+                raise error("Fused move %s -> %s not on the path" % (
+                    start_pos, end_pos))
+            move_end = path_moves[pos][1]
+            pos += 1
+            if move_end == end_pos:
+                break
+            max_dev = max(max_dev, segment_distance(
+                move_end, start_pos, end_pos))
+    if pos != len(path_moves):
+        raise error("Fused moves end before the path")
+    return max_dev
+
+def write_config(conffile, filename, fuse_deviation):
+    fileconfig = ConfigParser.RawConfigParser()
+    fileconfig.read(conffile)
+    fileconfig.set('printer', 'fuse_deviation', repr(fuse_deviation))
+    f = open(filename, 'wb')
+    fileconfig.write(f)
+    f.close()
+
+def check_fusion(tmpdir, conffile, gcodefile, dictionary, fuse_deviation):
+    filename = os.path.join(tmpdir, 'fuse.cfg')
+    write_config(conffile, filename, 0.)
+    path_moves = plan_moves(filename, gcodefile, dictionary)
+    write_config(conffile, filename, fuse_deviation)
+    fused_moves = plan_moves(filename, gcodefile, dictionary)
+    max_dev = max_deviation(path_moves, fused_moves)
+    return {'fuse_deviation': fuse_deviation, 'moves': len(path_moves),
+            'fused_moves': len(fused_moves),
+            'max_deviation': round(max_dev, 6),
+            'ok': max_dev <= fuse_deviation + 1e-9}
+
+def main():
+    usage = "%prog [options] <config file> <gcode file> <dictionary file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-f", "--fuse-deviation", type="string", dest="deviations",
+                    default="0.01,0.05",
+                    help="comma separated fuse_deviation values to check")
+    options, args = opts.parse_args()
+    if len(args) != 3:
+        opts.error("Incorrect number of arguments")
+    try:
+        deviations = [float(d) for d in options.deviations.split(',')]
+    except ValueError:
+        opts.error("Invalid fuse deviations %s" % (options.deviations,))
+    conffile, gcodefile = [os.path.abspath(a) for a in args[:2]]
+    dictionary = klippy.read_dictionary(args[2])
+    logging.basicConfig(level=logging.WARN)
+    tmpdir = tempfile.mkdtemp(prefix='fusecheck')
+    failed = False
+    try:
+        for fuse_deviation in deviations:
+            result = check_fusion(tmpdir, conffile, gcodefile, dictionary,
+                                  fuse_deviation)
+            sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+            sys.stdout.flush()
+            failed = failed or not result['ok']
+    except error, e:
+        sys.stderr.write("Fuse check failed: %s\n" % (str(e),))
+        failed = True
+    finally:
+        shutil.rmtree(tmpdir)
+    if failed:
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
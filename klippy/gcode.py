@@ -3,8 +3,8 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, re, logging, collections
-import homing
+import os, re, logging, collections, math
+import homing, replay
 
 # Parse out incoming GCode and find and translate head movements
 class GCodeParser:
@@ -33,6 +33,10 @@ class GCodeParser:
         self.last_position = [0.0, 0.0, 0.0, 0.0]
         self.homing_add = [0.0, 0.0, 0.0, 0.0]
         self.axis2pos = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3}
+        self.arc_resolution = 1.
+    def load_config(self, config):
+        self.arc_resolution = config.getfloat(
+            'arc_resolution', 1., above=0.)
     def build_handlers(self, is_ready):
         handlers = self.all_handlers
         if not is_ready:
@@ -235,11 +239,11 @@ class GCodeParser:
             return
         self.respond('echo:Unknown command:"%s"' % (cmd,))
     all_handlers = [
-        'G1', 'G4', 'G20', 'G28', 'G90', 'G91', 'G92',
+        'G1', 'G2', 'G3', 'G4', 'G20', 'G28', 'G90', 'G91', 'G92',
         'M82', 'M83', 'M18', 'M105', 'M104', 'M109', 'M112', 'M114', 'M115',
         'M140', 'M190', 'M106', 'M107', 'M206', 'M400',
-        'IGNORE', 'QUERY_ENDSTOPS', 'PID_TUNE', 'RESTART', 'FIRMWARE_RESTART',
-        'STATUS', 'HELP']
+        'IGNORE', 'QUERY_ENDSTOPS', 'PID_TUNE', 'REPLAY_PRINT', 'PROFILE',
+        'RESTART', 'FIRMWARE_RESTART', 'STATUS', 'HELP']
     cmd_G1_aliases = ['G0']
     def cmd_G1(self, params):
         # Move
@@ -267,6 +271,83 @@ class GCodeParser:
         except homing.EndstopError, e:
             self.respond_error(str(e))
             self.last_position = self.toolhead.get_position()
+    def cmd_G2(self, params):
+        # Clockwise arc move
+        self.do_arc(params, True)
+    def cmd_G3(self, params):
+        # Counter-clockwise arc move
+        self.do_arc(params, False)
+    def do_arc(self, params, clockwise):
+        # Determine arc end position and center (arcs are in the XY plane)
+        start_pos = self.last_position
+        end_pos = list(start_pos)
+        try:
+            for a, p in self.axis2pos.items():
+                if a in params:
+                    v = float(params[a])
+                    if (not self.absolutecoord
+                        or (p>2 and not self.absoluteextrude)):
+                        end_pos[p] += v
+                    else:
+                        end_pos[p] = v + self.base_position[p]
+            if 'F' in params:
+                speed = float(params['F']) / 60.
+                if speed <= 0.:
+                    raise ValueError()
+                self.speed = speed
+            dx = end_pos[0] - start_pos[0]
+            dy = end_pos[1] - start_pos[1]
+            if 'R' in params:
+                # Find center from radius (negative radius selects the
+                # arc greater than 180 degrees)
+                radius = float(params['R'])
+                chord = math.sqrt(dx**2 + dy**2)
+                if not chord or abs(radius) < .5 * chord - .000001:
+                    raise ValueError()
+                h = math.sqrt(max(0., radius**2 - .25 * chord**2)) / chord
+                if clockwise != (radius < 0.):
+                    h = -h
+                offset_i = .5 * dx - h * dy
+                offset_j = .5 * dy + h * dx
+            elif 'I' in params or 'J' in params:
+                offset_i = float(params.get('I', 0.))
+                offset_j = float(params.get('J', 0.))
+            else:
+                raise ValueError()
+        except ValueError, e:
+            raise error("Unable to parse move '%s'" % (params['#original'],))
+        center_x = start_pos[0] + offset_i
+        center_y = start_pos[1] + offset_j
+        radius = math.sqrt(offset_i**2 + offset_j**2)
+        start_a = math.atan2(-offset_j, -offset_i)
+        end_a = math.atan2(end_pos[1] - center_y, end_pos[0] - center_x)
+        if clockwise:
+            angle = start_a - end_a
+        else:
+            angle = end_a - start_a
+        if angle <= .000001:
+            angle += 2. * math.pi
+        if clockwise:
+            angle = -angle
+        # Split the arc into linear moves of at most arc_resolution
+        arc_d = math.sqrt((angle * radius)**2 + (end_pos[2]-start_pos[2])**2)
+        count = max(1, int(math.ceil(arc_d / self.arc_resolution)))
+        axes_d = [end_pos[i] - start_pos[i] for i in (2, 3)]
+        pos = list(start_pos)
+        try:
+            for i in range(1, count):
+                r = float(i) / count
+                a = start_a + angle * r
+                pos[0] = center_x + radius * math.cos(a)
+                pos[1] = center_y + radius * math.sin(a)
+                pos[2] = start_pos[2] + axes_d[0] * r
+                pos[3] = start_pos[3] + axes_d[1] * r
+                self.toolhead.move(pos, self.speed)
+            self.toolhead.move(end_pos, self.speed)
+        except homing.EndstopError, e:
+            self.respond_error(str(e))
+            end_pos = self.toolhead.get_position()
+        self.last_position = end_pos
     def cmd_G4(self, params):
         # Dwell
         if 'S' in params:
@@ -288,6 +369,9 @@ class GCodeParser:
         homing_state = homing.Homing(self.toolhead, axes)
         if self.is_fileinput:
             homing_state.set_no_verify_retract()
+        if self.printer.is_recording:
+            # The printer is homed before an artifact is replayed
+            homing_state.set_virtual()
         try:
             self.toolhead.home(homing_state)
         except homing.EndstopError, e:
@@ -409,6 +493,27 @@ class GCodeParser:
             self.motor_heater_off()
             self.toolhead.dwell(0.500)
             self.toolhead.wait_moves()
+    cmd_REPLAY_PRINT_help = "Run the print artifact given on the command line"
+    def cmd_REPLAY_PRINT(self, params):
+        print_replay = self.printer.objects.get('replay')
+        if print_replay is None:
+            self.respond_error("No print artifact specified")
+            return
+        try:
+            print_replay.replay_print(self.toolhead)
+        except replay.error, e:
+            self.respond_error(str(e))
+        self.last_position = self.toolhead.get_position()
+    cmd_PROFILE_help = "Enable/disable (S1/S0) or report hot path profiling"
+    def cmd_PROFILE(self, params):
+        prof = self.printer.objects['profiler']
+        if 'S' in params:
+            prof.set_enable(not not self.get_int('S', params))
+            return
+        if not prof.is_enabled():
+            self.respond_info("Profiling is not enabled")
+            return
+        self.respond_info(prof.report())
     cmd_RESTART_when_not_ready = True
     cmd_RESTART_help = "Reload config file and restart host software"
     def cmd_RESTART(self, params):
@@ -10,8 +10,12 @@ class Homing:
         self.toolhead = toolhead
         self.changed_axes = changed_axes
         self.verify_retract = True
+        self.is_virtual = False
     def set_no_verify_retract(self):
         self.verify_retract = False
+    def set_virtual(self):
+        # Only set the homed position (no homing moves are issued)
+        self.is_virtual = True
     def set_axes(self, axes):
         self.changed_axes = axes
     def get_axes(self):
@@ -24,8 +28,14 @@ class Homing:
                 thcoord[i] = coord[i]
         return thcoord
     def retract(self, newpos, speed):
+        if self.is_virtual:
+            self.toolhead.set_position(self._fill_coord(newpos))
+            return
         self.toolhead.move(self._fill_coord(newpos), speed)
     def home(self, forcepos, movepos, steppers, speed, second_home=False):
+        if self.is_virtual:
+            self.toolhead.set_position(self._fill_coord(movepos))
+            return
         # Alter kinematics class to think printer is at forcepos
         self.toolhead.set_position(self._fill_coord(forcepos))
         # Start homing and issue move
@@ -4,8 +4,9 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, optparse, ConfigParser, logging, time, threading
+import sys, os, optparse, ConfigParser, logging, time, threading
 import gcode, toolhead, util, mcu, fan, heater, extruder, reactor, queuelogger
+import profiler, replay
 import msgproto
 
 message_ready = "Printer is ready"
@@ -136,12 +137,19 @@ class Printer:
         self.need_dump_debug = False
         self.state_message = message_startup
         self.debugoutput = self.dictionary = None
+        self.is_recording = self.is_analysis = False
+        self.replayfile = None
         self.run_result = None
         self.fileconfig = None
         self.mcu = None
-    def set_fileoutput(self, debugoutput, dictionary):
+    def set_fileoutput(self, debugoutput, dictionary, record=False):
         self.debugoutput = debugoutput
         self.dictionary = dictionary
+        self.is_recording = record
+    def set_replay(self, replayfile):
+        self.replayfile = replayfile
+    def set_analysis(self):
+        self.is_analysis = True
     def stats(self, eventtime, force_output=False):
         if self.need_dump_debug:
             # Call dump_debug here so it is executed in the main thread
@@ -157,6 +165,9 @@ class Printer:
         out.append(self.gcode.stats(eventtime))
         out.append(thstats)
         out.append(self.mcu.stats(eventtime))
+        prof = self.objects.get('profiler')
+        if prof is not None and prof.is_enabled():
+            out.append(prof.stats(eventtime))
         logging.info("Stats %.1f: %s" % (eventtime, ' '.join(out)))
         return eventtime + 1.
     def load_config(self):
@@ -169,7 +180,8 @@ class Printer:
             ConfigLogger(self.fileconfig, self.bglogger)
         self.mcu = mcu.MCU(self, ConfigWrapper(self, 'mcu'))
         if self.debugoutput is not None:
-            self.mcu.connect_file(self.debugoutput, self.dictionary)
+            self.mcu.connect_file(self.debugoutput, self.dictionary,
+                                  record=self.is_recording)
         if self.fileconfig.has_section('extruder'):
             self.objects['extruder'] = extruder.PrinterExtruder(
                 self, ConfigWrapper(self, 'extruder'))
@@ -181,6 +193,13 @@ class Printer:
                 self, ConfigWrapper(self, 'heater_bed'))
         self.objects['toolhead'] = toolhead.ToolHead(
             self, ConfigWrapper(self, 'printer'))
+        self.gcode.load_config(ConfigWrapper(self, 'printer'))
+        self.objects['profiler'] = profiler.Profiler(self)
+        if self.is_analysis:
+            self.objects['analysis'] = toolhead.PrintAnalysis(
+                self.objects['toolhead'])
+        if self.replayfile is not None:
+            self.objects['replay'] = replay.PrintReplay(self, self.replayfile)
         # Validate that there are no undefined parameters in the config file
         valid_sections = dict([(s, 1) for s, o in self.all_config_options])
         for section in self.fileconfig.sections():
@@ -249,6 +268,9 @@ class Printer:
             if self.mcu is not None:
                 self.stats(self.reactor.monotonic(), force_output=True)
                 self.mcu.disconnect()
+            analysis = self.objects.get('analysis')
+            if analysis is not None:
+                analysis.log_report()
         except:
             logging.exception("Unhandled exception during disconnect")
     def firmware_restart(self):
@@ -291,9 +313,19 @@ def main():
                     help="enable debug messages")
     opts.add_option("-d", dest="read_dictionary",
                     help="file to read for mcu protocol dictionary")
+    opts.add_option("-c", "--compile", dest="compilefile",
+                    help="write a print artifact (for later replay) to file")
+    opts.add_option("-r", "--replay", dest="replayfile",
+                    help="print artifact to run with REPLAY_PRINT command")
+    opts.add_option("-a", "--analyze", action="store_true", dest="analyze",
+                    help="only report the print time of the input file")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
+    if options.compilefile and options.outputfile:
+        opts.error("Options -c and -o are mutually exclusive")
+    if options.analyze and not options.inputfile:
+        opts.error("Option -a requires an input file (-i)")
     conffile = args[0]
 
     input_fd = debuginput = debugoutput = bglogger = None
@@ -308,6 +340,10 @@ def main():
         input_fd = util.create_pty(options.inputtty)
     if options.outputfile:
         debugoutput = open(options.outputfile, 'wb')
+    if options.compilefile:
+        debugoutput = open(options.compilefile, 'wb')
+    if options.analyze and debugoutput is None:
+        debugoutput = open(os.devnull, 'wb')
     if options.logfile:
         bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel)
     else:
@@ -331,7 +367,12 @@ def main():
             conffile, input_fd, res, is_fileinput, software_version, bglogger)
         if debugoutput:
             proto_dict = read_dictionary(options.read_dictionary)
-            printer.set_fileoutput(debugoutput, proto_dict)
+            printer.set_fileoutput(debugoutput, proto_dict,
+                                   record=options.compilefile is not None)
+        if options.replayfile:
+            printer.set_replay(options.replayfile)
+        if options.analyze:
+            printer.set_analysis()
         res = printer.run()
         if res == 'restart':
             printer.disconnect()
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, zlib, logging, math
-import serialhdl, pins, chelper
+import serialhdl, msgproto, pins, chelper, replay
 
 class error(Exception):
     pass
@@ -25,6 +25,7 @@ class MCU_stepper:
     def __init__(self, mcu, step_pin, dir_pin):
         self._mcu = mcu
         self._oid = mcu.create_oid(self)
+        self._name = "stepper%d" % (self._oid,)
         self._step_pin, pullup, self._invert_step = parse_pin_extras(step_pin)
         self._dir_pin, pullup, self._invert_dir = parse_pin_extras(dir_pin)
         self._commanded_pos = 0
@@ -32,14 +33,19 @@ class MCU_stepper:
         self._velocity_factor = self._accel_factor = 0.
         self._mcu_position_offset = 0
         self._mcu_freq = self._min_stop_interval = 0.
+        self._delta_approx = False
         self._reset_cmd = self._get_position_cmd = None
-        self._ffi_lib = self._stepqueue = None
+        self._ffi_lib = self._stepqueue = self._stats = None
         self.print_to_mcu_time = mcu.print_to_mcu_time
+    def set_name(self, name):
+        self._name = name
     def set_min_stop_interval(self, min_stop_interval):
         self._min_stop_interval = min_stop_interval
     def set_step_distance(self, step_dist):
         self._step_dist = step_dist
         self._inv_step_dist = 1. / step_dist
+    def set_delta_approximation(self, delta_approx):
+        self._delta_approx = delta_approx
     def build_config(self):
         self._mcu_freq = self._mcu.get_mcu_freq()
         self._velocity_factor = 1. / (self._mcu_freq * self._step_dist)
@@ -66,8 +72,42 @@ class MCU_stepper:
             max_error, step_cmd.msgid, dir_cmd.msgid,
             self._invert_dir, self._oid),
                                       self._ffi_lib.stepcompress_free)
+        self._ffi_lib.stepcompress_set_factors(
+            self._stepqueue, self._mcu_freq, self._inv_step_dist,
+            self._velocity_factor, self._accel_factor)
+        if self._mcu.get_cubic_step_compression():
+            try:
+                cubic_cmd = self._mcu.lookup_command(
+                    "queue_step_cubic oid=%c interval=%u count=%hu add=%hi"
+                    " add2=%hi")
+            except msgproto.error, e:
+                raise error("cubic_step_compression requires micro-controller"
+                            " code built with STEPPER_CUBIC")
+            self._ffi_lib.stepcompress_set_cubic(
+                self._stepqueue, cubic_cmd.msgid)
+        if self._delta_approx:
+            self._ffi_lib.stepcompress_set_delta_approx(
+                self._stepqueue, self._delta_approx)
+        self._stats = ffi_main.new('struct stepcompress_stats *')
     def get_oid(self):
         return self._oid
+    def stats(self):
+        if self._stepqueue is None:
+            return ""
+        stats = self._stats
+        self._ffi_lib.stepcompress_get_stats(self._stepqueue, stats)
+        msgs = stats.queue_step_count + stats.queue_step_cubic_count
+        count_avg = 0.
+        if msgs:
+            count_avg = float(stats.step_count) / msgs
+        add_hist = list(stats.add_hist)
+        while len(add_hist) > 1 and not add_hist[-1]:
+            add_hist.pop()
+        return ("%s_steps=%d %s_queue_step=%d %s_count_avg=%.3f"
+                " %s_dir_changes=%d %s_add_hist=%s" % (
+                    self._name, stats.step_count, self._name, msgs,
+                    self._name, count_avg, self._name, stats.dir_changes,
+                    self._name, "/".join([str(c) for c in add_hist])))
     def set_position(self, pos):
         if pos >= 0.:
             steppos = int(pos * self._inv_step_dist + 0.5)
@@ -79,6 +119,12 @@ class MCU_stepper:
         return self._commanded_pos * self._step_dist
     def get_mcu_position(self):
         return self._commanded_pos + self._mcu_position_offset
+    def get_step_position(self):
+        return self._commanded_pos
+    def note_steps(self, count):
+        # Steps queued without the step_* methods (by a move block or
+        # sent directly by a print replay)
+        self._commanded_pos += count
     def note_homing_start(self, homing_clock):
         ret = self._ffi_lib.stepcompress_set_homing(
             self._stepqueue, homing_clock)
@@ -139,6 +185,72 @@ class MCU_stepper:
         if count == STEPCOMPRESS_ERROR_RET:
             raise error("Internal error in stepcompress")
         self._commanded_pos += count
+    def step_trapezoid(self, mcu_time, start_pos, accel_d, cruise_d, decel_d
+                       , accel_t, cruise_t, start_v, cruise_v, decel_v, accel):
+        count = self._ffi_lib.stepcompress_push_trapezoid(
+            self._stepqueue, self._commanded_pos, mcu_time, start_pos,
+            accel_d, cruise_d, decel_d, accel_t, cruise_t,
+            start_v, cruise_v, decel_v, accel)
+        if count == STEPCOMPRESS_ERROR_RET:
+            raise error("Internal error in stepcompress")
+        self._commanded_pos += count
+    def step_delta_trapezoid(self, mcu_time, accel_d, cruise_d, decel_d
+                             , accel_t, cruise_t, start_v, cruise_v, accel
+                             , height_base, startxy_d, arm_d
+                             , movez_r, movexy_r):
+        count = self._ffi_lib.stepcompress_push_delta_trapezoid(
+            self._stepqueue, self._commanded_pos, mcu_time,
+            accel_d, cruise_d, decel_d, accel_t, cruise_t,
+            start_v, cruise_v, accel,
+            height_base, startxy_d, arm_d, movez_r, movexy_r)
+        if count == STEPCOMPRESS_ERROR_RET:
+            raise error("Internal error in stepcompress")
+        self._commanded_pos += count
+
+BLOCK_KINEMATICS = {'cartesian': 0, 'corexy': 1}
+
+# Generation (and flushing) of the steps of a series of moves in C
+class MCU_move_block:
+    def __init__(self, mcu, kin_type, kin_steppers, ext_stepper):
+        self._mcu = mcu
+        self._kin_type = BLOCK_KINEMATICS[kin_type]
+        self._kin_steppers = kin_steppers
+        self._ext_stepper = ext_stepper
+        self._steppers = list(kin_steppers)
+        if ext_stepper is not None:
+            self._steppers.append(ext_stepper)
+        self._ffi_main = self._ffi_lib = None
+        self._kin_stepqueues = self._ext_stepqueue = None
+        self._commanded_pos = self._print_time = None
+    def _setup(self):
+        ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._ffi_main = ffi_main
+        self._kin_stepqueues = ffi_main.new(
+            "struct stepcompress *[3]",
+            [s._stepqueue for s in self._kin_steppers])
+        self._ext_stepqueue = ffi_main.NULL
+        if self._ext_stepper is not None:
+            self._ext_stepqueue = self._ext_stepper._stepqueue
+        self._commanded_pos = ffi_main.new("int64_t[4]")
+        self._print_time = ffi_main.new("double[1]")
+    def generate(self, move_data, move_count, print_time, move_flush_time):
+        # The move_data contains the fields of 'struct block_move' for
+        # each move.  Returns the print time at the end of the moves.
+        if self._ffi_lib is None:
+            self._setup()
+        commanded_pos = self._commanded_pos
+        steppers = self._steppers
+        for i, s in enumerate(steppers):
+            commanded_pos[i] = s.get_step_position()
+        self._print_time[0] = print_time
+        data = self._ffi_main.new("double[]", move_data)
+        self._mcu.push_moves(
+            self._kin_type, self._kin_stepqueues, self._ext_stepqueue,
+            commanded_pos, self._ffi_main.cast("struct block_move *", data),
+            move_count, self._print_time, move_flush_time)
+        for i, s in enumerate(steppers):
+            s.note_steps(commanded_pos[i] - s.get_step_position())
+        return self._print_time[0]
 
 class MCU_endstop:
     error = error
@@ -374,11 +486,14 @@ class MCU:
         # Serial port
         baud = config.getint('baud', 250000)
         self._serialport = config.get('serial', '/dev/ttyS0')
+        native_receive = config.getboolean('native_receive', False)
+        ext_window = config.getboolean('serial_ext_window', False)
         self.serial = serialhdl.SerialReader(
-            printer.reactor, self._serialport, baud)
+            printer.reactor, self._serialport, baud, native_receive,
+            ext_window)
         self.is_shutdown = False
         self._shutdown_msg = ""
-        self._is_fileoutput = False
+        self._is_fileoutput = self._is_recording = False
         self._timeout_timer = printer.reactor.register_timer(
             self.timeout_handler)
         rmethods = {m: m for m in ['arduino', 'command', 'rpi_usb']}
@@ -392,15 +507,22 @@ class MCU:
         self._oids = []
         self._config_cmds = []
         self._config_crc = None
+        self._move_count = 0
         self._init_callbacks = []
         self._pin_map = config.get('pin_map', None)
         self._custom = config.get('custom', '')
         # Move command queuing
-        ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._ffi_main, self._ffi_lib = chelper.get_ffi()
         self._max_stepper_error = config.getfloat(
             'max_stepper_error', 0.000025, minval=0.)
+        self._cubic_step_compression = config.getboolean(
+            'cubic_step_compression', False)
+        self._compress_threads = config.getint(
+            'step_compress_threads', 0, minval=0)
+        self._step_trace_file = config.get('step_trace_file', None)
         self._steppers = []
         self._steppersync = None
+        self._steptrace = None
         # Print time to clock epoch calculations
         self._print_start_time = 0.
         self._mcu_freq = 0.
@@ -456,9 +578,10 @@ class MCU:
         self.register_msg(self.handle_mcu_stats, 'stats')
         self._build_config()
         self._send_config()
-    def connect_file(self, debugoutput, dictionary, pace=False):
+    def connect_file(self, debugoutput, dictionary, pace=False, record=False):
         self._is_fileoutput = True
-        self.serial.connect_file(debugoutput, dictionary)
+        self._is_recording = record
+        self.serial.connect_file(debugoutput, dictionary, record=record)
         if not pace:
             def dummy_set_print_start_time(eventtime):
                 pass
@@ -476,14 +599,37 @@ class MCU:
         self._printer.note_mcu_error("Lost communication with firmware")
         return self._printer.reactor.NEVER
     def disconnect(self):
+        record_fd = None
+        if self._is_recording and self.serial.ser is not None:
+            # Keep the print artifact open so that the final positions
+            # can be added after the serialqueue writes its commands
+            record_fd = os.dup(self.serial.ser.fileno())
         self.serial.disconnect()
+        if record_fd is not None:
+            self._write_artifact_trailer(record_fd)
         if self._steppersync is not None:
             self._ffi_lib.steppersync_free(self._steppersync)
             self._steppersync = None
+        if self._steptrace is not None:
+            for s in self._steppers:
+                self._ffi_lib.stepcompress_set_trace(s._stepqueue,
+                                                     self._ffi_main.NULL)
+            self._ffi_lib.steptrace_free(self._steptrace)
+            self._steptrace = None
+    def _write_artifact_trailer(self, fd):
+        f = os.fdopen(fd, 'wb')
+        toolhead = self._printer.objects.get('toolhead')
+        if toolhead is not None:
+            f.seek(0, os.SEEK_END)
+            replay.write_trailer(
+                f, toolhead.get_position(),
+                [(s.get_oid(), s.get_mcu_position()) for s in self._steppers])
+        f.close()
     def stats(self, eventtime):
-        return "%s mcu_task_avg=%.06f mcu_task_stddev=%.06f" % (
+        stepper_stats = "".join([" " + s.stats() for s in self._steppers])
+        return "%s mcu_task_avg=%.06f mcu_task_stddev=%.06f%s" % (
             self.serial.stats(eventtime),
-            self._mcu_tick_avg, self._mcu_tick_stddev)
+            self._mcu_tick_avg, self._mcu_tick_stddev, stepper_stats)
     def force_shutdown(self):
         self.send(self._emergency_stop_cmd.encode())
     def microcontroller_restart(self):
@@ -553,6 +699,11 @@ class MCU:
         if self._is_fileoutput:
             config_params = {
                 'is_config': 0, 'move_count': 500, 'crc': self._config_crc}
+            if self._is_recording:
+                replay.write_header(
+                    self.serial.ser, self._config_crc,
+                    config_params['move_count'],
+                    self.serial.msgparser.raw_identify_data)
         else:
             config_params = self.serial.send_with_response(msg, 'config')
         if not config_params['is_config']:
@@ -575,7 +726,7 @@ class MCU:
         if self._config_crc != config_params['crc']:
             self._check_restart("CRC mismatch")
             raise error("Printer CRC does not match config")
-        move_count = config_params['move_count']
+        self._move_count = move_count = config_params['move_count']
         logging.info("Configured (%d moves)" % (move_count,))
         if self._printer.bglogger is not None:
             msgparser = self.serial.msgparser
@@ -589,8 +740,27 @@ class MCU:
         stepqueues = tuple(s._stepqueue for s in self._steppers)
         self._steppersync = self._ffi_lib.steppersync_alloc(
             self.serial.serialqueue, stepqueues, len(stepqueues), move_count)
+        if self._compress_threads:
+            threads = self._ffi_lib.steppersync_set_threads(
+                self._steppersync, self._compress_threads)
+            logging.info("Using %d step compression threads" % (threads,))
+        if self._step_trace_file is not None:
+            filename = os.path.expanduser(self._step_trace_file)
+            self._steptrace = self._ffi_lib.steptrace_alloc(
+                filename, self._mcu_freq)
+            if self._steptrace == self._ffi_main.NULL:
+                self._steptrace = None
+                raise error("Unable to open step trace file '%s'" % (
+                    filename,))
+            for s in self._steppers:
+                self._ffi_lib.stepcompress_set_trace(s._stepqueue,
+                                                     self._steptrace)
+            logging.info("Recording step times to %s" % (filename,))
         for cb in self._init_callbacks:
             cb()
+        if self._is_recording:
+            # Mark the end of the mcu setup commands in the print artifact
+            self.send(msg)
     # Config creation helpers
     def create_oid(self, oid):
         self._oids.append(oid)
@@ -622,6 +792,8 @@ class MCU:
         return MCU_pwm(self, pin, cycle_time, hard_cycle_ticks, max_duration)
     def create_adc(self, pin):
         return MCU_adc(self, pin)
+    def create_move_block(self, kin_type, kin_steppers, ext_stepper):
+        return MCU_move_block(self, kin_type, kin_steppers, ext_stepper)
     # Clock syncing
     def set_print_start_time(self, eventtime):
         clock = self.serial.get_clock(eventtime)
@@ -634,15 +806,23 @@ class MCU:
             return 0.
         mcu_time = print_time + self._print_start_time
         est_mcu_time = self.serial.get_clock(eventtime) / self._mcu_freq
-        return mcu_time - est_mcu_time
+        # Allow for the error of the clock estimate
+        clock_error = self.serial.get_clock_error(eventtime)
+        return mcu_time - est_mcu_time - 3. * clock_error
     def print_to_mcu_time(self, print_time):
         return print_time + self._print_start_time
     def get_mcu_freq(self):
         return self._mcu_freq
+    def get_config_crc(self):
+        return self._config_crc
+    def get_move_count(self):
+        return self._move_count
     def get_last_clock(self):
         return self.serial.get_last_clock()
     def get_max_stepper_error(self):
         return self._max_stepper_error
+    def get_cubic_step_compression(self):
+        return self._cubic_step_compression
     # Move command queuing
     def send(self, cmd, minclock=0, reqclock=0, cq=None):
         self.serial.send(cmd, minclock, reqclock, cq=cq)
@@ -654,6 +834,17 @@ class MCU:
         ret = self._ffi_lib.steppersync_flush(self._steppersync, clock)
         if ret:
             raise error("Internal error in stepcompress")
+    def push_moves(self, kin_type, kin_stepqueues, ext_stepqueue,
+                   commanded_pos, moves, move_count, print_time,
+                   move_flush_time):
+        # Generate (and flush) the steps of a block of moves - see
+        # steppersync_push_moves() in stepcompress.c
+        ret = self._ffi_lib.steppersync_push_moves(
+            self._steppersync, kin_type, kin_stepqueues, ext_stepqueue,
+            commanded_pos, moves, move_count, print_time,
+            self._print_start_time, move_flush_time, self._mcu_freq)
+        if ret:
+            raise error("Internal error in stepcompress")
     def pause(self, waketime):
         return self._printer.reactor.pause(waketime)
     def monotonic(self):
@@ -0,0 +1,111 @@
+#ifndef __MINHEAP_H
+#define __MINHEAP_H
+
+#include <stdint.h> // uint64_t
+#include <stdlib.h> // realloc
+
+
+/****************************************************************
+ * minheap - Binary min-heap of pointers ordered by a clock
+ ****************************************************************/
+
+// Items are ordered by 'key' and then by 'order' (so that items with
+// the same key are returned in a deterministic order).
+
+struct minheap_item {
+    uint64_t key;
+    uint32_t order;
+    void *data;
+};
+
+struct minheap {
+    struct minheap_item *items;
+    int count, size;
+};
+
+static inline void
+minheap_init(struct minheap *h)
+{
+    h->items = NULL;
+    h->count = h->size = 0;
+}
+
+static inline void
+minheap_free(struct minheap *h)
+{
+    free(h->items);
+    minheap_init(h);
+}
+
+static inline int
+minheap_less(const struct minheap_item *a, const struct minheap_item *b)
+{
+    return a->key < b->key || (a->key == b->key && a->order < b->order);
+}
+
+// Return the item with the lowest key (or NULL if the heap is empty)
+static inline struct minheap_item *
+minheap_top(struct minheap *h)
+{
+    return h->count ? &h->items[0] : NULL;
+}
+
+// Move the item at 'pos' down to its place in the heap
+static inline void
+minheap_sift_down(struct minheap *h, int pos)
+{
+    struct minheap_item *items = h->items, item = items[pos];
+    int count = h->count;
+    for (;;) {
+        int child = 2*pos + 1;
+        if (child >= count)
+            break;
+        if (child + 1 < count && minheap_less(&items[child+1], &items[child]))
+            child++;
+        if (!minheap_less(&items[child], &item))
+            break;
+        items[pos] = items[child];
+        pos = child;
+    }
+    items[pos] = item;
+}
+
+static inline void
+minheap_push(struct minheap *h, uint64_t key, uint32_t order, void *data)
+{
+    if (h->count >= h->size) {
+        h->size = h->size ? h->size * 2 : 8;
+        h->items = realloc(h->items, h->size * sizeof(*h->items));
+    }
+    struct minheap_item *items = h->items;
+    struct minheap_item item = { key, order, data };
+    int pos = h->count++;
+    while (pos) {
+        int parent = (pos - 1) / 2;
+        if (!minheap_less(&item, &items[parent]))
+            break;
+        items[pos] = items[parent];
+        pos = parent;
+    }
+    items[pos] = item;
+}
+
+// Remove the item with the lowest key
+static inline void
+minheap_pop(struct minheap *h)
+{
+    if (!--h->count)
+        return;
+    h->items[0] = h->items[h->count];
+    minheap_sift_down(h, 0);
+}
+
+// Change the key of the item with the lowest key
+static inline void
+minheap_replace_top(struct minheap *h, uint64_t key)
+{
+    h->items[0].key = key;
+    minheap_sift_down(h, 0);
+}
+
+#endif // minheap.h
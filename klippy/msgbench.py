@@ -0,0 +1,238 @@
+#!/usr/bin/env python2
+# Benchmark and round-trip checks for the message encoding code
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, optparse, time, json, random
+import msgproto, chelper
+
+
+######################################################################
+# Reference (pure python) implementation
+######################################################################
+
+# The block crc and check_packet() of msgproto are used as is when no
+# C helper is set on the MessageParser
+ref_parser = msgproto.MessageParser()
+
+def ref_encode(mp, params):
+    out = [mp.msgid]
+    for name, t in mp.param_names:
+        t.encode(out, params[name])
+    return out
+
+def ref_parse(mp, s, pos):
+    pos += 1
+    out = {}
+    for name, t in mp.param_names:
+        v, pos = t.parse(s, pos)
+        out[name] = v
+    return out, pos
+
+def ref_encode_block(seq, cmd):
+    msglen = msgproto.MESSAGE_MIN + len(cmd)
+    seq = (seq & msgproto.MESSAGE_SEQ_MASK) | msgproto.MESSAGE_DEST
+    out = chr(msglen) + chr(seq) + cmd
+    return out + msgproto.crc16_ccitt(out) + msgproto.MESSAGE_SYNC
+
+
+######################################################################
+# Test messages
+######################################################################
+
+TYPE_RANGES = {
+    msgproto.PT_uint32: (0, 0xffffffff), msgproto.PT_int32: (-0x80000000,
+                                                              0x7fffffff),
+    msgproto.PT_uint16: (0, 0xffff), msgproto.PT_int16: (-0x8000, 0x7fff),
+    msgproto.PT_byte: (0, 0xff),
+}
+
+def random_value(rand, t):
+    if not t.is_int:
+        return "".join([chr(rand.randrange(256))
+                        for i in range(rand.randrange(12))])
+    low, high = TYPE_RANGES[t.__class__]
+    # Favor small values (as found in real traffic)
+    bits = rand.choice([5, 7, 12, 19, 26, 32])
+    v = rand.randrange(1 << bits)
+    if low < 0 and rand.randrange(2):
+        v = -v
+    return max(low, min(high, v))
+
+# Build a list of (format, params) with random parameters for each
+# message format of the data dictionary
+def build_messages(msgparser, count, seed):
+    rand = random.Random(seed)
+    formats = [mp for msgid, mp in sorted(msgparser.messages_by_id.items())
+               if isinstance(mp, msgproto.MessageFormat)]
+    messages = []
+    for i in range(count):
+        mp = formats[i % len(formats)]
+        params = dict([(name, random_value(rand, t))
+                       for name, t in mp.param_names])
+        if 'static_string_id' in params:
+            params['static_string_id'] = rand.randrange(
+                max(1, len(msgparser.static_strings)))
+        messages.append((mp, params))
+    return messages
+
+# Extract the messages of a file of message blocks (as written by the
+# batch mode)
+def load_messages(msgparser, filename):
+    data = open(filename, 'rb').read()
+    messages = []
+    while 1:
+        l = msgparser.check_packet(data)
+        if l <= 0:
+            if l == 0 or not data:
+                break
+            data = data[1:]
+            continue
+        s = bytearray(data[:l])
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            mp = msgparser.messages_by_id.get(s[pos])
+            if not isinstance(mp, msgproto.MessageFormat):
+                break
+            params, pos = mp.parse(s, pos)
+            messages.append((mp, params))
+        data = data[l:]
+    return messages
+
+
+######################################################################
+# Round-trip checks
+######################################################################
+
+def check_messages(msgparser, messages):
+    for i, (mp, params) in enumerate(messages):
+        args = [params[name] for name in mp.names]
+        cmd = mp.encode(*args)
+        if cmd != ref_encode(mp, params):
+            raise msgproto.error("Encode mismatch on %s %s" % (
+                mp.name, params))
+        if mp.encode_by_name(**params) != cmd:
+            raise msgproto.error("Encode by name mismatch on %s" % (mp.name,))
+        block = msgparser.encode(i, str(bytearray(cmd)))
+        if block != ref_encode_block(i, str(bytearray(cmd))):
+            raise msgproto.error("Message block mismatch on %s" % (mp.name,))
+        for parser in (msgparser, ref_parser):
+            if parser.check_packet(block + "extra") != len(block):
+                raise msgproto.error("Check failed on %s" % (mp.name,))
+            if parser.check_packet(block[:-1]) != 0:
+                raise msgproto.error("Short block not detected on %s" % (
+                    mp.name,))
+            bad = block[:-3] + chr(ord(block[-3]) ^ 0x01) + block[-2:]
+            if parser.check_packet(bad) != -1:
+                raise msgproto.error("Bad crc not detected on %s" % (
+                    mp.name,))
+        for s in (bytearray(block), list(bytearray(block))):
+            parsed, pos = mp.parse(s, msgproto.MESSAGE_HEADER_SIZE)
+            ref = ref_parse(mp, s, msgproto.MESSAGE_HEADER_SIZE)
+            if (parsed, pos) != ref or pos != len(block) - 3:
+                raise msgproto.error("Decode mismatch on %s (%s vs %s)" % (
+                    mp.name, parsed, ref))
+            if parsed != params:
+                raise msgproto.error("Round trip mismatch on %s" % (mp.name,))
+
+
+######################################################################
+# Benchmarks
+######################################################################
+
+def run_timed(func, messages, repeat):
+    best = None
+    for i in range(repeat):
+        start_time = time.time()
+        func(messages)
+        t = time.time() - start_time
+        if best is None or t < best:
+            best = t
+    return round(len(messages) / best, 1)
+
+def bench_encode(messages):
+    for mp, args in messages:
+        mp.encode(*args)
+def bench_ref_encode(messages):
+    for mp, args in messages:
+        out = [mp.msgid]
+        for i, t in enumerate(mp.param_types):
+            t.encode(out, args[i])
+
+def bench_block(msgparser):
+    def bench(blocks):
+        for cmd in blocks:
+            msgparser.check_packet(msgparser.encode(0, cmd))
+    return bench
+def bench_ref_block(blocks):
+    for cmd in blocks:
+        ref_parser.check_packet(ref_encode_block(0, cmd))
+
+def bench_parse(msgparser):
+    def bench(blocks):
+        for s in blocks:
+            msgparser.parse(s)
+    return bench
+def bench_ref_parse(msgparser):
+    # Same as MessageParser.parse() using the reference decoding
+    def bench(blocks):
+        for s in blocks:
+            mp = msgparser.messages_by_id[s[msgproto.MESSAGE_HEADER_SIZE]]
+            params, pos = ref_parse(mp, s, msgproto.MESSAGE_HEADER_SIZE)
+            if pos != len(s)-msgproto.MESSAGE_TRAILER_SIZE:
+                raise msgproto.error("Extra data at end of message")
+            params['#name'] = mp.name
+            static_string_id = params.get('static_string_id')
+            if static_string_id is not None:
+                params['#msg'] = msgparser.static_strings[static_string_id]
+    return bench
+
+def run_bench(msgparser, messages, repeat):
+    encode_args = [(mp, [params[name] for name in mp.names])
+                   for mp, params in messages]
+    cmds = [str(bytearray(mp.encode(*args))) for mp, args in encode_args]
+    blocks = [bytearray(msgparser.encode(0, cmd)) for cmd in cmds]
+    return {
+        'messages': len(messages),
+        'encode_msgs_per_sec': run_timed(bench_encode, encode_args, repeat),
+        'ref_encode_msgs_per_sec': run_timed(
+            bench_ref_encode, encode_args, repeat),
+        'block_msgs_per_sec': run_timed(
+            bench_block(msgparser), cmds, repeat),
+        'ref_block_msgs_per_sec': run_timed(bench_ref_block, cmds, repeat),
+        'decode_msgs_per_sec': run_timed(
+            bench_parse(msgparser), blocks, repeat),
+        'ref_decode_msgs_per_sec': run_timed(
+            bench_ref_parse(msgparser), blocks, repeat)}
+
+def main():
+    usage = "%prog [options] <dictionary file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-i", "--input", type="string", dest="input",
+                    help="use the messages of a batch mode output file")
+    opts.add_option("-n", "--count", type="int", dest="count", default=20000,
+                    help="number of test messages")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=5,
+                    help="number of timed runs (the best run is reported)")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=1,
+                    help="random seed of the test messages")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    msgparser = msgproto.MessageParser()
+    msgparser.set_c_helper(chelper.get_ffi()[1])
+    msgparser.process_identify(open(args[0], 'rb').read(), decompress=False)
+    if options.input:
+        messages = load_messages(msgparser, options.input)
+    else:
+        messages = build_messages(msgparser, options.count, options.seed)
+    try:
+        check_messages(msgparser, messages)
+    except msgproto.error, e:
+        opts.error("Round trip check failed: %s" % (str(e),))
+    result = run_bench(msgparser, messages, options.repeat)
+    sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main()
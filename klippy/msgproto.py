@@ -21,6 +21,7 @@ MESSAGE_TRAILER_SYNC = 1
 MESSAGE_PAYLOAD_MAX = MESSAGE_MAX - MESSAGE_MIN
 MESSAGE_SEQ_MASK = 0x0f
 MESSAGE_DEST = 0x10
+MESSAGE_EXT_SEQ = 0x80
 MESSAGE_SYNC = '\x7E'
 
 class error(Exception):
@@ -36,6 +37,21 @@ def crc16_ccitt(buf):
     crc = chr(crc >> 8) + chr(crc & 0xff)
     return crc
 
+# Append the given integers to 'out' as variable length quantities
+def encode_ints(out, values):
+    append = out.append
+    for v in values:
+        if v >= 0x60 or v < -0x20:
+            if v >= 0x3000 or v < -0x1000:
+                if v >= 0x180000 or v < -0x80000:
+                    if v >= 0xc000000 or v < -0x4000000:
+                        append((v>>28) & 0x7f | 0x80)
+                    append((v>>21) & 0x7f | 0x80)
+                append((v>>14) & 0x7f | 0x80)
+            append((v>>7) & 0x7f | 0x80)
+        append(v & 0x7f)
+    return out
+
 class PT_uint32:
     is_int = 1
     max_length = 5
@@ -108,26 +124,48 @@ class MessageFormat:
         self.param_types = [MessageTypes[fmt] for name, fmt in argparts]
         self.param_names = [(name, MessageTypes[fmt]) for name, fmt in argparts]
         self.name_to_type = dict(self.param_names)
+        self.names = [name for name, t in self.param_names]
+        self.is_int = not [t for t in self.param_types if not t.is_int]
+        self.int_params = [(name, t.signed) for name, t in self.param_names
+                           if t.is_int]
     def encode(self, *params):
-        out = []
-        out.append(self.msgid)
+        if len(params) != len(self.param_types):
+            raise error("Wrong number of parameters for %s" % (self.name,))
+        if self.is_int:
+            return encode_ints([self.msgid], params)
+        out = [self.msgid]
         for i, t in enumerate(self.param_types):
             t.encode(out, params[i])
         return out
     def encode_by_name(self, **params):
-        out = []
-        out.append(self.msgid)
-        for name, t in self.param_names:
-            t.encode(out, params[name])
-        return out
+        return self.encode(*[params[name] for name in self.names])
     def parse(self, s, pos):
         pos += 1
         out = {}
-        for name, t in self.param_names:
-            v, pos = t.parse(s, pos)
+        if not self.is_int:
+            for name, t in self.param_names:
+                v, pos = t.parse(s, pos)
+                out[name] = v
+            return out, pos
+        # Same as PT_uint32.parse() for each parameter
+        for name, signed in self.int_params:
+            c = s[pos]
+            pos += 1
+            v = c & 0x7f
+            if (c & 0x60) == 0x60:
+                v |= -0x20
+            while c & 0x80:
+                c = s[pos]
+                pos += 1
+                v = (v<<7) | (c & 0x7f)
+            if not signed:
+                v = int(v & 0xffffffff)
             out[name] = v
         return out, pos
     def format_params(self, params):
+        if self.is_int:
+            return self.debugformat % tuple([params[name]
+                                             for name in self.names])
         out = []
         for name, t in self.param_names:
             v = params[name]
@@ -182,6 +220,7 @@ class UnknownFormat:
 class MessageParser:
     error = error
     def __init__(self):
+        self.ffi_lib = None
         self.unknown = UnknownFormat()
         self.messages_by_id = {}
         self.messages_by_name = {}
@@ -190,14 +229,20 @@ class MessageParser:
         self.version = ""
         self.raw_identify_data = ""
         self._init_messages(DefaultMessages, DefaultMessages.keys())
+    def set_c_helper(self, ffi_lib):
+        # Use the C message block helpers (from serialqueue.c)
+        self.ffi_lib = ffi_lib
     def check_packet(self, s):
+        if self.ffi_lib is not None:
+            return self.ffi_lib.msgproto_check_block(s, len(s))
         if len(s) < MESSAGE_MIN:
             return 0
         msglen = ord(s[MESSAGE_POS_LEN])
         if msglen < MESSAGE_MIN or msglen > MESSAGE_MAX:
             return -1
         msgseq = ord(s[MESSAGE_POS_SEQ])
-        if (msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST:
+        if ((msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST
+            and not msgseq & MESSAGE_EXT_SEQ):
             return -1
         if len(s) < msglen:
             # Need more data
@@ -205,11 +250,16 @@ class MessageParser:
         if s[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC:
             return -1
         msgcrc = s[msglen-MESSAGE_TRAILER_CRC:msglen-MESSAGE_TRAILER_CRC+2]
-        crc = crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
+        crc = self.crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
         if crc != msgcrc:
             #logging.debug("got crc %s vs %s" % (repr(crc), repr(msgcrc)))
             return -1
         return msglen
+    def crc16_ccitt(self, buf):
+        if self.ffi_lib is None:
+            return crc16_ccitt(buf)
+        crc = self.ffi_lib.msgproto_crc16(buf, len(buf))
+        return chr(crc >> 8) + chr(crc & 0xff)
     def dump(self, s):
         msgseq = s[MESSAGE_POS_SEQ]
         out = ["seq: %02x" % (msgseq,)]
@@ -246,7 +296,7 @@ class MessageParser:
         msglen = MESSAGE_MIN + len(cmd)
         seq = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
         out = [chr(msglen), chr(seq), cmd]
-        out.append(crc16_ccitt(''.join(out)))
+        out.append(self.crc16_ccitt(''.join(out)))
         out.append(MESSAGE_SYNC)
         return ''.join(out)
     def _parse_buffer(self, value):
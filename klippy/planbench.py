@@ -0,0 +1,374 @@
+#!/usr/bin/env python2
+# Benchmark and checks for the host look-ahead (move planning) code
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, optparse, time, math, json, random, types
+import toolhead, extruder
+
+class error(Exception):
+    pass
+
+
+######################################################################
+# Reference implementation
+######################################################################
+
+# The MoveQueue.flush() code before the lazy look-ahead results were
+# cached on the moves
+class RefMoveQueue(toolhead.MoveQueue):
+    def flush(self, lazy=False):
+        self.junction_flush = toolhead.LOOKAHEAD_FLUSH_TIME
+        update_flush_count = lazy
+        queue = self.queue
+        flush_count = len(queue)
+        delayed = []
+        next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
+        for i in range(flush_count-1, self.leftover-1, -1):
+            move = queue[i]
+            reachable_start_v2 = next_end_v2 + move.delta_v2
+            start_v2 = min(move.max_start_v2, reachable_start_v2)
+            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
+            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+            if smoothed_v2 < reachable_smoothed_v2:
+                if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2
+                    or delayed):
+                    if update_flush_count and peak_cruise_v2:
+                        flush_count = i
+                        update_flush_count = False
+                    peak_cruise_v2 = min(move.max_cruise_v2, (
+                        smoothed_v2 + reachable_smoothed_v2) * .5)
+                    if delayed:
+                        if not update_flush_count and i < flush_count:
+                            for m, ms_v2, me_v2 in delayed:
+                                mc_v2 = min(peak_cruise_v2, ms_v2)
+                                m.set_junction(min(ms_v2, mc_v2), mc_v2
+                                               , min(me_v2, mc_v2))
+                        del delayed[:]
+                if not update_flush_count and i < flush_count:
+                    cruise_v2 = min((start_v2 + reachable_start_v2) * .5
+                                    , move.max_cruise_v2, peak_cruise_v2)
+                    move.set_junction(min(start_v2, cruise_v2), cruise_v2
+                                      , min(next_end_v2, cruise_v2))
+            else:
+                delayed.append((move, start_v2, next_end_v2))
+            next_end_v2 = start_v2
+            next_smoothed_v2 = smoothed_v2
+        if update_flush_count:
+            return
+        move_count = self.extruder_lookahead(queue, flush_count, lazy)
+        self.generate_moves(queue[:move_count])
+        self.leftover = flush_count - move_count
+        del queue[:move_count]
+
+
+# The Move class before its fields were declared in __slots__ (an old
+# style class with a per-instance dict)
+RefMove = types.ClassType('RefMove', (), dict([
+    (name, value) for name, value in toolhead.Move.__dict__.items()
+    if name not in toolhead.Move.__slots__
+    and name not in ('__slots__', '__dict__', '__weakref__')]))
+
+
+######################################################################
+# Stand-ins for the printer objects used by the look-ahead code
+######################################################################
+
+# Extruder using the pressure advance look-ahead of extruder.py
+class PlanExtruder(extruder.PrinterExtruder):
+    def __init__(self, lookahead_time):
+        self.pressure_advance = .05
+        self.pressure_advance_lookahead_time = lookahead_time
+
+class PlanToolhead:
+    def __init__(self, queue_class, max_accel, lookahead_time,
+                 move_class=toolhead.Move):
+        self.move_class = move_class
+        self.max_accel = max_accel
+        self.max_accel_to_decel = max_accel * .5
+        self.junction_deviation = 0.02
+        self.extruder = PlanExtruder(lookahead_time)
+        if issubclass(queue_class, toolhead.BatchMoveQueue):
+            self.move_queue = queue_class(
+                self, self.extruder.lookahead, self._generate_moves)
+        else:
+            self.move_queue = queue_class(
+                self.extruder.lookahead, self._generate_moves)
+        self.results = []
+        self.max_queue = 0
+        self.plan_time = 0.
+    def _generate_moves(self, moves):
+        # Note the look-ahead results of each flushed move
+        self.results.append(len(moves))
+        for m in moves:
+            self.results.append((m.start_v, m.cruise_v, m.end_v, m.accel_t,
+                                 m.cruise_t, m.decel_t,
+                                 m.extrude_max_corner_v))
+    def run(self, path):
+        move_queue = self.move_queue
+        move_class = self.move_class
+        pos = path[0][0]
+        start_time = time.time()
+        for end_pos, speed in path[1:]:
+            if end_pos is None:
+                # Full flush (eg, a G4 or M400 command)
+                move_queue.flush()
+                continue
+            move = move_class(self, pos, end_pos, speed)
+            move.extrude_r = move.axes_d[3] / move.move_d
+            move.extrude_max_corner_v = 0.
+            move_queue.add_move(move)
+            self.max_queue = max(self.max_queue, len(move_queue.queue))
+            pos = end_pos
+        move_queue.flush()
+        self.plan_time = time.time() - start_time
+
+
+######################################################################
+# Move paths
+######################################################################
+
+# A path is a list of ((x, y, z, e), speed) points (a point of None
+# requests a full flush).  The speed of the first point is ignored.
+
+# Random moves of widely varying length, angle, speed, and extrusion
+def random_path(rand, count):
+    x = y = z = e = 0.
+    angle = 0.
+    path = [((x, y, z, e), 0.)]
+    for i in range(count):
+        r = rand.random()
+        if r < .01:
+            path.append((None, 0.))
+            continue
+        if r < .04:
+            # Retract or prime
+            e += rand.choice((-1., 1.)) * rand.uniform(.5, 3.)
+            path.append(((x, y, z, e), rand.uniform(20., 60.)))
+            continue
+        if r < .06:
+            z += rand.uniform(.1, 1.)
+            path.append(((x, y, z, e), rand.uniform(5., 20.)))
+            continue
+        dist = rand.choice((rand.uniform(.05, .5), rand.uniform(.5, 5.),
+                            rand.uniform(5., 80.)))
+        r = rand.random()
+        if r < .6:
+            angle += rand.uniform(-.2, .2)
+        elif r < .9:
+            angle = rand.uniform(0., 2. * math.pi)
+        else:
+            angle += math.pi
+        x += dist * math.cos(angle)
+        y += dist * math.sin(angle)
+        if rand.random() < .7:
+            e += dist * rand.choice((.04, .04, .041, .06))
+        path.append(((x, y, z, e), rand.choice(
+            (rand.uniform(5., 300.), 50., 100., 150.))))
+    return path
+
+# Back and forth extruding strokes that are each made of 'segments'
+# short moves - the queue holds more moves as the segments shrink
+def stroke_path(strokes, segments, length=100., speed=300.):
+    path = [((0., 0., 0., 0.), 0.)]
+    for i in range(strokes):
+        start_x, end_x = (0., length) if not i & 1 else (length, 0.)
+        y = i * .4
+        for j in range(1, segments + 1):
+            x = start_x + (end_x - start_x) * j / segments
+            e = (i * length + length * j / segments) * .04
+            path.append(((x, y, 0., e), speed))
+    return path
+
+
+######################################################################
+# Checks and benchmarks
+######################################################################
+
+# List that counts the look-ups of queued moves
+class CountingList(list):
+    def __init__(self):
+        list.__init__(self)
+        self.lookups = 0
+    def __getitem__(self, index):
+        self.lookups += 1
+        return list.__getitem__(self, index)
+
+def run_queue(queue_class, path, accel, lookahead_time, count=False):
+    th = PlanToolhead(queue_class, accel, lookahead_time)
+    if count:
+        th.move_queue.queue = CountingList()
+    th.run(path)
+    return th
+
+# Check that the lazy look-ahead produces the same (bit for bit)
+# junction speeds and flushes as the reference implementation
+def check_lookahead(options):
+    moves = flushes = 0
+    for seed in range(options.seed, options.seed + options.paths):
+        path = random_path(random.Random(seed), options.count)
+        ref = run_queue(RefMoveQueue, path, options.accel,
+                        options.lookahead_time)
+        th = run_queue(toolhead.MoveQueue, path, options.accel,
+                       options.lookahead_time)
+        if th.results != ref.results:
+            for i, (r, t) in enumerate(zip(ref.results, th.results)):
+                if r != t:
+                    break
+            raise error("Look-ahead mismatch (seed %d, result %d: %s vs %s)"
+                        % (seed, i, t, r))
+        flushes += len([r for r in ref.results if type(r) == int])
+        moves += len(path) - 1
+    return {'test': 'lookahead-check', 'paths': options.paths,
+            'moves': moves, 'flushes': flushes}
+
+# Check that the batch planning of file input runs produces the same
+# (bit for bit) moves as the look-ahead queue and compare their speed
+def check_batch(options):
+    moves = 0
+    times = [0., 0.]
+    for seed in range(options.seed, options.seed + options.paths):
+        path = random_path(random.Random(seed), options.count)
+        results = []
+        for i, queue_class in enumerate((toolhead.MoveQueue,
+                                         toolhead.BatchMoveQueue)):
+            plan_times = []
+            for j in range(options.repeat):
+                th = run_queue(queue_class, path, options.accel,
+                               options.lookahead_time)
+                plan_times.append(th.plan_time)
+            times[i] += min(plan_times)
+            # The flushes differ - only compare the flushed moves
+            results.append([r for r in th.results if type(r) != int])
+        ref_results, batch_results = results
+        if batch_results != ref_results:
+            for i, (r, t) in enumerate(zip(ref_results, batch_results)):
+                if r != t:
+                    break
+            raise error("Batch planning mismatch (seed %d, move %d: %s vs %s)"
+                        % (seed, i, t, r))
+        moves += len(ref_results)
+    return {'test': 'batch-check', 'paths': options.paths, 'moves': moves,
+            'us_per_move': round(times[0] * 1000000. / moves, 3),
+            'batch_us_per_move': round(times[1] * 1000000. / moves, 3)}
+
+# Report the planning time per move as the queue depth grows.  The
+# extruder look-ahead is disabled so that only the junction planning
+# is measured.
+def bench_depth(segments, options):
+    path = stroke_path(options.strokes, segments)
+    moves = float(len(path) - 1)
+    result = {'test': 'lookahead-depth', 'segments': segments,
+              'moves': int(moves)}
+    for name, queue_class in (('ref_', RefMoveQueue),
+                              ('', toolhead.MoveQueue)):
+        times = []
+        for i in range(options.repeat):
+            th = run_queue(queue_class, path, options.accel, 0.)
+            times.append(th.plan_time)
+        th = run_queue(queue_class, path, options.accel, 0., count=True)
+        result[name + 'max_queue'] = th.max_queue
+        result[name + 'lookups_per_move'] = round(
+            th.move_queue.queue.lookups / moves, 3)
+        result[name + 'us_per_move'] = round(min(times) * 1000000. / moves, 3)
+    return result
+
+# Compare the memory use and planning speed of the Move class with
+# that of the class without __slots__
+def compare_move_class(options):
+    path = random_path(random.Random(options.seed), options.count)
+    moves = float(len([p for p in path[1:] if p[0] is not None]))
+    result = {'test': 'move-class', 'moves': int(moves)}
+    points = [p for p, speed in path if p is not None]
+    for name, move_class in (('ref_', RefMove), ('', toolhead.Move)):
+        times = []
+        build_times = []
+        for i in range(options.repeat):
+            th = PlanToolhead(toolhead.MoveQueue, options.accel,
+                              options.lookahead_time, move_class)
+            th.run(path)
+            times.append(th.plan_time)
+            # Only create the moves and calculate their junctions
+            start_time = time.time()
+            prev_move = move_class(th, points[0], points[1], 100.)
+            prev_move.extrude_r = 0.
+            for j in range(2, len(points)):
+                move = move_class(th, points[j-1], points[j], 100.)
+                move.extrude_r = 0.
+                move.calc_junction(prev_move)
+                prev_move = move
+            build_times.append(time.time() - start_time)
+        move = move_class(th, (0., 0., 0., 0.), (1., 1., 0., .1), 100.)
+        move.extrude_r = move.extrude_max_corner_v = 0.
+        move.set_junction(0., 1., 0.)
+        size = sys.getsizeof(move)
+        if hasattr(move, '__dict__'):
+            size += sys.getsizeof(move.__dict__)
+        result[name + 'bytes_per_move'] = size
+        result[name + 'us_per_move'] = round(min(times) * 1000000. / moves, 3)
+        result[name + 'build_us_per_move'] = round(
+            min(build_times) * 1000000. / moves, 3)
+    return result
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--check", action="store_true", dest="check",
+                    default=False,
+                    help="compare the look-ahead with the reference code")
+    opts.add_option("-b", "--batch", action="store_true", dest="batch",
+                    default=False,
+                    help="compare the batch planning of file input runs"
+                    " with the look-ahead queue")
+    opts.add_option("-m", "--move-class", action="store_true",
+                    dest="move_class", default=False,
+                    help="compare the Move class with a class without"
+                    " __slots__")
+    opts.add_option("-p", "--paths", type="int", dest="paths", default=50,
+                    help="number of random paths to check")
+    opts.add_option("-n", "--count", type="int", dest="count", default=2000,
+                    help="number of moves in each random path")
+    opts.add_option("-d", "--depths", type="string", dest="depths",
+                    default="25,50,100,200,400,800",
+                    help="comma separated segments per stroke of the"
+                    " queue depth benchmark")
+    opts.add_option("--strokes", type="int", dest="strokes", default=20,
+                    help="number of strokes of the queue depth benchmark")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of timed runs (the best run is reported)")
+    opts.add_option("-a", "--accel", type="float", dest="accel",
+                    default=3000., help="maximum acceleration")
+    opts.add_option("--lookahead-time", type="float", dest="lookahead_time",
+                    default=0.010,
+                    help="pressure advance look-ahead time of the extruder")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=1,
+                    help="random seed of the first random path")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if options.move_class:
+        result = compare_move_class(options)
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+        return
+    if options.check or options.batch:
+        try:
+            if options.batch:
+                result = check_batch(options)
+            else:
+                result = check_lookahead(options)
+        except error, e:
+            opts.error(str(e))
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+        return
+    try:
+        depths = [int(d) for d in options.depths.split(',')]
+    except ValueError:
+        opts.error("Invalid depths %s" % (options.depths,))
+    for segments in depths:
+        result = bench_depth(segments, options)
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
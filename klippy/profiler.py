@@ -0,0 +1,109 @@
+# Timing instrumentation for the host move planning hot paths
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import time, logging
+import toolhead, mcu
+
+# Number of histogram buckets (bucket N counts calls taking less than
+# 2**N microseconds)
+HISTOGRAM_BUCKETS = 16
+
+# Accumulated timing for one instrumented function
+class Probe:
+    def __init__(self, name, obj, attr):
+        self.name = name
+        self.obj = obj
+        self.attr = attr
+        self.orig_attr = None
+        self.count = 0
+        self.total_time = 0.
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+    def install(self):
+        # Replace the function with a timing wrapper
+        obj, attr = self.obj, self.attr
+        self.orig_attr = obj.__dict__.get(attr)
+        func = getattr(obj, attr)
+        def timed_func(*args, **kwargs):
+            start_time = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.note_time(time.time() - start_time)
+        setattr(obj, attr, timed_func)
+    def uninstall(self):
+        if self.orig_attr is None:
+            delattr(self.obj, self.attr)
+        else:
+            setattr(self.obj, self.attr, self.orig_attr)
+    def note_time(self, duration):
+        self.count += 1
+        self.total_time += duration
+        bucket = min(int(duration * 1000000.).bit_length(),
+                     HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+    def get_histogram(self):
+        hist = list(self.histogram)
+        while len(hist) > 1 and not hist[-1]:
+            hist.pop()
+        return "/".join([str(c) for c in hist])
+    def stats(self):
+        return "prof_%s=%d:%.6f:%s" % (
+            self.name, self.count, self.total_time, self.get_histogram())
+    def report(self):
+        avg = 0.
+        if self.count:
+            avg = self.total_time / self.count
+        return "%-18s calls=%d total=%.6f avg=%.9f hist_us=%s" % (
+            self.name, self.count, self.total_time, avg, self.get_histogram())
+
+# Profiler that can be switched on and off at runtime.  When disabled
+# no wrappers are installed, so the hot paths run without overhead.
+# Times are inclusive (eg, the flush time includes the kinematic moves
+# that it invokes).
+class Profiler:
+    def __init__(self, printer):
+        self.printer = printer
+        self.probes = []
+    def is_enabled(self):
+        return not not self.probes
+    def _build_probes(self):
+        th = self.printer.objects['toolhead']
+        probes = [
+            Probe('move_init', toolhead.Move, '__init__'),
+            Probe('calc_junction', toolhead.Move, 'calc_junction'),
+            Probe('queue_flush', th.move_queue, 'flush'),
+            Probe('generate_moves', th.move_queue, 'generate_moves'),
+            Probe('extruder_lookahead', th.move_queue, 'extruder_lookahead'),
+            Probe('kin_move', th.kin, 'move'),
+            Probe('step_trapezoid', mcu.MCU_stepper, 'step_trapezoid'),
+            Probe('step_delta_trap', mcu.MCU_stepper, 'step_delta_trapezoid'),
+            Probe('step_const', mcu.MCU_stepper, 'step_const'),
+            Probe('step_delta', mcu.MCU_stepper, 'step_delta'),
+            Probe('steppersync_flush', self.printer.mcu, 'flush_moves')]
+        if hasattr(th.extruder, 'move'):
+            probes.append(Probe('extruder_move', th.extruder, 'move'))
+        if th.move_block is not None:
+            # Moves generated in a block bypass the kin_move,
+            # extruder_move, and step probes
+            probes.append(Probe('move_block', th, '_generate_move_block'))
+        return probes
+    def set_enable(self, enable):
+        if enable == self.is_enabled():
+            return
+        if enable:
+            self.probes = self._build_probes()
+            for p in self.probes:
+                p.install()
+            logging.info("Hot path profiling enabled")
+        else:
+            for p in reversed(self.probes):
+                p.uninstall()
+            logging.info("Hot path profiling disabled:\n%s" % (
+                self.report(),))
+            self.probes = []
+    def stats(self, eventtime):
+        return " ".join([p.stats() for p in self.probes])
+    def report(self):
+        return "\n".join([p.report() for p in self.probes])
@@ -0,0 +1,214 @@
+# Support for precompiled print artifacts (recorded mcu command streams)
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import struct, zlib, logging
+import extruder
+
+# An artifact is a header followed by one record per mcu command (in
+# the order the serialqueue would transmit them) and a trailer.  Each
+# record holds the command's min_clock and req_clock followed by the
+# encoded command.  The header contains the config CRC, the mcu
+# move_count, and a CRC of the data dictionary that the stream was
+# built with.  The mcu config (and init) commands at the start of the
+# stream are terminated by a get_config command; they are not
+# replayed.  The trailer holds the final toolhead position and the
+# final mcu position (in steps) of each stepper.
+ARTIFACT_MAGIC = "KLIPPYPRINT2"
+HEADER_FORMAT = "<12sIII"
+RECORD_FORMAT = "<QQB"
+POSITION_FORMAT = "<dddd"
+STEPPER_FORMAT = "<Bq"
+TRAILER_MAGIC = "KLIPPYFINAL1"
+TRAILER_FORMAT = "<I12s"
+
+# Commands generated by the host step compression code
+STEP_COMMANDS = ['queue_step', 'queue_step_cubic', 'set_next_step_dir',
+                 'reset_step_clock']
+
+# Amount of time to queue commands ahead of the mcu during replay
+REPLAY_AHEAD_TIME = 2.000
+
+class error(Exception):
+    pass
+
+def write_header(f, config_crc, move_count, dictionary):
+    f.write(struct.pack(HEADER_FORMAT, ARTIFACT_MAGIC, config_crc,
+                        move_count, zlib.crc32(dictionary) & 0xffffffff))
+    f.flush()
+
+def write_trailer(f, toolhead_pos, stepper_positions):
+    f.write(struct.pack(POSITION_FORMAT, *toolhead_pos))
+    for oid, pos in stepper_positions:
+        f.write(struct.pack(STEPPER_FORMAT, oid, pos))
+    f.write(struct.pack(TRAILER_FORMAT, len(stepper_positions), TRAILER_MAGIC))
+    f.flush()
+
+# Returns the (final toolhead position, {oid: final mcu position},
+# start of the trailer) of an artifact
+def read_trailer(data, header_size):
+    trailer_size = struct.calcsize(TRAILER_FORMAT)
+    if len(data) < header_size + trailer_size:
+        raise error("Print artifact is truncated")
+    count, magic = struct.unpack_from(
+        TRAILER_FORMAT, data, len(data) - trailer_size)
+    if magic != TRAILER_MAGIC:
+        raise error("Print artifact is truncated")
+    stepper_size = struct.calcsize(STEPPER_FORMAT)
+    end = (len(data) - trailer_size - count * stepper_size
+           - struct.calcsize(POSITION_FORMAT))
+    if end < header_size:
+        raise error("Print artifact is truncated")
+    toolhead_pos = list(struct.unpack_from(POSITION_FORMAT, data, end))
+    pos = end + struct.calcsize(POSITION_FORMAT)
+    stepper_positions = {}
+    for i in range(count):
+        oid, stepper_pos = struct.unpack_from(STEPPER_FORMAT, data, pos)
+        stepper_positions[oid] = stepper_pos
+        pos += stepper_size
+    return toolhead_pos, stepper_positions, end
+
+# Read an artifact.  Returns the header fields, the list of
+# (min_clock, req_clock, msg) records, and the trailer positions.
+def read_artifact(filename):
+    try:
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+    except IOError, e:
+        raise error("Unable to read print artifact %s: %s" % (
+            filename, e.strerror))
+    header_size = struct.calcsize(HEADER_FORMAT)
+    if len(data) < header_size:
+        raise error("File %s is not a print artifact" % (filename,))
+    header = struct.unpack_from(HEADER_FORMAT, data)
+    if header[0] != ARTIFACT_MAGIC:
+        raise error("File %s is not a print artifact" % (filename,))
+    toolhead_pos, stepper_positions, end = read_trailer(data, header_size)
+    records = []
+    record_size = struct.calcsize(RECORD_FORMAT)
+    pos = header_size
+    while pos < end:
+        if pos + record_size > end:
+            raise error("Print artifact is truncated")
+        min_clock, req_clock, msglen = struct.unpack_from(
+            RECORD_FORMAT, data, pos)
+        pos += record_size
+        msg = bytearray(data[pos:pos+msglen])
+        pos += msglen
+        if not msglen or pos > end:
+            raise error("Print artifact is truncated")
+        records.append((min_clock, req_clock, msg))
+    return header[1:], records, toolhead_pos, stepper_positions
+
+class PrintReplay:
+    def __init__(self, printer, filename):
+        self.printer = printer
+        self.filename = filename
+        self.step_queue = self.cmd_queue = None
+    def _load(self):
+        # Read the artifact and verify it was built for this printer
+        header, raw_records, toolhead_pos, stepper_positions = read_artifact(
+            self.filename)
+        config_crc, move_count, dictionary_crc = header
+        mcu = self.printer.mcu
+        msgparser = mcu.serial.msgparser
+        if config_crc != mcu.get_config_crc():
+            raise error("Print artifact config CRC does not match config")
+        identify_crc = zlib.crc32(msgparser.raw_identify_data) & 0xffffffff
+        if dictionary_crc != identify_crc:
+            raise error("Print artifact built for a different mcu dictionary")
+        if move_count > mcu.get_move_count():
+            raise error("Print artifact requires %d mcu moves (have %d)" % (
+                move_count, mcu.get_move_count()))
+        # Decode records (skipping the mcu setup commands)
+        records = []
+        in_config = True
+        for min_clock, req_clock, msg in raw_records:
+            mp = msgparser.messages_by_id.get(msg[0])
+            if mp is None or mp.name not in msgparser.messages_by_name:
+                raise error("Unknown command %d in print artifact" % (msg[0],))
+            if in_config:
+                # The recording marks the end of setup with a get_config
+                if mp.name == 'get_config':
+                    in_config = False
+                continue
+            if mp.name == 'end_stop_home':
+                raise error("Print artifact contains homing moves")
+            is_step = mp.name in STEP_COMMANDS
+            if 'clock' in mp.name_to_type:
+                params, mpos = mp.parse(msg, 0)
+                records.append((min_clock, req_clock, mp, params, is_step))
+            else:
+                records.append((min_clock, req_clock, list(msg), None, is_step))
+        if not [1 for r in records if r[1]]:
+            raise error("Print artifact does not contain any timed commands")
+        return records, toolhead_pos, stepper_positions
+    def _get_steppers(self, toolhead):
+        steppers = list(toolhead.kin.steppers)
+        if isinstance(toolhead.extruder, extruder.PrinterExtruder):
+            steppers.append(toolhead.extruder.stepper)
+        return steppers
+    def _enable_motors(self, toolhead):
+        # The artifact enables the motors - note that in the host state
+        # so that the closing motor_off disables them
+        print_time = toolhead.get_last_move_time()
+        for s in self._get_steppers(toolhead):
+            s.motor_enable(print_time, 1)
+        self.printer.mcu.flush_moves(print_time)
+    def _set_final_position(self, toolhead, toolhead_pos, stepper_positions):
+        # The replayed steps bypassed the host step compression code -
+        # update the host positions to match the end of the artifact
+        for s in self._get_steppers(toolhead):
+            mcu_stepper = s.mcu_stepper
+            mcu_stepper.note_steps(
+                stepper_positions.get(mcu_stepper.get_oid(), 0))
+        toolhead.set_position(toolhead_pos)
+        ext = toolhead.extruder
+        if isinstance(ext, extruder.PrinterExtruder):
+            ext.extrude_pos = ext.stepper.mcu_stepper.get_commanded_position()
+    def replay_print(self, toolhead):
+        records, toolhead_pos, stepper_positions = self._load()
+        mcu = self.printer.mcu
+        mcu_freq = mcu.get_mcu_freq()
+        self._enable_motors(toolhead)
+        # Map the artifact's clocks to the next toolhead move time
+        req_clocks = [r[1] for r in records if r[1]]
+        start_clock, end_clock = min(req_clocks), max(req_clocks)
+        duration = (end_clock - start_clock) / mcu_freq
+        start_mcu_time = mcu.print_to_mcu_time(toolhead.get_last_move_time())
+        end_mcu_time = start_mcu_time + duration
+        offset = int(start_mcu_time * mcu_freq) - start_clock
+        logging.info("Replaying %d commands from %s (%.3f seconds)" % (
+            len(records), self.filename, duration))
+        # Stream the commands to the serialqueue (the step commands use
+        # their own queue so that they can not delay the timed commands)
+        if self.cmd_queue is None:
+            self.step_queue = mcu.alloc_command_queue()
+            self.cmd_queue = mcu.alloc_command_queue()
+        reactor = self.printer.reactor
+        ahead_clock = int(REPLAY_AHEAD_TIME * mcu_freq)
+        eventtime = reactor.monotonic()
+        for min_clock, req_clock, cmd, params, is_step in records:
+            if min_clock:
+                min_clock += offset
+            if req_clock:
+                req_clock += offset
+            if params is not None:
+                params = dict(params)
+                params['clock'] = (params['clock'] + offset) & 0xffffffff
+                cmd = cmd.encode_by_name(**params)
+            while req_clock > mcu.serial.get_clock(eventtime) + ahead_clock:
+                if mcu.is_shutdown:
+                    raise error("Print replay aborted due to mcu shutdown")
+                eventtime = reactor.pause(eventtime + 0.100)
+            cmd_queue = self.cmd_queue
+            if is_step:
+                cmd_queue = self.step_queue
+            mcu.send(cmd, min_clock, req_clock, cmd_queue)
+        # Wait for the replay to complete
+        mcu_time = mcu.print_to_mcu_time(toolhead.get_last_move_time())
+        toolhead.dwell(max(0., end_mcu_time - mcu_time))
+        self._set_final_position(toolhead, toolhead_pos, stepper_positions)
+        toolhead.motor_off()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python2
+# Record a print artifact, replay it in batch mode, and compare the results
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, subprocess, tempfile, shutil, json, re
+import msgproto, replay
+
+# The M18 notes the motors as disabled before the replay
+REPLAY_GCODE = "M18\nREPLAY_PRINT\nM114\n"
+
+class error(Exception):
+    pass
+
+def run_klippy(args, logname):
+    klippy = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'klippy.py')
+    ret = subprocess.call([sys.executable, klippy] + args + ['-l', logname])
+    if ret:
+        raise error("Klippy run failed (see %s)" % (logname,))
+
+# Decode the messages (a list of (name, params)) of a batch mode output
+def read_output(msgparser, filename):
+    data = open(filename, 'rb').read()
+    msgs = []
+    while data:
+        l = msgparser.check_packet(data)
+        if l <= 0:
+            raise error("Invalid data in %s" % (filename,))
+        block = bytearray(data[:l])
+        data = data[l:]
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            mp = msgparser.messages_by_id[block[pos]]
+            params, pos = mp.parse(block, pos)
+            msgs.append((mp.name, params))
+    return msgs
+
+# Decode the replayed messages (those after the get_config) of an artifact
+def read_artifact(msgparser, filename):
+    header, records, toolhead_pos, stepper_positions = replay.read_artifact(
+        filename)
+    msgs = []
+    in_config = True
+    end_clock = 0
+    for min_clock, req_clock, msg in records:
+        mp = msgparser.messages_by_id[msg[0]]
+        if in_config:
+            in_config = mp.name != 'get_config'
+            continue
+        params, pos = mp.parse(msg, 0)
+        msgs.append((mp.name, params))
+        end_clock = max(end_clock, req_clock)
+    return msgs, end_clock, toolhead_pos
+
+def group_msgs(msgs):
+    groups = {}
+    for name, params in msgs:
+        params = dict([(k, v) for k, v in params.items()
+                       if not k.startswith('#')])
+        groups.setdefault((name, params.get('oid')), []).append(params)
+    return groups
+
+def shift_clock(params, offset):
+    if 'clock' not in params:
+        return params
+    params = dict(params)
+    params['clock'] = (params['clock'] + offset) & 0xffffffff
+    return params
+
+# Check that the artifact commands of each (name, oid) were sent in
+# order (with the same clock offset) in the replay output.  The host
+# adds its own commands (motor enable and disable) around them.
+def match_groups(expected, actual, offset):
+    for key, elist in expected.items():
+        alist = actual.get(key, [])
+        pos = 0
+        for params in elist:
+            want = shift_clock(params, offset)
+            while pos < len(alist) and alist[pos] != want:
+                pos += 1
+            if pos >= len(alist):
+                return "Command %s %s was not replayed" % (key[0], want)
+            pos += 1
+    return None
+
+def find_offset(expected, actual):
+    # Try each offset that matches the first clocked command
+    for key, elist in sorted(expected.items()):
+        first = elist[0]
+        if 'clock' not in first:
+            continue
+        offsets = []
+        for params in actual.get(key, []):
+            offset = (params['clock'] - first['clock']) & 0xffffffff
+            if shift_clock(first, offset) == params:
+                offsets.append(offset)
+        for offset in offsets:
+            if match_groups(expected, actual, offset) is None:
+                return offset
+        if offsets:
+            raise error(match_groups(expected, actual, offsets[0]))
+        raise error("Command %s %s was not replayed" % (key[0], first))
+    raise error("Print artifact does not contain any timed commands")
+
+def read_m114(logname):
+    # Find the toolhead position reported by the M114 after the replay
+    pos = None
+    for line in open(logname, 'rb'):
+        if line.startswith('!! '):
+            raise error("Replay error: %s" % (line[3:].strip(),))
+        m = re.search(r'Count X:(\S+) Y:(\S+) Z:(\S+)', line)
+        if m is not None:
+            pos = [float(v) for v in m.groups()]
+    if pos is None:
+        raise error("No position reported after the replay")
+    return pos
+
+def check_replay(tmpdir, config, gcode, dictionary):
+    artifact = os.path.join(tmpdir, 'test.artifact')
+    output = os.path.join(tmpdir, 'replay.serial')
+    replay_gcode = os.path.join(tmpdir, 'replay.gcode')
+    replay_log = os.path.join(tmpdir, 'replay.log')
+    f = open(replay_gcode, 'wb')
+    f.write(REPLAY_GCODE)
+    f.close()
+    # Record the artifact and replay it in batch mode
+    run_klippy([config, '-i', gcode, '-c', artifact, '-d', dictionary],
+               os.path.join(tmpdir, 'record.log'))
+    run_klippy([config, '-i', replay_gcode, '-r', artifact, '-o', output,
+                '-d', dictionary, '-v'], replay_log)
+    # Compare the replay output with the artifact
+    msgparser = msgproto.MessageParser()
+    msgparser.process_identify(open(dictionary, 'rb').read(), decompress=False)
+    expected, end_clock, toolhead_pos = read_artifact(msgparser, artifact)
+    actual = read_output(msgparser, output)
+    offset = find_offset(group_msgs(expected), group_msgs(actual))
+    # The host must disable the motors once the replay completes
+    end_clock = (end_clock + offset) & 0xffffffff
+    motor_off = [p for n, p in actual
+                 if n == 'schedule_digital_out'
+                 and (p['clock'] - end_clock) & 0xffffffff < 0x80000000
+                 and p['clock'] != end_clock]
+    if not motor_off:
+        raise error("Motors not disabled after the replay")
+    position = read_m114(replay_log)
+    for i in range(3):
+        if abs(position[i] - toolhead_pos[i]) > .0005:
+            raise error("Position %s after replay does not match %s" % (
+                position, toolhead_pos[:3]))
+    return {'commands': len(expected), 'clock_offset': offset,
+            'position': position, 'motor_off_commands': len(motor_off)}
+
+def main():
+    usage = "%prog [options] <config file> <gcode file> <dictionary file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-k", "--keep", action="store_true", dest="keep",
+                    default=False, help="keep the generated files")
+    options, args = opts.parse_args()
+    if len(args) != 3:
+        opts.error("Incorrect number of arguments")
+    config, gcode, dictionary = [os.path.abspath(a) for a in args]
+    tmpdir = tempfile.mkdtemp(prefix='replaycheck')
+    try:
+        result = check_replay(tmpdir, config, gcode, dictionary)
+    except (error, replay.error, msgproto.error), e:
+        sys.stderr.write("Replay check failed: %s\n" % (str(e),))
+        if options.keep:
+            sys.stderr.write("Files kept in %s\n" % (tmpdir,))
+        sys.exit(-1)
+    finally:
+        if not options.keep:
+            shutil.rmtree(tmpdir)
+    sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main()
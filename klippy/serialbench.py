@@ -0,0 +1,280 @@
+#!/usr/bin/env python2
+# Benchmark of the host to micro-controller serial path
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, json, signal, logging
+import reactor, serialhdl, chelper, fakemcu
+
+START_DELAY = 0.250
+FLUSH_INTERVAL = 0.050
+PROBE_INTERVAL = 0.250
+
+class error(Exception):
+    pass
+
+# Parse the "name=value" pairs of SerialReader.stats()
+def parse_stats(stats):
+    out = {}
+    for part in stats.split():
+        name, value = part.split('=', 1)
+        try:
+            out[name] = float(value)
+        except ValueError:
+            out[name] = value
+    return out
+
+# Sends a stream of steps (via the normal step compression and serial
+# queue code) to a micro-controller
+class SerialBench:
+    def __init__(self, reactor, serialport, options):
+        self.reactor = reactor
+        self.options = options
+        self.serial = serialhdl.SerialReader(
+            reactor, serialport, options.baud, ext_window=options.ext_window)
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.steppers = []
+        self.steppersync = None
+        self.mcu_freq = 0.
+        self.probe_cmd = None
+        self.probe_times = []
+        self.shutdown_msg = None
+        self.result = None
+    # Micro-controller setup
+    def _send_config(self, count):
+        msgparser = self.serial.msgparser
+        cmds = ["allocate_oids count=%d" % (count,)]
+        for oid in range(count):
+            cmds.append("config_stepper oid=%d step_pin=0 dir_pin=0"
+                        " min_stop_interval=0 invert_step=0" % (oid,))
+        cmds.append("finalize_config crc=0")
+        for c in cmds:
+            self.serial.send(msgparser.create_command(c))
+        params = self.serial.send_with_response(
+            msgparser.create_command("get_config"), 'config')
+        if not params['is_config']:
+            raise error("Unable to configure micro-controller")
+        return params['move_count']
+    def _setup_steppers(self, count, move_count):
+        msgparser = self.serial.msgparser
+        step_cmd = msgparser.lookup_command(
+            "queue_step oid=%c interval=%u count=%hu add=%hi")
+        dir_cmd = msgparser.lookup_command("set_next_step_dir oid=%c dir=%c")
+        max_error = int(self.options.max_error * self.mcu_freq)
+        for oid in range(count):
+            sc = self.ffi_main.gc(self.ffi_lib.stepcompress_alloc(
+                max_error, step_cmd.msgid, dir_cmd.msgid, 0, oid),
+                                  self.ffi_lib.stepcompress_free)
+            self.steppers.append(sc)
+        self.steppersync = self.ffi_main.gc(self.ffi_lib.steppersync_alloc(
+            self.serial.serialqueue, self.steppers, count, move_count),
+                                            self.ffi_lib.steppersync_free)
+    def _reset_steppers(self, clock):
+        reset_cmd = self.serial.msgparser.lookup_command(
+            "reset_step_clock oid=%c clock=%u")
+        for oid, sc in enumerate(self.steppers):
+            self.ffi_lib.stepcompress_reset(sc, clock)
+            data = (reset_cmd.msgid, oid, clock & 0xffffffff)
+            self.ffi_lib.stepcompress_queue_msg(sc, data, len(data))
+    # Step generation
+    def _gen_steps(self, state, end_time):
+        # Moves alternate between two speeds (so that the moves can't
+        # be merged) and change direction every fourth move
+        options = self.options
+        move_steps = options.move_steps
+        for oid, sc in enumerate(self.steppers):
+            mcu_time, move_num = state[oid]
+            while mcu_time < end_time:
+                velocity = options.rate
+                if move_num & 1:
+                    velocity *= 0.8
+                steps = move_steps
+                if move_num & 4:
+                    steps = -steps
+                count = self.ffi_lib.stepcompress_push_const(
+                    sc, mcu_time * self.mcu_freq, 0., steps,
+                    velocity / self.mcu_freq, 0.)
+                if count != steps:
+                    raise error("Internal error in stepcompress")
+                mcu_time += move_steps / velocity
+                move_num += 1
+            state[oid] = (mcu_time, move_num)
+        ret = self.ffi_lib.steppersync_flush(
+            self.steppersync, int(end_time * self.mcu_freq))
+        if ret:
+            raise error("Internal error in stepcompress")
+    def _get_step_stats(self):
+        stats = self.ffi_main.new('struct stepcompress_stats *')
+        steps = msgs = 0
+        for sc in self.steppers:
+            self.ffi_lib.stepcompress_get_stats(sc, stats)
+            steps += stats.step_count
+            msgs += stats.queue_step_count + stats.queue_step_cubic_count
+        return steps, msgs
+    # Response handling
+    def _handle_probe(self, params):
+        self.probe_times.append(params['#receive_time'] - params['#sent_time'])
+    def _handle_shutdown(self, params):
+        self.shutdown_msg = params['#msg']
+    def _send_probe(self, eventtime):
+        self.serial.send(self.probe_cmd)
+        return eventtime + PROBE_INTERVAL
+    # Benchmark
+    def _run(self):
+        options = self.options
+        serial = self.serial
+        serial.connect()
+        msgparser = serial.msgparser
+        self.mcu_freq = msgparser.get_constant_float('CLOCK_FREQ')
+        move_count = self._send_config(options.steppers)
+        self._setup_steppers(options.steppers, move_count)
+        serial.register_callback(self._handle_probe, 'uptime')
+        serial.register_callback(self._handle_shutdown, 'shutdown')
+        self.probe_cmd = msgparser.create_command('get_uptime')
+        probe_timer = self.reactor.register_timer(
+            self._send_probe, self.reactor.NOW)
+        # Generate steps
+        eventtime = self.reactor.monotonic()
+        start_time = serial.get_clock(eventtime) / self.mcu_freq + START_DELAY
+        self._reset_steppers(int(start_time * self.mcu_freq))
+        state = [(start_time, 0)] * options.steppers
+        start_cpu = os.times()
+        start_eventtime = eventtime
+        max_backlog = 0
+        while eventtime < start_eventtime + options.duration:
+            if self.shutdown_msg is not None:
+                break
+            mcu_time = serial.get_clock(eventtime) / self.mcu_freq
+            self._gen_steps(state, mcu_time + options.buffer_time)
+            max_backlog = max(max_backlog, serial.get_ready_time())
+            eventtime = self.reactor.pause(eventtime + FLUSH_INTERVAL)
+        end_cpu = os.times()
+        # Wait for the queued steps to be transmitted
+        end_time = max([mcu_time for mcu_time, move_num in state])
+        while self.shutdown_msg is None:
+            if serial.get_clock(eventtime) / self.mcu_freq > end_time + .100:
+                break
+            eventtime = self.reactor.pause(eventtime + FLUSH_INTERVAL)
+        self.reactor.unregister_timer(probe_timer)
+        # Report results
+        steps, msgs = self._get_step_stats()
+        sqstats = parse_stats(serial.stats(eventtime))
+        duration = end_cpu[4] - start_cpu[4]
+        cpu_time = (end_cpu[0] + end_cpu[1]) - (start_cpu[0] + start_cpu[1])
+        probe_times = self.probe_times or [0.]
+        self.result = {
+            'host_steps': steps, 'host_queue_step': msgs,
+            'host_cpu_percent': round(100. * cpu_time / duration, 1),
+            'host_cpu_per_queue_step': round(cpu_time / max(1, msgs), 9),
+            'host_max_backlog_time': round(max_backlog, 6),
+            'ack_srtt': sqstats.get('srtt'),
+            'ack_rttvar': sqstats.get('rttvar'),
+            'probe_latency_avg': round(sum(probe_times) / len(probe_times), 6),
+            'probe_latency_max': round(max(probe_times), 6),
+            'bytes_write': sqstats.get('bytes_write'),
+            'bytes_retransmit': sqstats.get('bytes_retransmit'),
+            'bytes_invalid': sqstats.get('bytes_invalid'),
+            'mcu_shutdown': self.shutdown_msg}
+    def run(self, eventtime):
+        try:
+            self._run()
+        except:
+            logging.exception("Unhandled exception during benchmark")
+        self.serial.disconnect()
+        self.reactor.end()
+        return self.reactor.NEVER
+
+# Run the fake micro-controller in a child process
+def start_fake_mcu(dictionary, options):
+    mfd, sfd, ptyname = fakemcu.create_pty()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        fm = fakemcu.FakeMCU(mfd, dictionary, options.baud, options.move_count,
+                             options.noise, options.seed)
+        signal.signal(signal.SIGTERM, fm.stop)
+        fm.run()
+        os.write(wfd, json.dumps(fm.get_stats()))
+        os._exit(0)
+    os.close(wfd)
+    os.close(mfd)
+    return pid, rfd, sfd, ptyname
+
+def stop_fake_mcu(pid, rfd):
+    os.kill(pid, signal.SIGTERM)
+    data = ""
+    while 1:
+        d = os.read(rfd, 4096)
+        if not d:
+            break
+        data += d
+    os.close(rfd)
+    pid, status, rusage = os.wait4(pid, 0)
+    if not data:
+        return {}
+    stats = json.loads(data)
+    stats['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+    return stats
+
+def main():
+    usage = "%prog [options] <dictionary file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-b", "--baud", type="int", dest="baud", default=250000,
+                    help="modeled serial baud rate")
+    opts.add_option("-m", "--move-count", type="int", dest="move_count",
+                    default=512, help="size of the mcu move queue")
+    opts.add_option("-n", "--noise", type="float", dest="noise", default=0.,
+                    help="probability of corrupting each byte sent to the mcu")
+    opts.add_option("-s", "--steppers", type="int", dest="steppers", default=3,
+                    help="number of steppers")
+    opts.add_option("-r", "--rate", type="float", dest="rate", default=4000.,
+                    help="steps per second of each stepper")
+    opts.add_option("-c", "--move-steps", type="int", dest="move_steps",
+                    default=8, help="number of steps in each move")
+    opts.add_option("-t", "--duration", type="float", dest="duration",
+                    default=10., help="time (in seconds) to generate steps")
+    opts.add_option("-a", "--buffer-time", type="float", dest="buffer_time",
+                    default=0.500, help="time steps are scheduled in advance")
+    opts.add_option("-e", "--max-error", type="float", dest="max_error",
+                    default=0.000025, help="maximum step time error")
+    opts.add_option("-x", "--ext-window", action="store_true",
+                    dest="ext_window", default=False,
+                    help="use the extended sequence mode (if supported)")
+    opts.add_option("--seed", type="int", dest="seed", default=1,
+                    help="random seed of the injected noise")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARN)
+    dictionary = open(args[0], 'rb').read()
+    pid, rfd, sfd, ptyname = start_fake_mcu(dictionary, options)
+    r = reactor.Reactor()
+    bench = SerialBench(r, ptyname, options)
+    r.register_timer(bench.run, r.NOW)
+    try:
+        r.run()
+    finally:
+        mcu_stats = stop_fake_mcu(pid, rfd)
+        os.close(sfd)
+    if bench.result is None:
+        sys.exit(-1)
+    result = dict(bench.result)
+    step_time = (mcu_stats.get('last_step_cmd_time', 0.)
+                 - mcu_stats.get('first_step_cmd_time', 0.))
+    mcu_queue_step = mcu_stats.get('queue_step', 0)
+    result.update({
+        'mcu_queue_step': mcu_queue_step,
+        'mcu_queue_step_per_sec': round(mcu_queue_step / max(step_time, .001),
+                                        1),
+        'mcu_naks': mcu_stats.get('naks_sent'),
+        'mcu_corrupt_bytes': mcu_stats.get('corrupt_bytes'),
+        'mcu_max_move_queue': mcu_stats.get('max_move_queue'),
+        'mcu_min_step_lead': mcu_stats.get('min_step_lead'),
+        'mcu_cpu_time': mcu_stats.get('cpu_time'),
+        'mcu_shutdown': mcu_stats.get('shutdown') or result['mcu_shutdown']})
+    sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main()
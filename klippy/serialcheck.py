@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+# Check the serial protocol error recovery with an injected noise link
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, json, select, subprocess, threading
+import random, collections, logging
+import reactor, serialhdl, fakemcu
+
+POLL_INTERVAL = 0.001
+MAX_PENDING = 200
+
+# Forward the data between a pseudo-tty and a micro-controller
+# simulator (a "linux simulator" build of the micro-controller code)
+# with a fixed latency, corrupting random bytes sent to the simulator
+class NoiseLink:
+    def __init__(self, mfd, sim, noise, delay, seed):
+        self.mfd = mfd
+        self.sim = sim
+        self.noise = noise
+        self.delay = delay
+        self.rand = random.Random(seed)
+        self.corrupt_bytes = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+    def start(self):
+        self.thread.start()
+    def _corrupt(self, data):
+        data = bytearray(data)
+        for i in range(len(data)):
+            if self.rand.random() < self.noise:
+                data[i] ^= 1 << self.rand.randrange(8)
+                self.corrupt_bytes += 1
+        return str(data)
+    def _run(self):
+        sim_in = self.sim.stdin.fileno()
+        sim_out = self.sim.stdout.fileno()
+        pending = collections.deque()
+        while 1:
+            rfds, wfds, efds = select.select(
+                [self.mfd, sim_out], [], [], POLL_INTERVAL)
+            curtime = time.time()
+            for fd in rfds:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                if fd == self.mfd:
+                    pending.append((curtime + self.delay, sim_in,
+                                    self._corrupt(data)))
+                else:
+                    pending.append((curtime + self.delay, self.mfd, data))
+            while pending and pending[0][0] <= curtime:
+                sendtime, fd, data = pending.popleft()
+                os.write(fd, data)
+
+# Sends a numbered stream of debug_ping commands and checks that each
+# pong arrives exactly once and in order
+class SerialCheck:
+    def __init__(self, reactor, serialport, options):
+        self.reactor = reactor
+        self.options = options
+        self.serial = serialhdl.SerialReader(
+            reactor, serialport, 250000, ext_window=options.ext_window)
+        self.pongs = []
+        self.result = None
+    def _handle_pong(self, params):
+        self.pongs.append(int(params['data']))
+    def _handle_stats(self, params):
+        pass
+    def _run(self):
+        options = self.options
+        serial = self.serial
+        serial.connect()
+        serial.register_callback(self._handle_pong, 'pong')
+        serial.register_callback(self._handle_stats, 'stats')
+        ping = serial.msgparser.lookup_command('debug_ping data=%*s')
+        start_time = time.time()
+        eventtime = self.reactor.monotonic()
+        for i in range(options.count):
+            serial.send(ping.encode(str(i)))
+            # Limit the number of commands queued in the host
+            while len(self.pongs) < i - MAX_PENDING:
+                eventtime = self.reactor.pause(eventtime + .001)
+        end_time = eventtime + options.timeout
+        while len(self.pongs) < options.count and eventtime < end_time:
+            eventtime = self.reactor.pause(eventtime + .010)
+        duration = time.time() - start_time
+        stats = dict([p.split('=', 1) for p in serial.stats(eventtime).split()
+                      if '=' in p])
+        ext_window = 0
+        if options.ext_window:
+            ext_window = int(serial.msgparser.config.get(
+                'SERIAL_EXT_WINDOW', 0))
+        self.result = {
+            'ext_window': ext_window,
+            'ok': self.pongs == range(options.count),
+            'pongs': len(self.pongs),
+            'duplicates': len(self.pongs) - len(set(self.pongs)),
+            'time': round(duration, 3),
+            'bytes_write': int(stats.get('bytes_write', 0)),
+            'bytes_retransmit': int(stats.get('bytes_retransmit', 0))}
+    def run(self, eventtime):
+        try:
+            self._run()
+        except:
+            logging.exception("Unhandled exception during check")
+        self.serial.disconnect()
+        self.reactor.end()
+        return self.reactor.NEVER
+
+def main():
+    usage = "%prog [options] <simulator executable>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=2000,
+                    help="number of debug_ping commands to send")
+    opts.add_option("-n", "--noise", type="float", dest="noise", default=0.,
+                    help="probability of corrupting each byte sent to the mcu")
+    opts.add_option("-d", "--delay", type="float", dest="delay",
+                    default=0.004, help="latency of the link (in seconds)")
+    opts.add_option("-e", "--ext-window", action="store_true",
+                    dest="ext_window", default=False,
+                    help="use the extended sequence mode (if supported)")
+    opts.add_option("-t", "--timeout", type="float", dest="timeout",
+                    default=60., help="time to wait for the responses")
+    opts.add_option("--seed", type="int", dest="seed", default=1,
+                    help="random seed of the injected noise")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARN)
+    sim = subprocess.Popen([args[0]], stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE)
+    mfd, sfd, ptyname = fakemcu.create_pty()
+    link = NoiseLink(mfd, sim, options.noise, options.delay, options.seed)
+    link.start()
+    r = reactor.Reactor()
+    check = SerialCheck(r, ptyname, options)
+    r.register_timer(check.run, r.NOW)
+    try:
+        r.run()
+    finally:
+        sim.kill()
+        sim.wait()
+        os.close(sfd)
+    if check.result is None:
+        sys.exit(-1)
+    result = dict(check.result)
+    result['corrupt_bytes'] = link.corrupt_bytes
+    sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+    if not result['ok']:
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import logging, threading, collections, math
 import serial
 
 import msgproto, chelper, util
@@ -11,24 +11,124 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Response parameter types of the C response decoder
+RP_UINT32, RP_INT32, RP_BUFFER = 0, 1, 2
+
+# Number of recent clock samples used in the clock regression
+CLOCK_SYNC_WINDOW = 32
+# Samples with a round trip time this far above the recent minimum
+# are not used in the clock regression (eg, retransmitted queries)
+CLOCK_SYNC_RTT_MARGIN = .005
+
+# Estimate the mcu clock from the (sent_time, receive_time, clock) of
+# query responses.  A linear regression over a window of recent
+# samples provides the clock frequency (as measured with the host's
+# clock) and the expected error of the clock prediction.
+class ClockSync:
+    def __init__(self):
+        self.nominal_freq = 0.
+        self.samples = collections.deque(maxlen=CLOCK_SYNC_WINDOW)
+        self.outliers = self.count = 0
+        self.last_clock = 0
+        self.last_time = 0.
+        # Prediction: clock = clock_ref + freq * (time - time_ref)
+        self.freq = self.time_ref = self.clock_ref = 0.
+        self.min_half_rtt = 0.
+        # Regression state for the prediction error
+        self.residual_var = self.time_var = 0.
+    def reset(self, nominal_freq):
+        self.__init__()
+        self.nominal_freq = nominal_freq
+    def set_fixed(self, freq, eventtime, clock):
+        # Use a fixed clock rate (for file output)
+        self.reset(freq)
+        self.freq = freq
+        self.time_ref = self.last_time = eventtime
+        self.clock_ref = self.last_clock = clock
+    def extend_clock(self, clock):
+        # Convert a 32bit clock to a 64bit clock (near the last sample)
+        last_clock = self.last_clock
+        clock_diff = (last_clock - clock) & 0xffffffff
+        if clock_diff & 0x80000000:
+            return last_clock + 0x100000000 - clock_diff
+        return last_clock - clock_diff
+    def add_sample(self, clock, sent_time, receive_time):
+        self.last_clock = clock
+        self.last_time = receive_time
+        if not sent_time:
+            return
+        # The mcu clock was sampled about half a round trip after sending
+        rtt = receive_time - sent_time
+        self.samples.append((sent_time + .5 * rtt, clock, rtt))
+        # Skip samples with an unusually long round trip time
+        min_rtt = min([r for t, c, r in self.samples])
+        self.min_half_rtt = .5 * min_rtt
+        max_rtt = min_rtt + CLOCK_SYNC_RTT_MARGIN
+        if rtt > max_rtt:
+            self.outliers += 1
+        samples = [(t, c) for t, c, r in self.samples if r <= max_rtt]
+        self.count = count = len(samples)
+        time_avg = sum([t for t, c in samples]) / count
+        clock_avg = sum([c for t, c in samples]) / float(count)
+        if count < 2:
+            self.freq = self.nominal_freq
+            self.time_ref, self.clock_ref = time_avg, clock_avg
+            self.residual_var = self.time_var = 0.
+            return
+        # Linear regression of clock versus host time
+        time_var = clock_cov = 0.
+        for t, c in samples:
+            diff_time = t - time_avg
+            time_var += diff_time**2
+            clock_cov += diff_time * (c - clock_avg)
+        freq = clock_cov / time_var
+        residual_var = 0.
+        if count > 2:
+            residuals = sum([(c - clock_avg - freq * (t - time_avg))**2
+                             for t, c in samples])
+            residual_var = residuals / (count - 2)
+        self.freq = freq
+        self.time_ref, self.clock_ref = time_avg, clock_avg
+        self.residual_var, self.time_var = residual_var, time_var
+    def get_clock(self, eventtime):
+        return self.clock_ref + (eventtime - self.time_ref) * self.freq
+    def get_error(self, eventtime):
+        # Standard deviation (in seconds) of the predicted clock
+        count = self.count
+        if count <= 2 or not self.freq:
+            return self.min_half_rtt
+        diff_time = eventtime - self.time_ref
+        var = self.residual_var * (1. / count + diff_time**2 / self.time_var)
+        return math.sqrt(var) / self.freq
+    def get_drift(self):
+        # Difference between the measured and nominal rate (in ppm)
+        if not self.freq or not self.nominal_freq:
+            return 0.
+        return (self.freq - self.nominal_freq) * 1000000. / self.nominal_freq
+
 class SerialReader:
     BITS_PER_BYTE = 10.
-    def __init__(self, reactor, serialport, baud):
+    PULL_BATCH = 32
+    def __init__(self, reactor, serialport, baud, native_receive=False,
+                 ext_window=False):
         self.reactor = reactor
         self.serialport = serialport
         self.baud = baud
+        self.native_receive = native_receive
+        self.ext_window = ext_window
         # Serial port
         self.ser = None
-        self.msgparser = msgproto.MessageParser()
         # C interface
         self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.msgparser = msgproto.MessageParser()
+        self.msgparser.set_c_helper(self.ffi_lib)
         self.serialqueue = None
         self.default_cmd_queue = self.alloc_command_queue()
         self.stats_buf = self.ffi_main.new('char[4096]')
         # MCU time/clock tracking
-        self.last_ack_time = self.last_ack_rtt_time = 0.
-        self.last_ack_clock = self.last_ack_rtt_clock = 0
-        self.est_clock = 0.
+        self.clocksync = ClockSync()
+        # Response filtering in the C code
+        self.is_native = False
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
@@ -42,22 +142,27 @@ class SerialReader:
         }
         self.handlers = dict(((k, None), v) for k, v in handlers.items())
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new(
+            'struct pull_queue_message[%d]' % (self.PULL_BATCH,))
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
-            if count <= 0:
+            count = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, self.PULL_BATCH)
+            if count < 0:
                 break
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            with self.lock:
-                hdl = (params['#name'], params.get('oid'))
-                hdl = self.handlers.get(hdl, self.handle_default)
-            try:
-                hdl(params)
-            except:
-                logging.exception("Exception in serial callback")
+            for i in range(count):
+                # Parse the message in place (slicing a cdata array
+                # does not copy it)
+                response = responses[i]
+                params = self.msgparser.parse(response.msg[0:response.len])
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                with self.lock:
+                    hdl = (params['#name'], params.get('oid'))
+                    hdl = self.handlers.get(hdl, self.handle_default)
+                try:
+                    hdl(params)
+                except:
+                    logging.exception("Exception in serial callback")
     def connect(self):
         # Initial connection
         logging.info("Starting serial connect")
@@ -83,9 +188,12 @@ class SerialReader:
                 continue
             break
         msgparser = msgproto.MessageParser()
+        msgparser.set_c_helper(self.ffi_lib)
         msgparser.process_identify(identify_data)
         self.msgparser = msgparser
         self.register_callback(self.handle_unknown, '#unknown')
+        if self.native_receive:
+            self._setup_native_receive()
         logging.info("Loaded %d commands (%s)" % (
             len(msgparser.messages_by_id), msgparser.version))
         logging.info("MCU config: %s" % (" ".join(
@@ -96,52 +204,104 @@ class SerialReader:
             baud_adjust = self.BITS_PER_BYTE / mcu_baud
             self.ffi_lib.serialqueue_set_baud_adjust(
                 self.serialqueue, baud_adjust)
+        # Use the extended sequence mode if enabled and the mcu supports it
+        ext_window = int(msgparser.config.get('SERIAL_EXT_WINDOW', 0))
+        if self.ext_window and ext_window:
+            self.ffi_lib.serialqueue_set_ext_window(
+                self.serialqueue, ext_window)
         # Enable periodic get_status timer
+        with self.lock:
+            self.clocksync.reset(msgparser.get_constant_float('CLOCK_FREQ'))
         get_status = msgparser.lookup_command('get_status')
         self.status_cmd = get_status.encode()
         self.reactor.update_timer(self.status_timer, self.reactor.NOW)
-        # Load initial last_ack_clock/last_ack_time
+        # Load initial clock
         uptime_msg = msgparser.create_command('get_uptime')
         params = self.send_with_response(uptime_msg, 'uptime')
-        self.last_ack_clock = (params['high'] << 32) | params['clock']
-        self.last_ack_time = params['#receive_time']
+        with self.lock:
+            clock = (params['high'] << 32) | params['clock']
+            self.clocksync.add_sample(
+                clock, params['#sent_time'], params['#receive_time'])
+            self._update_clock_est()
         # Make sure est_clock is calculated
         starttime = eventtime = self.reactor.monotonic()
-        while not self.est_clock:
+        while not self.clocksync.freq:
             if eventtime > starttime + 5.:
                 raise error("timeout on est_clock calculation")
             eventtime = self.reactor.pause(eventtime + 0.010)
-    def connect_file(self, debugoutput, dictionary, pace=False):
+    def connect_file(self, debugoutput, dictionary, pace=False, record=False):
         self.ser = debugoutput
         self.msgparser.process_identify(dictionary, decompress=False)
         est_clock = 1000000000000.
         if pace:
             est_clock = float(self.msgparser.config['CLOCK_FREQ'])
         self.serialqueue = self.ffi_lib.serialqueue_alloc(self.ser.fileno(), 1)
-        self.est_clock = est_clock
-        self.last_ack_time = self.reactor.monotonic()
-        self.last_ack_clock = 0
-        self.ffi_lib.serialqueue_set_clock_est(
-            self.serialqueue, self.est_clock, self.last_ack_time
-            , self.last_ack_clock)
+        if record:
+            self.ffi_lib.serialqueue_set_record(self.serialqueue, 1)
+        with self.lock:
+            self.clocksync.set_fixed(est_clock, self.reactor.monotonic(), 0)
+            self._update_clock_est()
+    def _setup_native_receive(self):
+        # Decode the responses in the C code and only pass the
+        # responses that have a handler to python
+        with self.lock:
+            for msgid, mp in self.msgparser.messages_by_id.items():
+                if not isinstance(mp, msgproto.MessageFormat):
+                    continue
+                types = []
+                for t in mp.param_types:
+                    if not t.is_int:
+                        types.append(RP_BUFFER)
+                    elif t.signed:
+                        types.append(RP_INT32)
+                    else:
+                        types.append(RP_UINT32)
+                oid_param = -1
+                if 'oid' in mp.names:
+                    oid_param = mp.names.index('oid')
+                self.ffi_lib.serialqueue_set_response_format(
+                    self.serialqueue, msgid, types, len(types), oid_param)
+                for name, oid in self.handlers:
+                    if name == mp.name:
+                        self._set_response_handler(mp, oid, 1)
+            self.is_native = True
+    def _set_response_handler(self, mp, oid, enable):
+        if oid is None:
+            oid = -1
+        self.ffi_lib.serialqueue_set_response_handler(
+            self.serialqueue, mp.msgid, oid, enable)
     def disconnect(self):
         if self.serialqueue is not None:
             self.ffi_lib.serialqueue_exit(self.serialqueue)
             if self.background_thread is not None:
                 self.background_thread.join()
+            with self.lock:
+                self.is_native = False
             self.ffi_lib.serialqueue_free(self.serialqueue)
             self.background_thread = self.serialqueue = None
         if self.ser is not None:
             self.ser.close()
             self.ser = None
+    def get_ready_time(self):
+        # Time needed to transmit the messages that are ready to be sent
+        if self.serialqueue is None or not self.baud:
+            return 0.
+        ready_bytes = self.ffi_lib.serialqueue_get_ready_bytes(self.serialqueue)
+        return ready_bytes * self.BITS_PER_BYTE / self.baud
     def stats(self, eventtime):
         if self.serialqueue is None:
             return ""
         sqstats = self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
         sqstats = self.ffi_main.string(self.stats_buf)
-        tstats = " est_clock=%.3f last_ack_time=%.3f last_ack_clock=%d" % (
-            self.est_clock, self.last_ack_time, self.last_ack_clock)
+        with self.lock:
+            cs = self.clocksync
+            tstats = (" est_clock=%.3f clock_drift=%.3f clock_error=%.6f"
+                      " min_half_rtt=%.6f clock_outliers=%d"
+                      " last_ack_time=%.3f last_ack_clock=%d" % (
+                          cs.freq, cs.get_drift(), cs.get_error(eventtime),
+                          cs.min_half_rtt, cs.outliers,
+                          cs.last_time, cs.last_clock))
         return sqstats + tstats
     def _status_event(self, eventtime):
         self.send(self.status_cmd)
@@ -150,24 +310,37 @@ class SerialReader:
     def register_callback(self, callback, name, oid=None):
         with self.lock:
             self.handlers[name, oid] = callback
+            if self.is_native:
+                mp = self.msgparser.messages_by_name.get(name)
+                if mp is not None:
+                    self._set_response_handler(mp, oid, 1)
     def unregister_callback(self, name, oid=None):
         with self.lock:
             del self.handlers[name, oid]
+            if self.is_native:
+                mp = self.msgparser.messages_by_name.get(name)
+                if mp is not None:
+                    self._set_response_handler(mp, oid, 0)
     # Clock tracking
+    def _update_clock_est(self):
+        # Pass a conservative (low) clock estimate to the C code so
+        # that messages are not sent before their minimum clock
+        cs = self.clocksync
+        clock = cs.clock_ref - 3. * cs.get_error(cs.last_time) * cs.freq
+        self.ffi_lib.serialqueue_set_clock_est(
+            self.serialqueue, cs.freq, cs.time_ref, max(0, int(clock)))
     def get_clock(self, eventtime):
         with self.lock:
-            return int(self.last_ack_clock
-                       + (eventtime - self.last_ack_time) * self.est_clock)
+            return int(self.clocksync.get_clock(eventtime))
+    def get_clock_error(self, eventtime):
+        with self.lock:
+            return self.clocksync.get_error(eventtime)
     def translate_clock(self, raw_clock):
         with self.lock:
-            last_ack_clock = self.last_ack_clock
-        clock_diff = (last_ack_clock - raw_clock) & 0xffffffff
-        if clock_diff & 0x80000000:
-            return last_ack_clock + 0x100000000 - clock_diff
-        return last_ack_clock - clock_diff
+            return self.clocksync.extend_clock(raw_clock)
     def get_last_clock(self):
         with self.lock:
-            return self.last_ack_clock, self.last_ack_time
+            return self.clocksync.last_clock, self.clocksync.last_time
     # Command sending
     def send(self, cmd, minclock=0, reqclock=0, cq=None):
         if cq is None:
@@ -206,27 +379,13 @@ class SerialReader:
     # Default message handlers
     def handle_status(self, params):
         with self.lock:
-            # Update last_ack_time / last_ack_clock
-            ack_clock = (self.last_ack_clock & ~0xffffffff) | params['clock']
-            if ack_clock < self.last_ack_clock:
-                ack_clock += 0x100000000
-            sent_time = params['#sent_time']
-            self.last_ack_time = receive_time = params['#receive_time']
-            self.last_ack_clock = ack_clock
-            # Update est_clock (if applicable)
-            if receive_time > self.last_ack_rtt_time + 1. and sent_time:
-                if self.last_ack_rtt_time:
-                    timedelta = receive_time - self.last_ack_rtt_time
-                    clockdelta = ack_clock - self.last_ack_rtt_clock
-                    estclock = clockdelta / timedelta
-                    if estclock > self.est_clock and self.est_clock:
-                        self.est_clock = (self.est_clock * 63. + estclock) / 64.
-                    else:
-                        self.est_clock = estclock
-                self.last_ack_rtt_time = sent_time
-                self.last_ack_rtt_clock = ack_clock
-            self.ffi_lib.serialqueue_set_clock_est(
-                self.serialqueue, self.est_clock, receive_time, ack_clock)
+            cs = self.clocksync
+            if not cs.last_time:
+                # Initial clock not yet loaded
+                return
+            clock = cs.extend_clock(params['clock'])
+            cs.add_sample(clock, params['#sent_time'], params['#receive_time'])
+            self._update_clock_est()
     def handle_unknown(self, params):
         logging.warn("Unknown message type %d: %s" % (
             params['#msgid'], repr(params['#msg'])))
@@ -23,6 +23,7 @@
 #include <termios.h> // tcflush
 #include <unistd.h> // pipe
 #include "list.h" // list_add_tail
+#include "minheap.h" // minheap_push
 #include "pyhelper.h" // get_monotonic
 #include "serialqueue.h" // struct queue_message
 
@@ -187,7 +188,7 @@ pollreactor_is_exit(struct pollreactor *pr)
 
 // Implement the standard crc "ccitt" algorithm on the given buffer
 static uint16_t
-crc16_ccitt(uint8_t *buf, uint8_t len)
+crc16_ccitt(uint8_t *buf, int len)
 {
     uint16_t crc = 0xffff;
     while (len--) {
@@ -213,7 +214,8 @@ check_message(uint8_t *need_sync, uint8_t *buf, int buf_len)
     if (msglen < MESSAGE_MIN || msglen > MESSAGE_MAX)
         goto error;
     uint8_t msgseq = buf[MESSAGE_POS_SEQ];
-    if ((msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST)
+    if ((msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST
+        && !(msgseq & MESSAGE_EXT_SEQ))
         goto error;
     if (buf_len < msglen)
         // Need more data
@@ -255,6 +257,50 @@ f4: *p++ = v & 0x7f;
     return p;
 }
 
+// Decode a variable length quantity (vlq) integer at 'pos'.  Returns
+// the position after the integer or -1 if the buffer is too short.
+static int
+decode_int(uint8_t *buf, int buf_len, int pos, uint32_t *pv)
+{
+    if (pos >= buf_len)
+        return -1;
+    uint8_t c = buf[pos++];
+    uint32_t v = c & 0x7f;
+    if ((c & 0x60) == 0x60)
+        v |= -0x20;
+    while (c & 0x80) {
+        if (pos >= buf_len)
+            return -1;
+        c = buf[pos++];
+        v = (v<<7) | (c & 0x7f);
+    }
+    *pv = v;
+    return pos;
+}
+
+
+/****************************************************************
+ * Message block helpers for the python message parser
+ ****************************************************************/
+
+// Return the crc of a buffer
+uint16_t
+msgproto_crc16(uint8_t *buf, int len)
+{
+    return crc16_ccitt(buf, len);
+}
+
+// Check if a buffer starts with a valid message block.  Returns the
+// length of the block, 0 if more data is needed, or -1 if the data is
+// not a valid message block.
+int
+msgproto_check_block(uint8_t *buf, int buf_len)
+{
+    uint8_t need_sync = 0;
+    int ret = check_message(&need_sync, buf, buf_len);
+    return ret < 0 ? -1 : ret;
+}
+
 
 /****************************************************************
  * Command queues
@@ -263,6 +309,7 @@ f4: *p++ = v & 0x7f;
 struct command_queue {
     struct list_head stalled_queue, ready_queue;
     struct list_node node;
+    uint32_t pending_order;
 };
 
 // Allocate a 'struct queue_message' object
@@ -352,18 +399,40 @@ struct serialqueue {
     uint64_t retransmit_seq, rtt_sample_seq;
     struct list_head sent_queue;
     double srtt, rttvar, rto;
+    int window, ext_seq, ext_window_pending, nak_retransmit;
     // Pending transmission message queues
     struct list_head pending_queues;
+    uint32_t pending_order;
+    struct minheap ready_heap, stalled_heap;
     int ready_bytes, stalled_bytes;
     uint64_t need_kick_clock;
     // Received messages
     struct list_head receive_queue;
+    // Native response decoding (indexed by msgid)
+    struct response_format *responses;
+    int num_responses;
     // Debugging
     struct list_head old_sent, old_receive;
+    int record;
     // Stats
     uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint32_t receive_filtered;
 };
 
+// Response parameter types (see serialqueue_set_response_format)
+enum { RP_UINT32, RP_INT32, RP_BUFFER };
+
+#define RESPONSE_MAX_PARAMS 16
+
+struct response_format {
+    uint8_t is_set, num_params, oid_param, types[RESPONSE_MAX_PARAMS];
+    // Set if python has a handler for the message (for each oid)
+    uint8_t want_no_oid;
+    uint32_t want_oids[256 / 32];
+};
+
+#define RESPONSE_NO_OID 0xff
+
 #define SQPF_SERIAL 0
 #define SQPF_PIPE   1
 #define SQPF_NUM    2
@@ -374,10 +443,13 @@ struct serialqueue {
 
 #define MIN_RTO 0.025
 #define MAX_RTO 5.000
+#define MAX_EXT_WINDOW (MESSAGE_EXT_SEQ_MASK / 2)
 #define MAX_SERIAL_BUFFER 0.050
 #define MIN_REQTIME_DELTA 0.250
 #define IDLE_QUERY_TIME 1.0
 
+#define RECORD_HEADER_SIZE 17
+
 #define DEBUG_QUEUE_SENT 100
 #define DEBUG_QUEUE_RECEIVE 20
 
@@ -474,29 +546,74 @@ update_receive_seq(struct serialqueue *sq, double eventtime, uint64_t rseq)
     }
 }
 
+// Decode a received response.
+// Returns non-zero if the message should be passed to python.
+static int
+check_response(struct serialqueue *sq, struct queue_message *qm)
+{
+    int len = qm->len - MESSAGE_TRAILER_SIZE, pos = MESSAGE_HEADER_SIZE;
+    uint8_t msgid = qm->msg[pos++];
+    if (msgid >= sq->num_responses || !sq->responses[msgid].is_set)
+        // Not a known response (python reports unknown messages)
+        return 1;
+    struct response_format *rf = &sq->responses[msgid];
+    uint32_t params[RESPONSE_MAX_PARAMS];
+    int i;
+    for (i=0; i<rf->num_params; i++) {
+        if (rf->types[i] == RP_BUFFER) {
+            if (pos >= len || pos + 1 + qm->msg[pos] > len)
+                return 1;
+            params[i] = pos;
+            pos += 1 + qm->msg[pos];
+            continue;
+        }
+        pos = decode_int(qm->msg, len, pos, &params[i]);
+        if (pos < 0)
+            return 1;
+    }
+    if (pos != len)
+        // Python reports invalid messages
+        return 1;
+    if (rf->oid_param == RESPONSE_NO_OID)
+        return rf->want_no_oid;
+    uint32_t oid = params[rf->oid_param];
+    return oid < 256 && rf->want_oids[oid / 32] & (1 << (oid % 32));
+}
+
 // Process a well formed input message
 static void
 handle_message(struct serialqueue *sq, double eventtime, int len)
 {
     // Calculate receive sequence number
-    uint64_t rseq = ((sq->receive_seq & ~MESSAGE_SEQ_MASK)
-                     | (sq->input_buf[MESSAGE_POS_SEQ] & MESSAGE_SEQ_MASK));
+    uint8_t msgseq = sq->input_buf[MESSAGE_POS_SEQ];
+    uint64_t seq_mask = MESSAGE_SEQ_MASK;
+    if (msgseq & MESSAGE_EXT_SEQ)
+        seq_mask = MESSAGE_EXT_SEQ_MASK;
+    uint64_t rseq = (sq->receive_seq & ~seq_mask) | (msgseq & seq_mask);
     if (rseq < sq->receive_seq)
-        rseq += MESSAGE_SEQ_MASK+1;
+        rseq += seq_mask+1;
 
-    if (rseq != sq->receive_seq)
+    if (rseq != sq->receive_seq) {
         // New sequence number
         update_receive_seq(sq, eventtime, rseq);
-    else if (len == MESSAGE_MIN && rseq > sq->retransmit_seq
-             && !list_empty(&sq->sent_queue))
+    } else if (len == MESSAGE_MIN && rseq > sq->retransmit_seq
+               && !list_empty(&sq->sent_queue)) {
         // Duplicate sequence number in an empty message is a nak
+        sq->nak_retransmit = 1;
         pollreactor_update_timer(&sq->pr, SQPT_RETRANSMIT, PR_NOW);
+    }
 
     if (len > MESSAGE_MIN) {
         // Add message to receive queue
         struct queue_message *qm = message_fill(sq->input_buf, len);
         qm->sent_time = sq->last_receive_sent_time;
         qm->receive_time = get_monotonic(); // must be time post read()
+        if (sq->num_responses && !check_response(sq, qm)) {
+            // No python handler for this message
+            sq->receive_filtered++;
+            debug_queue_add(&sq->old_receive, qm);
+            return;
+        }
         list_add_tail(&qm->node, &sq->receive_queue);
         check_wake_receive(sq);
     }
@@ -549,10 +666,41 @@ kick_event(struct serialqueue *sq, double eventtime)
     pollreactor_update_timer(&sq->pr, SQPT_COMMAND, PR_NOW);
 }
 
+// Resend only the block that the mcu reported as missing (the mcu
+// holds the blocks sent after it when in extended sequence mode)
+static double
+selective_retransmit(struct serialqueue *sq, double eventtime)
+{
+    sq->nak_retransmit = 0;
+    if (list_empty(&sq->sent_queue))
+        return PR_NEVER;
+    struct queue_message *qm = list_first_entry(
+        &sq->sent_queue, struct queue_message, node);
+    int ret = write(sq->serial_fd, qm->msg, qm->len);
+    if (ret < 0)
+        report_errno("retransmit write", ret);
+    sq->bytes_retransmit += qm->len;
+    sq->retransmit_seq = sq->receive_seq;
+    sq->rtt_sample_seq = 0;
+    if (eventtime > sq->idle_time)
+        sq->idle_time = eventtime;
+    sq->idle_time += qm->len * sq->baud_adjust;
+    return sq->idle_time + sq->rto;
+}
+
 // Callback timer for when a retransmit should be done
 static double
 retransmit_event(struct serialqueue *sq, double eventtime)
 {
+    pthread_mutex_lock(&sq->lock);
+    if (sq->ext_seq && sq->nak_retransmit) {
+        double waketime = selective_retransmit(sq, eventtime);
+        pthread_mutex_unlock(&sq->lock);
+        return waketime;
+    }
+    sq->nak_retransmit = 0;
+    pthread_mutex_unlock(&sq->lock);
+
     int ret = tcflush(sq->serial_fd, TCOFLUSH);
     if (ret < 0)
         report_errno("tcflush", ret);
@@ -560,7 +708,7 @@ retransmit_event(struct serialqueue *sq, double eventtime)
     pthread_mutex_lock(&sq->lock);
 
     // Retransmit all pending messages
-    uint8_t buf[MESSAGE_MAX * MESSAGE_SEQ_MASK + 1];
+    uint8_t buf[MESSAGE_MAX * MAX_EXT_WINDOW + 1];
     int buflen = 0;
     buf[buflen++] = MESSAGE_SYNC;
     struct queue_message *qm;
@@ -586,6 +734,26 @@ retransmit_event(struct serialqueue *sq, double eventtime)
     return waketime;
 }
 
+// Write a message along with its scheduling clocks to the output
+// file (used when recording a print artifact for later replay)
+static void
+record_message(struct serialqueue *sq, struct queue_message *qm)
+{
+    uint8_t buf[RECORD_HEADER_SIZE + MESSAGE_MAX];
+    int i;
+    for (i=0; i<8; i++) {
+        buf[i] = qm->min_clock >> (i*8);
+        buf[8+i] = qm->req_clock >> (i*8);
+    }
+    buf[16] = qm->len;
+    memcpy(&buf[RECORD_HEADER_SIZE], qm->msg, qm->len);
+    int len = RECORD_HEADER_SIZE + qm->len;
+    int ret = write(sq->serial_fd, buf, len);
+    if (ret < 0)
+        report_errno("write", ret);
+    sq->bytes_write += len;
+}
+
 // Construct a block of data and send to the serial port
 static void
 build_and_send_command(struct serialqueue *sq, double eventtime)
@@ -595,36 +763,46 @@ build_and_send_command(struct serialqueue *sq, double eventtime)
 
     while (sq->ready_bytes) {
         // Find highest priority message (message with lowest req_clock)
-        uint64_t min_clock = MAX_CLOCK;
-        struct command_queue *q, *cq = NULL;
-        struct queue_message *qm = NULL;
-        list_for_each_entry(q, &sq->pending_queues, node) {
-            if (!list_empty(&q->ready_queue)) {
-                struct queue_message *m = list_first_entry(
-                    &q->ready_queue, struct queue_message, node);
-                if (m->req_clock < min_clock) {
-                    min_clock = m->req_clock;
-                    cq = q;
-                    qm = m;
-                }
-            }
-        }
+        struct command_queue *cq = minheap_top(&sq->ready_heap)->data;
+        struct queue_message *qm = list_first_entry(
+            &cq->ready_queue, struct queue_message, node);
         // Append message to outgoing command
         if (out->len + qm->len > sizeof(out->msg) - MESSAGE_TRAILER_SIZE)
             break;
         list_del(&qm->node);
-        if (list_empty(&cq->ready_queue) && list_empty(&cq->stalled_queue))
-            list_del(&cq->node);
+        if (list_empty(&cq->ready_queue)) {
+            minheap_pop(&sq->ready_heap);
+            if (list_empty(&cq->stalled_queue))
+                list_del(&cq->node);
+        } else {
+            struct queue_message *m = list_first_entry(
+                &cq->ready_queue, struct queue_message, node);
+            minheap_replace_top(&sq->ready_heap, m->req_clock);
+        }
+        sq->ready_bytes -= qm->len;
+        if (sq->record) {
+            record_message(sq, qm);
+            message_free(qm);
+            continue;
+        }
         memcpy(&out->msg[out->len], qm->msg, qm->len);
         out->len += qm->len;
-        sq->ready_bytes -= qm->len;
         message_free(qm);
     }
+    if (sq->record) {
+        message_free(out);
+        return;
+    }
 
     // Fill header / trailer
     out->len += MESSAGE_TRAILER_SIZE;
     out->msg[MESSAGE_POS_LEN] = out->len;
-    out->msg[MESSAGE_POS_SEQ] = MESSAGE_DEST | (sq->send_seq & MESSAGE_SEQ_MASK);
+    if (sq->ext_seq)
+        out->msg[MESSAGE_POS_SEQ] = (MESSAGE_EXT_SEQ
+                                     | (sq->send_seq & MESSAGE_EXT_SEQ_MASK));
+    else
+        out->msg[MESSAGE_POS_SEQ] = (MESSAGE_DEST
+                                     | (sq->send_seq & MESSAGE_SEQ_MASK));
     uint16_t crc = crc16_ccitt(out->msg, out->len - MESSAGE_TRAILER_SIZE);
     out->msg[out->len - MESSAGE_TRAILER_CRC] = crc >> 8;
     out->msg[out->len - MESSAGE_TRAILER_CRC+1] = crc & 0xff;
@@ -656,41 +834,57 @@ check_send_command(struct serialqueue *sq, double eventtime)
     if (eventtime < sq->idle_time - MAX_SERIAL_BUFFER)
         // Serial port already busy
         return sq->idle_time - MAX_SERIAL_BUFFER;
-    if (sq->send_seq - sq->receive_seq >= MESSAGE_SEQ_MASK
-        && sq->receive_seq != (uint64_t)-1)
-        // Need an ack before more messages can be sent
-        return PR_NEVER;
+    if (sq->receive_seq != (uint64_t)-1) {
+        if (sq->send_seq - sq->receive_seq >= sq->window)
+            // Need an ack before more messages can be sent
+            return PR_NEVER;
+        if (sq->ext_window_pending) {
+            if (sq->send_seq != sq->receive_seq)
+                // Wait for all blocks to be acked before switching
+                return PR_NEVER;
+            sq->ext_seq = 1;
+            sq->window = sq->ext_window_pending;
+            sq->ext_window_pending = 0;
+        }
+    }
 
     // Check for stalled messages now ready
     double idletime = eventtime > sq->idle_time ? eventtime : sq->idle_time;
     idletime += MESSAGE_MIN * sq->baud_adjust;
     double timedelta = idletime - sq->last_ack_time;
     uint64_t ack_clock = (uint64_t)(timedelta * sq->est_clock) + sq->last_ack_clock;
-    uint64_t min_stalled_clock = MAX_CLOCK, min_ready_clock = MAX_CLOCK;
-    struct command_queue *cq;
-    list_for_each_entry(cq, &sq->pending_queues, node) {
+    struct minheap_item *top;
+    while ((top = minheap_top(&sq->stalled_heap)) && top->key <= ack_clock) {
         // Move messages from the stalled_queue to the ready_queue
+        struct command_queue *cq = top->data;
+        if (list_empty(&cq->ready_queue)) {
+            struct queue_message *qm = list_first_entry(
+                &cq->stalled_queue, struct queue_message, node);
+            minheap_push(&sq->ready_heap, qm->req_clock, cq->pending_order
+                         , cq);
+        }
         while (!list_empty(&cq->stalled_queue)) {
             struct queue_message *qm = list_first_entry(
                 &cq->stalled_queue, struct queue_message, node);
-            if (ack_clock < qm->min_clock) {
-                if (qm->min_clock < min_stalled_clock)
-                    min_stalled_clock = qm->min_clock;
+            if (ack_clock < qm->min_clock)
                 break;
-            }
             list_del(&qm->node);
             list_add_tail(&qm->node, &cq->ready_queue);
             sq->stalled_bytes -= qm->len;
             sq->ready_bytes += qm->len;
         }
-        // Update min_ready_clock
-        if (!list_empty(&cq->ready_queue)) {
+        if (list_empty(&cq->stalled_queue)) {
+            minheap_pop(&sq->stalled_heap);
+        } else {
             struct queue_message *qm = list_first_entry(
-                &cq->ready_queue, struct queue_message, node);
-            if (qm->req_clock < min_ready_clock)
-                min_ready_clock = qm->req_clock;
+                &cq->stalled_queue, struct queue_message, node);
+            minheap_replace_top(&sq->stalled_heap, qm->min_clock);
         }
     }
+    top = minheap_top(&sq->stalled_heap);
+    uint64_t min_stalled_clock = top ? top->key : MAX_CLOCK;
+    top = minheap_top(&sq->ready_heap);
+    uint64_t min_ready_clock = top ? top->key : MAX_CLOCK;
 
     // Check for messages to send
     if (sq->ready_bytes >= MESSAGE_PAYLOAD_MAX)
@@ -762,6 +956,7 @@ serialqueue_alloc(int serial_fd, int write_only)
 
     // Retransmit setup
     sq->send_seq = 1;
+    sq->window = MESSAGE_SEQ_MASK;
     if (write_only) {
         sq->receive_seq = -1;
         sq->rto = PR_NEVER;
@@ -773,6 +968,8 @@ serialqueue_alloc(int serial_fd, int write_only)
     // Queues
     sq->need_kick_clock = MAX_CLOCK;
     list_init(&sq->pending_queues);
+    minheap_init(&sq->ready_heap);
+    minheap_init(&sq->stalled_heap);
     list_init(&sq->sent_queue);
     list_init(&sq->receive_queue);
 
@@ -831,6 +1028,9 @@ serialqueue_free(struct serialqueue *sq)
         message_queue_free(&cq->ready_queue);
         message_queue_free(&cq->stalled_queue);
     }
+    minheap_free(&sq->ready_heap);
+    minheap_free(&sq->stalled_heap);
+    free(sq->responses);
     pthread_mutex_unlock(&sq->lock);
     pollreactor_free(&sq->pr);
     free(sq);
@@ -879,8 +1079,12 @@ serialqueue_send_batch(struct serialqueue *sq, struct command_queue *cq
 
     // Add list to cq->stalled_queue
     pthread_mutex_lock(&sq->lock);
-    if (list_empty(&cq->ready_queue) && list_empty(&cq->stalled_queue))
+    if (list_empty(&cq->ready_queue) && list_empty(&cq->stalled_queue)) {
         list_add_tail(&cq->node, &sq->pending_queues);
+        cq->pending_order = sq->pending_order++;
+    }
+    if (list_empty(&cq->stalled_queue))
+        minheap_push(&sq->stalled_heap, qm->min_clock, cq->pending_order, cq);
     list_join_tail(msgs, &cq->stalled_queue);
     sq->stalled_bytes += len;
     int mustwake = 0;
@@ -927,10 +1131,12 @@ serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
-void
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+// Return the messages read from the serial port (or wait for one if
+// none available).  Up to 'max' messages are copied to 'q' and the
+// number of messages copied is returned (or -1 on exit).
+int
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
 {
     pthread_mutex_lock(&sq->lock);
     // Wait for message to be available
@@ -943,23 +1149,47 @@ serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
             report_errno("pthread_cond_wait", ret);
     }
 
-    // Remove message from queue
-    struct queue_message *qm = list_first_entry(
-        &sq->receive_queue, struct queue_message, node);
-    list_del(&qm->node);
+    // Remove messages from queue
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue)) {
+        struct queue_message *qm = list_first_entry(
+            &sq->receive_queue, struct queue_message, node);
+        list_del(&qm->node);
 
-    // Copy message
-    memcpy(pqm->msg, qm->msg, qm->len);
-    pqm->len = qm->len;
-    pqm->sent_time = qm->sent_time;
-    pqm->receive_time = qm->receive_time;
-    debug_queue_add(&sq->old_receive, qm);
+        // Copy message
+        struct pull_queue_message *pqm = &q[count++];
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        debug_queue_add(&sq->old_receive, qm);
+    }
 
     pthread_mutex_unlock(&sq->lock);
-    return;
+    return count;
 
 exit:
-    pqm->len = -1;
+    pthread_mutex_unlock(&sq->lock);
+    return -1;
+}
+
+// Return a message read from the serial port (or wait for one if none
+// available)
+void
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    if (serialqueue_pull_batch(sq, pqm, 1) < 0)
+        pqm->len = -1;
+}
+
+// Write queued messages (and their scheduling clocks) to the output
+// file instead of encoding them into blocks - only valid for a
+// write_only serialqueue.
+void
+serialqueue_set_record(struct serialqueue *sq, int record)
+{
+    pthread_mutex_lock(&sq->lock);
+    sq->record = record;
     pthread_mutex_unlock(&sq->lock);
 }
 
@@ -971,6 +1201,20 @@ serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust)
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Switch to the "extended sequence" mode of the serial protocol once
+// all blocks sent so far are acked.  This permits 'window' unacked
+// blocks and the retransmission of only a lost block.
+void
+serialqueue_set_ext_window(struct serialqueue *sq, int window)
+{
+    if (window > MAX_EXT_WINDOW)
+        window = MAX_EXT_WINDOW;
+    pthread_mutex_lock(&sq->lock);
+    sq->ext_window_pending = window;
+    pthread_mutex_unlock(&sq->lock);
+    kick_bg_thread(sq);
+}
+
 // Set the estimated clock rate of the mcu on the other end of the
 // serial port
 void
@@ -984,6 +1228,67 @@ serialqueue_set_clock_est(struct serialqueue *sq, double est_clock
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Decode the given response natively.  Once a response format is
+// set, received messages are only passed to serialqueue_pull() if
+// they are unknown, invalid, or have a handler (see
+// serialqueue_set_response_handler).  The 'types' are RP_xxx values
+// and 'oid_param' is the index of the oid parameter (or -1).
+void
+serialqueue_set_response_format(struct serialqueue *sq, int msgid
+                                , uint8_t *types, int num_types
+                                , int oid_param)
+{
+    if (msgid < 0 || msgid > 255 || num_types > RESPONSE_MAX_PARAMS)
+        return;
+    pthread_mutex_lock(&sq->lock);
+    if (msgid >= sq->num_responses) {
+        int num = msgid + 1;
+        sq->responses = realloc(sq->responses, num * sizeof(*sq->responses));
+        memset(&sq->responses[sq->num_responses], 0
+               , (num - sq->num_responses) * sizeof(*sq->responses));
+        sq->num_responses = num;
+    }
+    struct response_format *rf = &sq->responses[msgid];
+    memset(rf, 0, sizeof(*rf));
+    rf->is_set = 1;
+    rf->num_params = num_types;
+    memcpy(rf->types, types, num_types);
+    rf->oid_param = oid_param < 0 ? RESPONSE_NO_OID : oid_param;
+    pthread_mutex_unlock(&sq->lock);
+}
+
+// Note if python has a handler for a natively decoded response (with
+// the given oid, or -1 for responses without an oid)
+void
+serialqueue_set_response_handler(struct serialqueue *sq, int msgid, int oid
+                                 , int enable)
+{
+    pthread_mutex_lock(&sq->lock);
+    if (msgid >= 0 && msgid < sq->num_responses) {
+        struct response_format *rf = &sq->responses[msgid];
+        if (oid < 0) {
+            rf->want_no_oid = !!enable;
+        } else if (oid < 256) {
+            uint32_t bit = 1 << (oid % 32);
+            if (enable)
+                rf->want_oids[oid / 32] |= bit;
+            else
+                rf->want_oids[oid / 32] &= ~bit;
+        }
+    }
+    pthread_mutex_unlock(&sq->lock);
+}
+
+// Return the number of bytes ready to be transmitted
+int
+serialqueue_get_ready_bytes(struct serialqueue *sq)
+{
+    pthread_mutex_lock(&sq->lock);
+    int ready_bytes = sq->ready_bytes;
+    pthread_mutex_unlock(&sq->lock);
+    return ready_bytes;
+}
+
 // Return a string buffer containing statistics for the serial port
 void
 serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
@@ -996,14 +1301,15 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
     snprintf(buf, len, "bytes_write=%u bytes_read=%u"
              " bytes_retransmit=%u bytes_invalid=%u"
              " send_seq=%u receive_seq=%u retransmit_seq=%u"
-             " srtt=%.3f rttvar=%.3f rto=%.3f"
-             " ready_bytes=%u stalled_bytes=%u"
+             " srtt=%.3f rttvar=%.3f rto=%.3f window=%d"
+             " ready_bytes=%u stalled_bytes=%u receive_filtered=%u"
              , stats.bytes_write, stats.bytes_read
              , stats.bytes_retransmit, stats.bytes_invalid
              , (int)stats.send_seq, (int)stats.receive_seq
              , (int)stats.retransmit_seq
-             , stats.srtt, stats.rttvar, stats.rto
-             , stats.ready_bytes, stats.stalled_bytes);
+             , stats.srtt, stats.rttvar, stats.rto, stats.window
+             , stats.ready_bytes, stats.stalled_bytes
+             , stats.receive_filtered);
 }
 
 // Extract old messages stored in the debug queues
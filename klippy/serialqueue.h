@@ -17,6 +17,8 @@
 #define MESSAGE_SEQ_MASK 0x0f
 #define MESSAGE_DEST 0x10
 #define MESSAGE_SYNC 0x7E
+#define MESSAGE_EXT_SEQ 0x80
+#define MESSAGE_EXT_SEQ_MASK 0x7f
 
 struct queue_message {
     int len;
@@ -58,9 +60,19 @@ void serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *c
                                  , uint32_t *data, int len
                                  , uint64_t min_clock, uint64_t req_clock);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
+int serialqueue_pull_batch(struct serialqueue *sq
+                           , struct pull_queue_message *q, int max);
+void serialqueue_set_record(struct serialqueue *sq, int record);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
+void serialqueue_set_ext_window(struct serialqueue *sq, int window);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_clock
                                , double last_ack_time, uint64_t last_ack_clock);
+void serialqueue_set_response_format(struct serialqueue *sq, int msgid
+                                     , uint8_t *types, int num_types
+                                     , int oid_param);
+void serialqueue_set_response_handler(struct serialqueue *sq, int msgid
+                                      , int oid, int enable);
+int serialqueue_get_ready_bytes(struct serialqueue *sq);
 void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
 int serialqueue_extract_old(struct serialqueue *sq, int sentq
                             , struct pull_queue_message *q, int max);
@@ -0,0 +1,770 @@
+#!/usr/bin/env python2
+# Benchmark and quality checks for the step compression code
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, json, random, tempfile, copy, hashlib
+import chelper, msgproto, mcu, toolhead, extruder
+
+MOVE_COUNT = 16
+MOVE_FLUSH_TIME = 0.050
+START_PRINT_TIME = 0.250
+SYNC_MOVE_TIME = 0.050
+PROFILES = ['cartesian', 'corexy', 'delta', 'extruder', 'long']
+
+
+######################################################################
+# Stand-ins for the printer objects used by the step generation code
+######################################################################
+
+# Micro-controller that only supports what MCU_stepper needs
+class BenchMCU:
+    def __init__(self, msgparser, max_stepper_error, cubic):
+        self._msgparser = msgparser
+        self._mcu_freq = msgparser.get_constant_float('CLOCK_FREQ')
+        self._max_stepper_error = max_stepper_error
+        self._cubic = cubic
+        self._oids = []
+        self._steppersync = None
+        self._ffi_lib = chelper.get_ffi()[1]
+    def create_oid(self, oid):
+        self._oids.append(oid)
+        return len(self._oids) - 1
+    def register_stepper(self, stepper):
+        pass
+    def add_config_cmd(self, cmd):
+        pass
+    def lookup_command(self, msgformat):
+        return self._msgparser.lookup_command(msgformat)
+    def get_mcu_freq(self):
+        return self._mcu_freq
+    def get_max_stepper_error(self):
+        return self._max_stepper_error
+    def get_cubic_step_compression(self):
+        return self._cubic
+    def print_to_mcu_time(self, print_time):
+        return print_time
+    def set_steppersync(self, steppersync):
+        self._steppersync = steppersync
+    def push_moves(self, kin_type, kin_stepqueues, ext_stepqueue,
+                   commanded_pos, moves, move_count, print_time,
+                   move_flush_time):
+        ret = self._ffi_lib.steppersync_push_moves(
+            self._steppersync, kin_type, kin_stepqueues, ext_stepqueue,
+            commanded_pos, moves, move_count, print_time, 0.,
+            move_flush_time, self._mcu_freq)
+        if ret:
+            raise mcu.error("Internal error in stepcompress")
+
+class BenchStepper:
+    def __init__(self, bmcu, name, step_dist):
+        self.name = name
+        self.step_dist = step_dist
+        self.mcu_stepper = mcu.MCU_stepper(bmcu, "PA0", "PA1")
+        self.mcu_stepper.set_step_distance(step_dist)
+
+# Step generation with a call per move phase (as done before the
+# step_trapezoid() and step_delta_trapezoid() calls)
+def phase_move(mcu_stepper, move_time, start_pos, axis_d, move):
+    axis_r = abs(axis_d) / move.move_d
+    accel = move.accel * axis_r
+    cruise_v = move.cruise_v * axis_r
+    if move.accel_r:
+        accel_d = move.accel_r * axis_d
+        mcu_stepper.step_const(
+            move_time, start_pos, accel_d, move.start_v * axis_r, accel)
+        start_pos += accel_d
+        move_time += move.accel_t
+    if move.cruise_r:
+        cruise_d = move.cruise_r * axis_d
+        mcu_stepper.step_const(move_time, start_pos, cruise_d, cruise_v, 0.)
+        start_pos += cruise_d
+        move_time += move.cruise_t
+    if move.decel_r:
+        decel_d = move.decel_r * axis_d
+        mcu_stepper.step_const(move_time, start_pos, decel_d, cruise_v, -accel)
+
+def delta_phase_move(mcu_stepper, move_time, move, vt_startz, vt_startxy_d,
+                     vt_arm_d, movez_r, movexy_r):
+    move_d = move.move_d
+    accel_d = move.accel_r * move_d
+    cruise_d = move.cruise_r * move_d
+    decel_d = move.decel_r * move_d
+    if accel_d:
+        mcu_stepper.step_delta(
+            move_time, accel_d, move.start_v, move.accel,
+            vt_startz, vt_startxy_d, vt_arm_d, movez_r)
+        vt_startz += accel_d * movez_r
+        vt_startxy_d -= accel_d * movexy_r
+        move_time += move.accel_t
+    if cruise_d:
+        mcu_stepper.step_delta(
+            move_time, cruise_d, move.cruise_v, 0.,
+            vt_startz, vt_startxy_d, vt_arm_d, movez_r)
+        vt_startz += cruise_d * movez_r
+        vt_startxy_d -= cruise_d * movexy_r
+        move_time += move.cruise_t
+    if decel_d:
+        mcu_stepper.step_delta(
+            move_time, decel_d, move.cruise_v, -move.accel,
+            vt_startz, vt_startxy_d, vt_arm_d, movez_r)
+
+class CartesianKinematics:
+    per_phase = False
+    def __init__(self, bmcu, step_dists):
+        self.steppers = [BenchStepper(bmcu, n, sd)
+                         for n, sd in zip('xyz', step_dists)]
+    def get_steppers(self):
+        return self.steppers
+    def get_move_block(self):
+        return 'cartesian', [s.mcu_stepper for s in self.steppers]
+    def set_position(self, pos):
+        for i, s in enumerate(self.steppers):
+            s.mcu_stepper.set_position(pos[i])
+    def move(self, move_time, move):
+        for i, s in enumerate(self.steppers):
+            axis_d = move.axes_d[i]
+            if not axis_d:
+                continue
+            if self.per_phase:
+                phase_move(s.mcu_stepper, move_time, move.start_pos[i],
+                           axis_d, move)
+                continue
+            axis_r = abs(axis_d) / move.move_d
+            cruise_v = move.cruise_v * axis_r
+            s.mcu_stepper.step_trapezoid(
+                move_time, move.start_pos[i],
+                move.accel_r * axis_d, move.cruise_r * axis_d,
+                move.decel_r * axis_d, move.accel_t, move.cruise_t,
+                move.start_v * axis_r, cruise_v, cruise_v,
+                move.accel * axis_r)
+
+class CoreXYKinematics(CartesianKinematics):
+    def __init__(self, bmcu, step_dists):
+        self.steppers = [BenchStepper(bmcu, n, sd)
+                         for n, sd in zip('abz', step_dists)]
+    def get_move_block(self):
+        return 'corexy', [s.mcu_stepper for s in self.steppers]
+    def set_position(self, pos):
+        for s, p in zip(self.steppers, (pos[0] + pos[1], pos[0] - pos[1],
+                                        pos[2])):
+            s.mcu_stepper.set_position(p)
+    def move(self, move_time, move):
+        sxp, syp, szp = move.start_pos[:3]
+        dx, dy, dz = move.axes_d[:3]
+        for i, start_pos, axis_d in ((0, sxp + syp, dx + dy),
+                                     (1, sxp - syp, dx - dy),
+                                     (2, szp, dz)):
+            if not axis_d:
+                continue
+            mcu_stepper = self.steppers[i].mcu_stepper
+            if self.per_phase:
+                phase_move(mcu_stepper, move_time, start_pos, axis_d, move)
+                continue
+            axis_r = abs(axis_d) / move.move_d
+            cruise_v = move.cruise_v * axis_r
+            mcu_stepper.step_trapezoid(
+                move_time, start_pos,
+                move.accel_r * axis_d, move.cruise_r * axis_d,
+                move.decel_r * axis_d, move.accel_t, move.cruise_t,
+                move.start_v * axis_r, cruise_v, cruise_v,
+                move.accel * axis_r)
+
+class DeltaKinematics:
+    per_phase = False
+    def __init__(self, bmcu, step_dist, radius, arm_length, delta_approx):
+        self.steppers = [BenchStepper(bmcu, n, step_dist) for n in 'abc']
+        for s in self.steppers:
+            s.mcu_stepper.set_delta_approximation(delta_approx)
+        self.arm_length2 = arm_length**2
+        self.towers = [(math.cos(math.radians(a)) * radius,
+                        math.sin(math.radians(a)) * radius)
+                       for a in (210., 330., 90.)]
+    def get_steppers(self):
+        return self.steppers
+    def set_position(self, pos):
+        for s, t in zip(self.steppers, self.towers):
+            s.mcu_stepper.set_position(math.sqrt(
+                self.arm_length2 - (t[0] - pos[0])**2 - (t[1] - pos[1])**2)
+                                       + pos[2])
+    def move(self, move_time, move):
+        # Same step generation as delta.py
+        axes_d = move.axes_d
+        move_d = move.move_d
+        movexy_r = 1.
+        movez_r = 0.
+        inv_movexy_d = 1. / move_d
+        if not axes_d[0] and not axes_d[1]:
+            movez_r = axes_d[2] * inv_movexy_d
+            movexy_r = inv_movexy_d = 0.
+        elif axes_d[2]:
+            movexy_d = math.sqrt(axes_d[0]**2 + axes_d[1]**2)
+            movexy_r = movexy_d * inv_movexy_d
+            movez_r = axes_d[2] * inv_movexy_d
+            inv_movexy_d = 1. / movexy_d
+        origx, origy, origz = move.start_pos[:3]
+        for s, tower in zip(self.steppers, self.towers):
+            towerx_d = tower[0] - origx
+            towery_d = tower[1] - origy
+            vt_startxy_d = (towerx_d*axes_d[0] + towery_d*axes_d[1])*inv_movexy_d
+            tangentxy_d2 = towerx_d**2 + towery_d**2 - vt_startxy_d**2
+            vt_arm_d = math.sqrt(self.arm_length2 - tangentxy_d2)
+            if self.per_phase:
+                delta_phase_move(s.mcu_stepper, move_time, move, origz,
+                                 vt_startxy_d, vt_arm_d, movez_r, movexy_r)
+                continue
+            s.mcu_stepper.step_delta_trapezoid(
+                move_time, move.accel_r * move_d, move.cruise_r * move_d,
+                move.decel_r * move_d, move.accel_t, move.cruise_t,
+                move.start_v, move.cruise_v, move.accel,
+                origz, vt_startxy_d, vt_arm_d, movez_r, movexy_r)
+
+# Extruder using the pressure advance code of extruder.py
+class BenchExtruder(extruder.PrinterExtruder):
+    def __init__(self, bmcu, step_dist, pressure_advance, lookahead_time):
+        self.stepper = BenchStepper(bmcu, 'e', step_dist)
+        self.pressure_advance = pressure_advance
+        self.pressure_advance_lookahead_time = lookahead_time
+        self.need_motor_enable = False
+        self.extrude_pos = 0.
+
+class BenchToolhead:
+    def __init__(self, kin, extruder, steppersync, max_accel, mcu_freq,
+                 move_block=None):
+        self.kin = kin
+        self.extruder = extruder
+        self.steppersync = steppersync
+        self.max_accel = max_accel
+        self.max_accel_to_decel = max_accel * .5
+        self.junction_deviation = 0.02
+        self.mcu_freq = mcu_freq
+        self.ffi_lib = chelper.get_ffi()[1]
+        self.move_queue = toolhead.MoveQueue(
+            extruder.lookahead, self._generate_moves)
+        self.move_block = move_block
+        self.print_time = START_PRINT_TIME
+        self.flush_time = self.move_time = 0.
+    def _generate_moves(self, moves):
+        if self.move_block is not None:
+            # Same as ToolHead._generate_move_block()
+            start_time = time.time()
+            data = toolhead.get_move_block_data(moves, self.extruder)
+            self.print_time = self.move_block.generate(
+                data, len(moves), self.print_time, MOVE_FLUSH_TIME)
+            self.move_time += time.time() - start_time
+            self.flush_moves(self.print_time - MOVE_FLUSH_TIME)
+            return
+        for move in moves:
+            start_time = time.time()
+            move.move()
+            self.move_time += time.time() - start_time
+    def get_next_move_time(self):
+        return self.print_time
+    def update_move_time(self, movetime):
+        self.print_time += movetime
+        self.flush_moves(self.print_time - MOVE_FLUSH_TIME)
+    def flush_moves(self, print_time):
+        clock = int(print_time * self.mcu_freq)
+        start_time = time.time()
+        ret = self.ffi_lib.steppersync_flush(self.steppersync, clock)
+        self.flush_time += time.time() - start_time
+        if ret:
+            raise mcu.error("Internal error in stepcompress")
+    def run(self, path):
+        pos = path[0][0]
+        for end_pos, speed in path[1:]:
+            move = toolhead.Move(self, pos, end_pos, speed)
+            if not move.move_d:
+                continue
+            move.extrude_r = move.axes_d[3] / move.move_d
+            move.extrude_max_corner_v = 0.
+            self.move_queue.add_move(move)
+            pos = end_pos
+        self.move_queue.flush()
+        self.flush_moves(self.print_time + MOVE_FLUSH_TIME)
+
+
+######################################################################
+# Move profiles
+######################################################################
+
+# A path is a list of ((x, y, z, e), speed) points.  The speed of the
+# first point is ignored.
+
+# Perimeters made of short segments followed by a zig-zag infill
+def print_path(rand, layers, center=(100., 100.), size=40., z=0.):
+    path = [((center[0], center[1], z, 0.), 0.)]
+    e = 0.
+    for layer in range(layers):
+        z += .2
+        for radius in (size * .5, size * .5 - .4, size * .25):
+            segments = int(2. * math.pi * radius / rand.uniform(.3, 1.))
+            for i in range(segments + 1):
+                a = 2. * math.pi * i / segments
+                x = center[0] + radius * math.cos(a)
+                y = center[1] + radius * math.sin(a)
+                prev = path[-1][0]
+                if i:
+                    e += math.sqrt((x-prev[0])**2 + (y-prev[1])**2) * .04
+                path.append(((x, y, z, e), i and 50. or 150.))
+        half = size * .3
+        y = center[1] - half
+        side = 1.
+        while y < center[1] + half:
+            x = center[0] + side * half
+            e += 2. * half * .04
+            path.append(((x, y, z, e), 100.))
+            y += .45
+            path.append(((x, y, z, e), 100.))
+            side = -side
+    return path
+
+# Circles and chords near the edge of a delta build area
+def delta_edge_path(rand, radius, loops):
+    path = [((0., 0., 10., 0.), 0.)]
+    for loop in range(loops):
+        r = radius * rand.uniform(.9, 1.)
+        segments = 180
+        for i in range(segments + 1):
+            a = 2. * math.pi * i / segments
+            path.append(((r * math.cos(a), r * math.sin(a), 10., 0.), 150.))
+        a = rand.uniform(0., 2. * math.pi)
+        path.append(((r * math.cos(a), r * math.sin(a), 10., 0.), 200.))
+        path.append(((-r * math.cos(a), -r * math.sin(a), 10., 0.), 200.))
+    return path
+
+# Long fast moves back and forth across the bed
+def long_path(rand, loops, length=300., speed=300.):
+    path = [((0., 0., 0., 0.), 0.)]
+    for loop in range(loops):
+        y = rand.uniform(0., length)
+        path.append(((length, y, 0., 0.), speed))
+        path.append(((0., length - y, 0., 0.), speed))
+    return path
+
+# Read the G0/G1 moves of a recorded gcode file
+def gcode_path(filename):
+    pos = [0., 0., 0., 0.]
+    offsets = [0., 0., 0., 0.]
+    speed = 25.
+    absolute_coord = absolute_extrude = True
+    path = [(tuple(pos), speed)]
+    for line in open(filename, 'rb'):
+        parts = line.split(';', 1)[0].upper().split()
+        if not parts:
+            continue
+        cmd = parts[0]
+        params = {}
+        for p in parts[1:]:
+            try:
+                params[p[0]] = float(p[1:])
+            except ValueError:
+                pass
+        if cmd == 'G90':
+            absolute_coord = absolute_extrude = True
+        elif cmd == 'G91':
+            absolute_coord = absolute_extrude = False
+        elif cmd == 'M82':
+            absolute_extrude = True
+        elif cmd == 'M83':
+            absolute_extrude = False
+        elif cmd == 'G92':
+            for i, a in enumerate('XYZE'):
+                if a in params:
+                    offsets[i] = pos[i] - params[a]
+        elif cmd in ('G0', 'G1'):
+            for i, a in enumerate('XYZE'):
+                if a not in params:
+                    continue
+                absolute = absolute_extrude if a == 'E' else absolute_coord
+                if absolute:
+                    pos[i] = params[a] + offsets[i]
+                else:
+                    pos[i] += params[a]
+            if 'F' in params and params['F'] > 0.:
+                speed = params['F'] / 60.
+            path.append((tuple(pos), speed))
+    return path
+
+
+######################################################################
+# Benchmark runner
+######################################################################
+
+# Wait for all queued messages to be written and free the serialqueue
+def close_serialqueue(sq):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    stats_buf = ffi_main.new('char[4096]')
+    while 1:
+        ffi_lib.serialqueue_get_stats(sq, stats_buf, len(stats_buf))
+        stats = dict(p.split('=', 1)
+                     for p in ffi_main.string(stats_buf).split())
+        if stats['ready_bytes'] == stats['stalled_bytes'] == '0':
+            break
+        time.sleep(.001)
+    ffi_lib.serialqueue_exit(sq)
+    ffi_lib.serialqueue_free(sq)
+
+# Digest of the commands in the message blocks of 'data' (the packing
+# of the commands into blocks depends on the serialqueue thread timing)
+def command_digest(msgparser, data):
+    digest = hashlib.md5()
+    while data:
+        l = msgparser.check_packet(data)
+        if l <= 0:
+            raise msgproto.error("Invalid message block in output")
+        digest.update(data[msgproto.MESSAGE_HEADER_SIZE
+                           :l-msgproto.MESSAGE_TRAILER_SIZE])
+        data = data[l:]
+    return digest.hexdigest()
+
+# Build the kinematics (and extruder) of a profile
+def build_profile(profile, bmcu, options):
+    pressure_advance = 0.
+    if profile == 'cartesian':
+        kin = CartesianKinematics(bmcu, (.0125, .0125, .0025))
+    elif profile == 'corexy':
+        kin = CoreXYKinematics(bmcu, (.0125, .0125, .0025))
+    elif profile == 'delta':
+        kin = DeltaKinematics(bmcu, .01, 174.75, 333., options.delta_approx)
+    elif profile == 'long':
+        # 1/256 microstepping
+        kin = CartesianKinematics(bmcu, (.00078125, .00078125, .0025))
+    else:
+        kin = CartesianKinematics(bmcu, (.0125, .0125, .0025))
+        pressure_advance = options.pressure_advance
+    kin.per_phase = options.per_phase
+    ext = extruder.DummyExtruder()
+    if profile in ('cartesian', 'corexy', 'extruder') or options.gcode:
+        ext = BenchExtruder(bmcu, .0022, pressure_advance, 0.010)
+    return kin, ext
+
+def build_path(profile, options):
+    if options.gcode:
+        return gcode_path(options.gcode)
+    rand = random.Random(options.seed)
+    if profile == 'delta':
+        return delta_edge_path(rand, 140., options.layers)
+    if profile == 'long':
+        return long_path(rand, options.layers)
+    return print_path(rand, options.layers)
+
+def run_profile(profile, msgparser, options):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    bmcu = BenchMCU(msgparser, options.max_error, options.cubic)
+    kin, ext = build_profile(profile, bmcu, options)
+    path = build_path(profile, options)
+    steppers = list(kin.get_steppers())
+    if isinstance(ext, BenchExtruder):
+        steppers.append(ext.stepper)
+    for s in steppers:
+        s.mcu_stepper.build_config()
+    kin.set_position(path[0][0])
+    steptrace = None
+    if options.step_trace:
+        steptrace = ffi_lib.steptrace_alloc(options.step_trace,
+                                            bmcu.get_mcu_freq())
+        if steptrace == ffi_main.NULL:
+            raise mcu.error("Unable to open step trace file")
+        for s in steppers:
+            ffi_lib.stepcompress_set_trace(s.mcu_stepper._stepqueue, steptrace)
+    # Send the generated commands through a serialqueue to a file
+    outfile = tempfile.TemporaryFile()
+    sq = ffi_lib.serialqueue_alloc(outfile.fileno(), 1)
+    ffi_lib.serialqueue_set_clock_est(sq, 1000000000000., 0., 0)
+    stepqueues = tuple(s.mcu_stepper._stepqueue for s in steppers)
+    ss = ffi_lib.steppersync_alloc(sq, stepqueues, len(stepqueues), MOVE_COUNT)
+    bmcu.set_steppersync(ss)
+    move_block = None
+    if options.block and hasattr(kin, 'get_move_block'):
+        kin_type, kin_steppers = kin.get_move_block()
+        ext_stepper = None
+        if isinstance(ext, BenchExtruder):
+            ext_stepper = ext.stepper.mcu_stepper
+        move_block = mcu.MCU_move_block(bmcu, kin_type, kin_steppers,
+                                        ext_stepper)
+    th = BenchToolhead(kin, ext, ss, options.accel, bmcu.get_mcu_freq(),
+                       move_block)
+    start_cpu = time.clock()
+    th.run(path)
+    cpu_time = time.clock() - start_cpu
+    close_serialqueue(sq)
+    ffi_lib.steppersync_free(ss)
+    if steptrace is not None:
+        for s in steppers:
+            ffi_lib.stepcompress_set_trace(s.mcu_stepper._stepqueue,
+                                           ffi_main.NULL)
+        ffi_lib.steptrace_free(steptrace)
+    outfile.seek(0)
+    wire_data = outfile.read()
+    outfile.close()
+    # Gather the compression statistics
+    stats = ffi_main.new('struct stepcompress_stats *')
+    mcu_freq = bmcu.get_mcu_freq()
+    totals = {'steps': 0, 'queue_step': 0, 'queue_step_cubic': 0,
+              'msg_bytes': 0, 'error_sum': 0, 'error_max': 0,
+              'dir_changes': 0, 'delta_error_max': 0.}
+    result = {'profile': profile, 'cubic': options.cubic,
+              'block': move_block is not None,
+              'delta_approx': options.delta_approx,
+              'max_error_us': options.max_error * 1000000., 'steppers': {}}
+    for s in steppers:
+        ffi_lib.stepcompress_get_stats(s.mcu_stepper._stepqueue, stats)
+        sres = {'steps': stats.step_count,
+                'queue_step': stats.queue_step_count,
+                'queue_step_cubic': stats.queue_step_cubic_count,
+                'msg_bytes': stats.msg_bytes, 'error_sum': stats.error_sum,
+                'error_max': stats.error_max,
+                'dir_changes': stats.dir_changes,
+                'delta_error_max': stats.delta_error_max}
+        for name, value in sres.items():
+            if name in ('error_max', 'delta_error_max'):
+                totals[name] = max(totals[name], value)
+            else:
+                totals[name] += value
+        result['steppers'][s.name] = summarize(sres, mcu_freq)
+    result.update(summarize(totals, mcu_freq))
+    steps = max(totals['steps'], 1)
+    result['moves'] = len(path) - 1
+    result['wire_bytes'] = len(wire_data)
+    result['wire_bytes_per_1000_steps'] = round(
+        len(wire_data) * 1000. / steps, 3)
+    result['commands_md5'] = command_digest(msgparser, wire_data)
+    result['cpu_ns_per_step'] = round(cpu_time * 1000000000. / steps, 1)
+    result['flush_ns_per_step'] = round(
+        th.flush_time * 1000000000. / steps, 1)
+    result['move_ns_per_step'] = round(th.move_time * 1000000000. / steps, 1)
+    result['moves_per_sec'] = round(result['moves'] / max(th.move_time, .001))
+    return result
+
+# Compare the approximated delta step generation with the exact one
+def compare_delta(msgparser, options):
+    results = {}
+    for delta_approx in (0, 1, 2):
+        opts = copy.copy(options)
+        opts.delta_approx = delta_approx
+        results[delta_approx] = run_profile('delta', msgparser, opts)
+    exact, approx, check = results[0], results[1], results[2]
+    if exact['steps'] != approx['steps']:
+        raise mcu.error("Step count mismatch (%d vs %d)" % (
+            exact['steps'], approx['steps']))
+    return {
+        'profile': 'delta-compare', 'steps': exact['steps'],
+        'exact_queue_step': exact['queue_step'],
+        'approx_queue_step': approx['queue_step'],
+        'exact_move_ns_per_step': exact['move_ns_per_step'],
+        'approx_move_ns_per_step': approx['move_ns_per_step'],
+        'exact_cpu_ns_per_step': exact['cpu_ns_per_step'],
+        'approx_cpu_ns_per_step': approx['cpu_ns_per_step'],
+        'approx_error_max_us': check['delta_error_max_us']}
+
+# Check that generating the steps of a block of moves in a single C
+# call sends exactly the same commands as generating them per move
+def compare_block(profile, msgparser, options):
+    results = {}
+    for block in (False, True):
+        opts = copy.copy(options)
+        opts.block = block
+        results[block] = run_profile(profile, msgparser, opts)
+    move, block = results[False], results[True]
+    if not block['block']:
+        raise mcu.error("Block generation not supported")
+    if move['commands_md5'] != block['commands_md5']:
+        raise mcu.error("Block generation sent different commands")
+    return {
+        'profile': profile + '-block-compare', 'steps': move['steps'],
+        'queue_step': move['queue_step'],
+        'move_cpu_ns_per_step': move['cpu_ns_per_step'],
+        'block_cpu_ns_per_step': block['cpu_ns_per_step']}
+
+# Compare the speed of generating the steps of each move phase with a
+# separate call and of generating all phases with a single call
+def compare_phases(profile, msgparser, options):
+    results = {}
+    for per_phase in (True, False):
+        opts = copy.copy(options)
+        opts.per_phase = per_phase
+        opts.block = False
+        results[per_phase] = run_profile(profile, msgparser, opts)
+    phase, trapezoid = results[True], results[False]
+    return {
+        'profile': profile + '-phase-compare', 'moves': phase['moves'],
+        'phase_steps': phase['steps'], 'trapezoid_steps': trapezoid['steps'],
+        'phase_moves_per_sec': phase['moves_per_sec'],
+        'trapezoid_moves_per_sec': trapezoid['moves_per_sec']}
+
+# Merge the step commands of 'count' steppers that each make a short
+# back and forth move every SYNC_MOVE_TIME
+def run_sync_scaling(count, msgparser, options):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    bmcu = BenchMCU(msgparser, options.max_error, options.cubic)
+    steppers = [BenchStepper(bmcu, "s%d" % (i,), .0125) for i in range(count)]
+    for s in steppers:
+        s.mcu_stepper.build_config()
+    outfile = tempfile.TemporaryFile()
+    sq = ffi_lib.serialqueue_alloc(outfile.fileno(), 1)
+    ffi_lib.serialqueue_set_clock_est(sq, 1000000000000., 0., 0)
+    stepqueues = tuple(s.mcu_stepper._stepqueue for s in steppers)
+    ss = ffi_lib.steppersync_alloc(sq, stepqueues, len(stepqueues), MOVE_COUNT)
+    mcu_freq = bmcu.get_mcu_freq()
+    rand = random.Random(options.seed)
+    print_time = START_PRINT_TIME
+    flush_time = [0.]
+    def flush(print_time):
+        start_time = time.time()
+        ret = ffi_lib.steppersync_flush(ss, int(print_time * mcu_freq))
+        flush_time[0] += time.time() - start_time
+        if ret:
+            raise mcu.error("Internal error in stepcompress")
+    for i in range(options.layers * 10):
+        for s in steppers:
+            half_t = rand.uniform(.005, SYNC_MOVE_TIME * .5)
+            accel = rand.uniform(500., options.accel)
+            dist = .5 * accel * half_t**2
+            if i & 1:
+                dist = -dist
+            pos = s.mcu_stepper.get_commanded_position()
+            s.mcu_stepper.step_const(print_time, pos, dist, 0., accel)
+            s.mcu_stepper.step_const(print_time + half_t, pos + dist, dist,
+                                     accel * half_t, -accel)
+        print_time += SYNC_MOVE_TIME
+        flush(print_time - MOVE_FLUSH_TIME)
+    flush(print_time + MOVE_FLUSH_TIME)
+    close_serialqueue(sq)
+    ffi_lib.steppersync_free(ss)
+    outfile.close()
+    stats = ffi_main.new('struct stepcompress_stats *')
+    msgs = steps = 0
+    for s in steppers:
+        ffi_lib.stepcompress_get_stats(s.mcu_stepper._stepqueue, stats)
+        msgs += stats.queue_step_count + stats.queue_step_cubic_count
+        steps += stats.step_count
+    return {'sync_steppers': count, 'steps': steps, 'queue_step': msgs,
+            'flush_ns_per_msg': round(
+                flush_time[0] * 1000000000. / max(msgs, 1), 1)}
+
+def summarize(s, mcu_freq):
+    steps = max(s['steps'], 1)
+    cmds = s['queue_step'] + s['queue_step_cubic']
+    return {
+        'steps': s['steps'], 'queue_step': s['queue_step'],
+        'queue_step_cubic': s['queue_step_cubic'],
+        'cmds_per_1000_steps': round(cmds * 1000. / steps, 3),
+        'msg_bytes': s['msg_bytes'], 'dir_changes': s['dir_changes'],
+        'error_max_us': round(s['error_max'] * 1000000. / mcu_freq, 3),
+        'error_mean_us': round(
+            s['error_sum'] * 1000000. / (mcu_freq * steps), 3),
+        'delta_error_max_us': round(
+            s['delta_error_max'] * 1000000. / mcu_freq, 3)}
+
+def main():
+    usage = "%prog [options] <dictionary file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-p", "--profiles", type="string", dest="profiles",
+                    default=",".join(PROFILES[:4]),
+                    help="comma separated list of move profiles")
+    opts.add_option("-g", "--gcode", type="string", dest="gcode",
+                    help="use the moves of a recorded gcode file")
+    opts.add_option("-n", "--layers", type="int", dest="layers", default=20,
+                    help="number of synthetic layers (or delta loops)")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=1,
+                    help="random seed of the synthetic profiles")
+    opts.add_option("-e", "--max-error", type="float", dest="max_error",
+                    default=0.000025, help="max_stepper_error (seconds)")
+    opts.add_option("-a", "--accel", type="float", dest="accel",
+                    default=3000., help="maximum acceleration")
+    opts.add_option("--pressure-advance", type="float",
+                    dest="pressure_advance", default=0.05,
+                    help="pressure advance of the extruder profile")
+    opts.add_option("-c", "--cubic", action="store_true", dest="cubic",
+                    default=False,
+                    help="enable cubic step compression")
+    opts.add_option("--delta-approx", action="store_true",
+                    dest="delta_approx", default=False,
+                    help="use the approximate delta step generation")
+    opts.add_option("--compare-delta", action="store_true",
+                    dest="compare_delta", default=False,
+                    help="compare the exact and approximate delta step"
+                    " generation")
+    opts.add_option("-b", "--block", action="store_true", dest="block",
+                    default=False,
+                    help="generate the steps of each batch of moves in a"
+                    " single call (as block_step_generation does)")
+    opts.add_option("--compare-block", action="store_true",
+                    dest="compare_block", default=False,
+                    help="check that block step generation sends the same"
+                    " commands as per move step generation")
+    opts.add_option("--per-phase", action="store_true", dest="per_phase",
+                    default=False,
+                    help="generate the steps of each move phase with a"
+                    " separate step_const() or step_delta() call")
+    opts.add_option("--compare-phases", action="store_true",
+                    dest="compare_phases", default=False,
+                    help="compare the speed of per phase and per move"
+                    " step generation")
+    opts.add_option("--step-trace", type="string", dest="step_trace",
+                    help="record the step times to the given trace file")
+    opts.add_option("--sync-steppers", type="string", dest="sync_steppers",
+                    help="comma separated stepper counts of a stepper"
+                    " synchronization scaling test (eg, 4,8,16,32)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    profiles = [p.strip() for p in options.profiles.split(',')]
+    for profile in profiles:
+        if profile not in PROFILES:
+            opts.error("Unknown profile %s" % (profile,))
+    msgparser = msgproto.MessageParser()
+    msgparser.process_identify(open(args[0], 'rb').read(), decompress=False)
+    # Each profile is reported as a line of json
+    if options.compare_delta:
+        try:
+            result = compare_delta(msgparser, options)
+        except (msgproto.error, mcu.error), e:
+            opts.error("Delta comparison: %s" % (str(e),))
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+        return
+    if options.compare_phases:
+        for profile in profiles:
+            try:
+                result = compare_phases(profile, msgparser, options)
+            except (msgproto.error, mcu.error), e:
+                opts.error("Phase comparison %s: %s" % (profile, str(e)))
+            sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+            sys.stdout.flush()
+        return
+    if options.compare_block:
+        for profile in profiles:
+            if profile == 'delta':
+                continue
+            try:
+                result = compare_block(profile, msgparser, options)
+            except (msgproto.error, mcu.error), e:
+                opts.error("Block comparison %s: %s" % (profile, str(e)))
+            sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+            sys.stdout.flush()
+        return
+    if options.sync_steppers:
+        try:
+            counts = [int(c) for c in options.sync_steppers.split(',')]
+        except ValueError:
+            opts.error("Invalid stepper counts %s" % (options.sync_steppers,))
+        for count in counts:
+            try:
+                result = run_sync_scaling(count, msgparser, options)
+            except (msgproto.error, mcu.error), e:
+                opts.error("Sync test: %s" % (str(e),))
+            sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+            sys.stdout.flush()
+        return
+    for profile in profiles:
+        try:
+            result = run_profile(profile, msgparser, options)
+        except (msgproto.error, mcu.error), e:
+            opts.error("Profile %s: %s" % (profile, str(e)))
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -14,64 +14,254 @@
 // This code is writtin in C (instead of python) for processing
 // efficiency - the repetitive integer math is vastly faster in C.
 
+#include <fcntl.h> // open
 #include <math.h> // sqrt
+#include <pthread.h> // pthread_create
 #include <stddef.h> // offsetof
 #include <stdint.h> // uint32_t
 #include <stdio.h> // fprintf
 #include <stdlib.h> // malloc
 #include <string.h> // memset
+#include <sys/mman.h> // mmap
+#include <unistd.h> // ftruncate
+#include "minheap.h" // minheap_push
 #include "pyhelper.h" // errorf
 #include "serialqueue.h" // struct queue_message
 
 #define CHECK_LINES 1
 #define QUEUE_START_SIZE 1024
+// Maximum number of step times reserved for a move at a time
+#define QUEUE_RESERVE_MAX 65536
+// Maximum number of entries at the start of the step time ring that
+// are mirrored after its end (the longest run of steps compressed)
+#define QUEUE_MIRROR_SIZE 65536
+
+// Delta step times are approximated by quadratics that each cover up
+// to DELTA_APPROX_MAX steps.  A quadratic is used only if it is within
+// max_error/DELTA_APPROX_DIV of the exact step times at the quarter
+// points between its nodes - otherwise shorter runs are tried.
+#define DELTA_APPROX_DIV 16
+#define DELTA_APPROX_MIN 4
+#define DELTA_APPROX_MAX 256
+
+// Number of buckets in the histogram of chosen 'add' values (bucket N
+// counts adds with an absolute value less than 2**N)
+#define ADD_HIST_BUCKETS 17
+
+struct stepcompress_stats {
+    uint64_t step_count, queue_step_count, queue_step_cubic_count;
+    uint64_t msg_bytes, error_sum;
+    uint32_t error_max, dir_changes;
+    uint32_t add_hist[ADD_HIST_BUCKETS];
+    double delta_error_max;
+};
 
 struct stepcompress {
-    // Buffer management
-    uint64_t *queue, *queue_end, *queue_pos, *queue_next;
+    // Buffer management (a ring of step times - 'queue_pos' and
+    // 'queue_next' are free running indexes into it)
+    uint64_t *queue;
+    uint32_t queue_mask, queue_pos, queue_next;
     // Internal tracking
     uint32_t max_error;
+    double delta_approx_error;
+    int delta_approx_check;
     // Message generation
     uint64_t last_step_clock, homing_clock;
     struct list_head msg_queue;
     uint32_t queue_step_msgid, set_next_step_dir_msgid, oid;
+    uint32_t queue_step_cubic_msgid;
     int sdir, invert_sdir;
+    // Move to step conversion factors
+    double mcu_freq, inv_step_dist, velocity_factor, accel_factor;
+    // Compression statistics
+    struct stepcompress_stats stats;
+    // Step time recording
+    struct steptrace *trace;
 };
 
 
 /****************************************************************
- * Queue management
+ * Step trace recording
  ****************************************************************/
 
-// Shuffle the internal queue to avoid having to allocate more ram
-static void
-clean_queue(struct stepcompress *sc)
+// A step trace file starts with a 'struct steptrace_header' that is
+// followed by 'data_size' bytes of blocks.  Each block is a 'struct
+// steptrace_block' followed by 'count' 64bit step clocks of a single
+// stepper moving in a single direction.  All fields are stored in
+// host byte order.
+
+#define STEPTRACE_MAGIC "KLSTEPTR"
+#define STEPTRACE_VERSION 1
+// The file is extended (and remapped) in units of this many bytes
+#define STEPTRACE_GROW_SIZE (16*1024*1024)
+
+struct steptrace_header {
+    char magic[8];
+    uint32_t version, header_size;
+    uint64_t data_size;
+    double mcu_freq;
+};
+
+struct steptrace_block {
+    uint32_t oid, dir, count, pad;
+};
+
+struct steptrace {
+    int fd, failed;
+    uint8_t *map;
+    size_t map_size, pos;
+    // The last block written (it is extended while the same stepper
+    // keeps stepping in the same direction)
+    struct stepcompress *last_sc;
+    int last_dir;
+    size_t last_block;
+};
+
+// Extend the trace file so that 'size' bytes are mapped
+static int
+steptrace_grow(struct steptrace *st, size_t size)
 {
-    int in_use = sc->queue_next - sc->queue_pos;
-    memmove(sc->queue, sc->queue_pos, in_use * sizeof(*sc->queue));
-    sc->queue_pos = sc->queue;
-    sc->queue_next = sc->queue + in_use;
+    size_t map_size = st->map_size;
+    while (map_size < size)
+        map_size += STEPTRACE_GROW_SIZE;
+    int ret = ftruncate(st->fd, map_size);
+    if (ret) {
+        report_errno("steptrace ftruncate", ret);
+        return -1;
+    }
+    void *map = mmap(NULL, map_size, PROT_READ|PROT_WRITE, MAP_SHARED
+                     , st->fd, 0);
+    if (map == MAP_FAILED) {
+        report_errno("steptrace mmap", -1);
+        return -1;
+    }
+    if (st->map)
+        munmap(st->map, st->map_size);
+    st->map = map;
+    st->map_size = map_size;
+    return 0;
 }
 
-// Expand the internal queue of step times
+// Open a step trace file
+struct steptrace *
+steptrace_alloc(const char *filename, double mcu_freq)
+{
+    int fd = open(filename, O_RDWR|O_CREAT|O_TRUNC|O_CLOEXEC, 0644);
+    if (fd < 0) {
+        report_errno("steptrace open", fd);
+        return NULL;
+    }
+    struct steptrace *st = malloc(sizeof(*st));
+    memset(st, 0, sizeof(*st));
+    st->fd = fd;
+    st->pos = sizeof(struct steptrace_header);
+    if (steptrace_grow(st, st->pos)) {
+        close(fd);
+        free(st);
+        return NULL;
+    }
+    struct steptrace_header *hdr = (void*)st->map;
+    memcpy(hdr->magic, STEPTRACE_MAGIC, sizeof(hdr->magic));
+    hdr->version = STEPTRACE_VERSION;
+    hdr->header_size = sizeof(*hdr);
+    hdr->mcu_freq = mcu_freq;
+    return st;
+}
+
+// Close a step trace file (truncating it to the recorded data)
+void
+steptrace_free(struct steptrace *st)
+{
+    if (!st)
+        return;
+    if (st->map)
+        munmap(st->map, st->map_size);
+    int ret = ftruncate(st->fd, st->pos);
+    if (ret)
+        report_errno("steptrace ftruncate", ret);
+    close(st->fd);
+    free(st);
+}
+
+// Append step clocks to the trace
 static void
-expand_queue(struct stepcompress *sc, int count)
+steptrace_record(struct steptrace *st, struct stepcompress *sc
+                 , uint64_t *clocks, uint32_t count)
 {
-    int alloc = sc->queue_end - sc->queue;
-    if (count + sc->queue_next - sc->queue_pos <= alloc) {
-        clean_queue(sc);
+    if (unlikely(st->failed))
         return;
+    size_t size = count * sizeof(*clocks);
+    int extend = st->last_sc == sc && st->last_dir == sc->sdir;
+    size_t need = st->pos + size + (extend ? 0 : sizeof(struct steptrace_block));
+    if (unlikely(need > st->map_size) && steptrace_grow(st, need)) {
+        errorf("steptrace: unable to extend trace file - recording stopped");
+        st->failed = 1;
+        return;
+    }
+    if (!extend) {
+        struct steptrace_block *b = (void*)&st->map[st->pos];
+        b->oid = sc->oid;
+        b->dir = sc->sdir;
+        b->count = b->pad = 0;
+        st->last_sc = sc;
+        st->last_dir = sc->sdir;
+        st->last_block = st->pos;
+        st->pos += sizeof(*b);
     }
-    int pos = sc->queue_pos - sc->queue;
-    int next = sc->queue_next - sc->queue;
-    if (!alloc)
-        alloc = QUEUE_START_SIZE;
-    while (next + count > alloc)
+    memcpy(&st->map[st->pos], clocks, size);
+    st->pos += size;
+    struct steptrace_block *b = (void*)&st->map[st->last_block];
+    b->count += count;
+    struct steptrace_header *hdr = (void*)st->map;
+    hdr->data_size = st->pos - sizeof(*hdr);
+}
+
+
+/****************************************************************
+ * Queue management
+ ****************************************************************/
+
+// Return the step time stored at the given queue index
+static inline uint64_t
+queue_get(struct stepcompress *sc, uint32_t pos)
+{
+    return sc->queue[pos & sc->queue_mask];
+}
+
+// Return the queued step times as an array.  The first entries of the
+// ring are mirrored after its end, so the returned array holds at
+// least 64K (or all queued) step times contiguously.
+static inline uint64_t *
+queue_window(struct stepcompress *sc)
+{
+    return &sc->queue[sc->queue_pos & sc->queue_mask];
+}
+
+// Number of ring entries mirrored after the end of the ring
+static inline uint32_t
+queue_mirror_size(uint32_t alloc)
+{
+    return alloc < QUEUE_MIRROR_SIZE ? alloc : QUEUE_MIRROR_SIZE;
+}
+
+// Grow the ring so that it can hold at least 'size' step times.
+// Entries are only copied here - the ring never shuffles entries
+// while it is large enough.
+static void
+expand_queue(struct stepcompress *sc, uint32_t size)
+{
+    uint32_t alloc = sc->queue ? sc->queue_mask + 1 : QUEUE_START_SIZE;
+    while (alloc < size)
         alloc *= 2;
-    sc->queue = realloc(sc->queue, alloc * sizeof(*sc->queue));
-    sc->queue_end = sc->queue + alloc;
-    sc->queue_pos = sc->queue + pos;
-    sc->queue_next = sc->queue + next;
+    uint32_t mirror = queue_mirror_size(alloc);
+    uint64_t *queue = malloc((alloc + mirror) * sizeof(*queue));
+    uint32_t pos;
+    for (pos = sc->queue_pos; pos != sc->queue_next; pos++)
+        queue[pos & (alloc - 1)] = queue_get(sc, pos);
+    memcpy(&queue[alloc], queue, mirror * sizeof(*queue));
+    free(sc->queue);
+    sc->queue = queue;
+    sc->queue_mask = alloc - 1;
 }
 
 
@@ -100,10 +290,10 @@ struct points {
 // Given a requested step time, return the minimum and maximum
 // acceptable times
 static inline struct points
-minmax_point(struct stepcompress *sc, uint64_t *pos)
+minmax_point(struct stepcompress *sc, uint64_t *qpos, uint32_t i)
 {
-    uint32_t prevpoint = pos > sc->queue_pos ? *(pos-1) - sc->last_step_clock : 0;
-    uint32_t point = *pos - sc->last_step_clock;
+    uint32_t prevpoint = i ? qpos[i-1] - sc->last_step_clock : 0;
+    uint32_t point = qpos[i] - sc->last_step_clock;
     uint32_t max_error = (point - prevpoint) / 2;
     if (max_error > sc->max_error)
         max_error = sc->max_error;
@@ -119,14 +309,35 @@ minmax_point(struct stepcompress *sc, uint64_t *pos)
 struct step_move {
     uint32_t interval;
     uint16_t count;
-    int16_t add;
+    int16_t add, add2;
 };
 
-// Find a 'step_move' that covers a series of step times
+// Return the time offset contributed by 'add2' to step 'count'
+static inline int64_t
+cubic_offset(int32_t add2, int32_t count)
+{
+    return (int64_t)add2 * count * (count-1) * (count-2) / 6;
+}
+
+// Check if a sequence with the given 'add2' may be extended to 'count'
+static inline int
+cubic_in_range(int32_t add, int32_t add2, int32_t count)
+{
+    if (!add2)
+        return 1;
+    int64_t c = cubic_offset(add2, count);
+    int32_t lastadd = add + add2 * (count - 1);
+    return (c < (1<<30) && c > -(1<<30)
+            && lastadd >= -0x8000 && lastadd <= 0x7fff);
+}
+
+// Find a 'step_move' that covers a series of step times (after
+// removing the third order 'add2' term from each step time)
 static struct step_move
-compress_bisect_add(struct stepcompress *sc)
+compress_bisect_add(struct stepcompress *sc, int32_t add2)
 {
-    struct points point = minmax_point(sc, sc->queue_pos);
+    uint64_t *qpos = queue_window(sc);
+    struct points point = minmax_point(sc, qpos, 0);
     int32_t outer_mininterval = point.minp, outer_maxinterval = point.maxp;
     int32_t add = 0, minadd = -0x8000, maxadd = 0x7fff;
     int32_t bestinterval = 0, bestcount = 1, bestadd = 1, bestreach = INT32_MIN;
@@ -140,14 +351,23 @@ compress_bisect_add(struct stepcompress *sc)
         int32_t nextcount = 1;
         for (;;) {
             nextcount++;
+            int in_range = cubic_in_range(add, add2, nextcount);
             if (nextcount > bestcount
-                && (&sc->queue_pos[nextcount-1] >= sc->queue_next
-                    || sc->queue_pos[nextcount-1] >= sc->last_step_clock+(3<<28)
-                    || nextcount > 65535)) {
+                && (nextcount > sc->queue_next - sc->queue_pos
+                    || qpos[nextcount-1] >= sc->last_step_clock+(3<<28)
+                    || nextcount > 65535 || !in_range)) {
                 int32_t count = nextcount - 1;
-                return (struct step_move){ interval, count, add };
+                return (struct step_move){ interval, count, add, add2 };
+            }
+            if (!in_range)
+                // This 'add' can not produce a better sequence
+                goto done;
+            nextpoint = minmax_point(sc, qpos, nextcount - 1);
+            if (add2) {
+                int32_t c3 = cubic_offset(add2, nextcount);
+                nextpoint.minp -= c3;
+                nextpoint.maxp -= c3;
             }
-            nextpoint = minmax_point(sc, sc->queue_pos + nextcount - 1);
             int32_t nextaddfactor = nextcount*(nextcount-1)/2;
             int32_t c = add*nextaddfactor;
             if (nextmininterval*nextcount < nextpoint.minp - c)
@@ -211,10 +431,65 @@ compress_bisect_add(struct stepcompress *sc)
             break;
         add = maxadd - (maxadd - minadd) / 4;
     }
+done:
     if (zerocount + zerocount/16 >= bestcount)
         // Prefer add=0 if it's similar to the best found sequence
-        return (struct step_move){ zerointerval, zerocount, 0 };
-    return (struct step_move){ bestinterval, bestcount, bestadd };
+        return (struct step_move){ zerointerval, zerocount, 0, add2 };
+    return (struct step_move){ bestinterval, bestcount, bestadd, add2 };
+}
+
+// Minimum quadratic sequence length before a cubic sequence is tried
+#define CUBIC_MIN_COUNT 3
+// Maximum number of 'add2' values tried on each side of the estimate
+#define CUBIC_SEARCH 16
+
+// Find a 'step_move' for the next steps, trying a third order 'add2'
+// term when the mcu supports it and it covers more steps
+static struct step_move
+compress_steps(struct stepcompress *sc)
+{
+    struct step_move best = compress_bisect_add(sc, 0);
+    int32_t avail = sc->queue_next - sc->queue_pos;
+    if (!sc->queue_step_cubic_msgid || best.count < CUBIC_MIN_COUNT
+        || best.count >= avail || best.count == 65535)
+        return best;
+
+    // Estimate 'add2' from the third difference of the step times.
+    // The third difference of 'add2*n*(n-1)*(n-2)/6' is 'add2*h^3'.
+    int32_t h = best.count;
+    if (3*h > avail)
+        h = avail / 3;
+    uint32_t qp = sc->queue_pos - 1;
+    uint64_t lsc = sc->last_step_clock;
+    double d3 = ((double)(int64_t)(queue_get(sc, qp + 3*h) - lsc)
+                 - 3.*(int64_t)(queue_get(sc, qp + 2*h) - lsc)
+                 + 3.*(int64_t)(queue_get(sc, qp + h) - lsc));
+    double est = d3 / ((double)h * h * h);
+    if (est > 0x7fff || est < -0x8000)
+        return best;
+    int32_t add2 = (int32_t)(est >= 0. ? est + .5 : est - .5);
+
+    // Search for the 'add2' near the estimate that covers the most steps
+    struct step_move move = add2 ? compress_bisect_add(sc, add2) : best;
+    int32_t dir;
+    for (dir=-1; dir<=1; dir+=2) {
+        struct step_move next = move;
+        int32_t a2 = add2, tries = 0;
+        for (;;) {
+            a2 += dir;
+            if (!a2 || ++tries > CUBIC_SEARCH)
+                break;
+            struct step_move m = compress_bisect_add(sc, a2);
+            if (m.count <= next.count)
+                break;
+            next = m;
+        }
+        if (next.count > move.count)
+            move = next;
+    }
+    if (move.count > best.count)
+        return move;
+    return best;
 }
 
 
@@ -231,12 +506,13 @@ check_line(struct stepcompress *sc, struct step_move move)
     if (!CHECK_LINES)
         return 0;
     if (move.count == 1) {
-        if (move.interval != (uint32_t)(*sc->queue_pos - sc->last_step_clock)
-            || *sc->queue_pos < sc->last_step_clock) {
+        uint64_t step_clock = *queue_window(sc);
+        if (move.interval != (uint32_t)(step_clock - sc->last_step_clock)
+            || step_clock < sc->last_step_clock) {
             errorf("stepcompress o=%d i=%d c=%d a=%d:"
                    " Count 1 point out of range (%lld)"
                    , sc->oid, move.interval, move.count, move.add
-                   , (long long)(*sc->queue_pos - sc->last_step_clock));
+                   , (long long)(step_clock - sc->last_step_clock));
             return ERROR_RET;
         }
         return 0;
@@ -247,10 +523,13 @@ check_line(struct stepcompress *sc, struct step_move move)
                , sc->oid, move.interval, move.count, move.add);
         return ERROR_RET;
     }
-    uint32_t interval = move.interval, p = 0;
+    uint32_t interval = move.interval, p = 0, error_max = sc->stats.error_max;
+    uint64_t error_sum = 0;
+    int32_t add = move.add;
+    uint64_t *qpos = queue_window(sc);
     uint16_t i;
     for (i=0; i<move.count; i++) {
-        struct points point = minmax_point(sc, sc->queue_pos + i);
+        struct points point = minmax_point(sc, qpos, i);
         p += interval;
         if (p < point.minp || p > point.maxp) {
             errorf("stepcompress o=%d i=%d c=%d a=%d: Point %d: %d not in %d:%d"
@@ -258,6 +537,11 @@ check_line(struct stepcompress *sc, struct step_move move)
                    , i+1, p, point.minp, point.maxp);
             return ERROR_RET;
         }
+        // Steps may only be scheduled early - note how early
+        uint32_t error = point.maxp - p;
+        error_sum += error;
+        if (error > error_max)
+            error_max = error;
         if (interval >= 0x80000000) {
             errorf("stepcompress o=%d i=%d c=%d a=%d:"
                    " Point %d: interval overflow %d"
@@ -265,8 +549,11 @@ check_line(struct stepcompress *sc, struct step_move move)
                    , i+1, interval);
             return ERROR_RET;
         }
-        interval += move.add;
+        interval += add;
+        add += move.add2;
     }
+    sc->stats.error_sum += error_sum;
+    sc->stats.error_max = error_max;
     return 0;
 }
 
@@ -293,6 +580,46 @@ stepcompress_alloc(uint32_t max_error, uint32_t queue_step_msgid
     return sc;
 }
 
+// Report the compression statistics of a 'stepcompress' object.  The
+// timing error is the number of clock ticks each step was scheduled
+// ahead of its requested time.
+void
+stepcompress_get_stats(struct stepcompress *sc
+                       , struct stepcompress_stats *stats)
+{
+    *stats = sc->stats;
+}
+
+// Generate delta steps from a piecewise quadratic approximation of
+// the step times (instead of solving each step time exactly).  If
+// 'enable' is 2, each approximated step time is also compared with
+// the exact step time (and the largest difference is reported in the
+// delta_error_max statistic).
+void
+stepcompress_set_delta_approx(struct stepcompress *sc, uint32_t enable)
+{
+    sc->delta_approx_error = (enable
+                              ? (double)sc->max_error / DELTA_APPROX_DIV : 0.);
+    sc->delta_approx_check = enable == 2;
+}
+
+// Enable third order step compression using the given mcu command id
+void
+stepcompress_set_cubic(struct stepcompress *sc, uint32_t queue_step_cubic_msgid)
+{
+    sc->queue_step_cubic_msgid = queue_step_cubic_msgid;
+}
+
+// Record all steps subsequently scheduled on this stepper in the given
+// step trace (or stop recording if 'st' is NULL).  The trace may be
+// shared by several steppers, but they must all be used from the same
+// thread.
+void
+stepcompress_set_trace(struct stepcompress *sc, struct steptrace *st)
+{
+    sc->trace = st;
+}
+
 // Free memory associated with a 'stepcompress' object
 void
 stepcompress_free(struct stepcompress *sc)
@@ -308,25 +635,43 @@ stepcompress_free(struct stepcompress *sc)
 static int
 stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
 {
-    if (sc->queue_pos >= sc->queue_next)
+    if (sc->queue_pos == sc->queue_next)
         return 0;
     while (move_clock > sc->last_step_clock) {
-        struct step_move move = compress_bisect_add(sc);
+        struct step_move move = compress_steps(sc);
         int ret = check_line(sc, move);
         if (ret)
             return ret;
 
-        uint32_t msg[5] = {
-            sc->queue_step_msgid, sc->oid, move.interval, move.count, move.add
-        };
-        struct queue_message *qm = message_alloc_and_encode(msg, 5);
+        struct queue_message *qm;
+        if (move.add2) {
+            uint32_t msg[6] = {
+                sc->queue_step_cubic_msgid, sc->oid, move.interval
+                , move.count, move.add, move.add2
+            };
+            qm = message_alloc_and_encode(msg, 6);
+            sc->stats.queue_step_cubic_count++;
+        } else {
+            uint32_t msg[5] = {
+                sc->queue_step_msgid, sc->oid, move.interval, move.count
+                , move.add
+            };
+            qm = message_alloc_and_encode(msg, 5);
+            sc->stats.queue_step_count++;
+        }
+        sc->stats.step_count += move.count;
+        sc->stats.msg_bytes += qm->len;
+        uint32_t abs_add = move.add < 0 ? -move.add : move.add;
+        sc->stats.add_hist[abs_add ? 32 - __builtin_clz(abs_add) : 0]++;
         qm->min_clock = qm->req_clock = sc->last_step_clock;
-        if (move.count == 1 && sc->last_step_clock + (1<<27) < *sc->queue_pos) {
+        uint64_t first_clock = *queue_window(sc);
+        if (move.count == 1 && sc->last_step_clock + (1<<27) < first_clock) {
             // Be careful with 32bit overflow
-            sc->last_step_clock = qm->req_clock = *sc->queue_pos;
+            sc->last_step_clock = qm->req_clock = first_clock;
         } else {
             int32_t addfactor = move.count*(move.count-1)/2;
             uint32_t ticks = move.add*addfactor + move.interval*move.count;
+            ticks += cubic_offset(move.add2, move.count);
             sc->last_step_clock += ticks;
         }
         if (sc->homing_clock)
@@ -334,11 +679,9 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
             qm->min_clock = qm->req_clock = sc->homing_clock;
         list_add_tail(&qm->node, &sc->msg_queue);
 
-        if (sc->queue_pos + move.count >= sc->queue_next) {
-            sc->queue_pos = sc->queue_next = sc->queue;
-            break;
-        }
         sc->queue_pos += move.count;
+        if (sc->queue_pos == sc->queue_next)
+            break;
     }
     return 0;
 }
@@ -349,6 +692,8 @@ set_next_step_dir(struct stepcompress *sc, int sdir)
 {
     if (sc->sdir == sdir)
         return 0;
+    if (sc->sdir >= 0)
+        sc->stats.dir_changes++;
     sc->sdir = sdir;
     int ret = stepcompress_flush(sc, UINT64_MAX);
     if (ret)
@@ -362,30 +707,64 @@ set_next_step_dir(struct stepcompress *sc, int sdir)
     return 0;
 }
 
-// Check if the internal queue needs to be expanded, and expand if so
+// Reserve queue space for 'count' new step times.  On success,
+// 'pqnext' and 'pqend' are set to a run of free entries (of up to
+// 'count' entries) that may be filled without further checks.
 static int
-_check_push(struct stepcompress *sc)
+queue_reserve(struct stepcompress *sc, int count
+              , uint64_t **pqnext, uint64_t **pqend)
 {
-    if (sc->queue_next - sc->queue_pos > 65535 + 2000) {
+    uint32_t in_use = sc->queue_next - sc->queue_pos;
+    if (in_use > 65535 + 2000) {
         // No point in keeping more than 64K steps in memory
-        int ret = stepcompress_flush(sc, *(sc->queue_next - 65535));
+        int ret = stepcompress_flush(
+            sc, queue_get(sc, sc->queue_next - 65535));
         if (ret)
             return ret;
+        in_use = sc->queue_next - sc->queue_pos;
     }
-    expand_queue(sc, 1);
+    int want = count < QUEUE_RESERVE_MAX ? count : QUEUE_RESERVE_MAX;
+    int avail = sc->queue ? sc->queue_mask + 1 - in_use : 0;
+    if (avail < want) {
+        expand_queue(sc, in_use + want);
+        avail = sc->queue_mask + 1 - in_use;
+    }
+    // Entries are filled up to the end of the ring at most
+    uint32_t next = sc->queue_next & sc->queue_mask;
+    if (avail > sc->queue_mask + 1 - next)
+        avail = sc->queue_mask + 1 - next;
+    *pqnext = &sc->queue[next];
+    *pqend = *pqnext + (avail < count ? avail : count);
     return 0;
 }
+// Add the entries filled up to 'qnext' to the queue
+static void
+queue_commit(struct stepcompress *sc, uint64_t *qnext)
+{
+    uint32_t alloc = sc->queue_mask + 1, mirror = queue_mirror_size(alloc);
+    uint32_t next = sc->queue_next & sc->queue_mask;
+    uint32_t count = qnext - &sc->queue[next];
+    if (next < mirror) {
+        // Update the mirrored copy of the start of the ring
+        uint32_t mcount = next + count > mirror ? mirror - next : count;
+        memcpy(&sc->queue[alloc + next], &sc->queue[next]
+               , mcount * sizeof(*sc->queue));
+    }
+    if (sc->trace && count)
+        steptrace_record(sc->trace, sc, &sc->queue[next], count);
+    sc->queue_next += count;
+}
+// Store a step time, reserving space for the 'count' remaining step
+// times of the move when the current run of free entries is full
 static inline int
 check_push(struct stepcompress *sc, uint64_t **pqnext, uint64_t **pqend
-           , uint64_t c)
+           , int count, uint64_t c)
 {
     if (unlikely(*pqnext >= *pqend)) {
-        sc->queue_next = *pqnext;
-        int ret = _check_push(sc);
+        queue_commit(sc, *pqnext);
+        int ret = queue_reserve(sc, count, pqnext, pqend);
         if (ret)
             return ret;
-        *pqnext = sc->queue_next;
-        *pqend = sc->queue_end;
     }
     *(*pqnext)++ = c;
     return 0;
@@ -455,11 +834,12 @@ stepcompress_push(struct stepcompress *sc, double step_clock, int32_t sdir)
     if (ret)
         return ret;
     step_clock += 0.5;
-    uint64_t *qnext = sc->queue_next, *qend = sc->queue_end;
-    ret = check_push(sc, &qnext, &qend, step_clock);
+    uint64_t *qnext, *qend;
+    ret = queue_reserve(sc, 1, &qnext, &qend);
     if (ret)
         return ret;
-    sc->queue_next = qnext;
+    *qnext++ = step_clock;
+    queue_commit(sc, qnext);
     return 0;
 }
 
@@ -507,13 +887,16 @@ stepcompress_push_const(
     // Calculate each step time
     clock_offset += 0.5;
     double pos = step_offset + .5;
-    uint64_t *qnext = sc->queue_next, *qend = sc->queue_end;
+    uint64_t *qnext, *qend;
+    ret = queue_reserve(sc, count, &qnext, &qend);
+    if (ret)
+        return ret;
     if (!accel) {
         // Move at constant velocity (zero acceleration)
         double inv_cruise_sv = 1. / start_sv;
         while (count--) {
             uint64_t c = clock_offset + pos*inv_cruise_sv;
-            int ret = check_push(sc, &qnext, &qend, c);
+            int ret = check_push(sc, &qnext, &qend, count + 1, c);
             if (ret)
                 return ret;
             pos += 1.0;
@@ -527,16 +910,106 @@ stepcompress_push_const(
         while (count--) {
             double v = safe_sqrt(pos * accel_multiplier);
             uint64_t c = clock_offset + (accel_multiplier >= 0. ? v : -v);
-            int ret = check_push(sc, &qnext, &qend, c);
+            int ret = check_push(sc, &qnext, &qend, count + 1, c);
             if (ret)
                 return ret;
             pos += 1.0;
         }
     }
-    sc->queue_next = qnext;
+    queue_commit(sc, qnext);
     return res;
 }
 
+// The parameters of the step time calculation of a delta move
+struct delta_steps {
+    double clock_offset, start_pos, zoffset, arm_sd2, movexy_r, movez_r;
+    double inv_cruise_sv, accel_multiplier;
+    int sdir;
+};
+
+// Return the step time of the step at the given carriage height
+static inline double
+delta_step_clock(struct delta_steps *ds, double height)
+{
+    double relheight = ds->movexy_r*height - ds->zoffset;
+    double v = safe_sqrt(ds->arm_sd2 - relheight*relheight);
+    double pos = ds->start_pos + ds->movez_r*height + (ds->sdir ? -v : v);
+    if (!ds->accel_multiplier)
+        return ds->clock_offset + pos * ds->inv_cruise_sv;
+    v = safe_sqrt(pos * ds->accel_multiplier);
+    return ds->clock_offset + (ds->accel_multiplier >= 0. ? v : -v);
+}
+
+// Schedule the 'count' steps of a delta move starting at 'height'
+static int
+push_delta_approx(struct stepcompress *sc, struct delta_steps *ds
+                  , double height, int count
+                  , uint64_t **pqnext, uint64_t **pqend)
+{
+    // The largest error of a quadratic is slightly past the quarter
+    // points (by up to 3% when the third derivative is constant)
+    double dh = ds->sdir ? 1. : -1., max_err = sc->delta_approx_error * .9;
+    double t0 = delta_step_clock(ds, height);
+    int run = DELTA_APPROX_MAX;
+    while (count > 1) {
+        // Find a quadratic through steps 0, k/2, and k of this run
+        int k = run;
+        while (k >= count)
+            k /= 2;
+        double tk = 0., tm = 0., tq = 0., d1 = 0., c = 0.;
+        if (k >= DELTA_APPROX_MIN) {
+            tk = delta_step_clock(ds, height + k*dh);
+            tm = delta_step_clock(ds, height + (k/2)*dh);
+        }
+        while (k >= DELTA_APPROX_MIN) {
+            int m = k / 2, q = k / 4;
+            d1 = (tm - t0) / m;
+            c = ((tk - tm) / m - d1) / k;
+            tq = delta_step_clock(ds, height + q*dh);
+            double e1 = t0 + d1*q - c*q*(m-q) - tq;
+            double e3 = t0 + d1*(m+q) + c*(m+q)*q - delta_step_clock(
+                ds, height + (m+q)*dh);
+            if (fabs(e1) <= max_err && fabs(e3) <= max_err)
+                break;
+            // Try the first half of this run
+            k = m;
+            tk = tm;
+            tm = tq;
+        }
+        if (k < DELTA_APPROX_MIN) {
+            // Use the exact step time
+            int ret = check_push(sc, pqnext, pqend, count, t0);
+            if (ret)
+                return ret;
+            height += dh;
+            t0 = delta_step_clock(ds, height);
+            count--;
+            run = DELTA_APPROX_MIN;
+            continue;
+        }
+        // Generate the steps using forward differences
+        double t = t0, dt = d1 + c*(1 - k/2), ddt = 2. * c;
+        int i;
+        for (i=0; i<k; i++) {
+            int ret = check_push(sc, pqnext, pqend, count - i, t);
+            if (ret)
+                return ret;
+            if (unlikely(sc->delta_approx_check)) {
+                double err = fabs(t - delta_step_clock(ds, height + i*dh));
+                if (err > sc->stats.delta_error_max)
+                    sc->stats.delta_error_max = err;
+            }
+            t += dt;
+            dt += ddt;
+        }
+        height += k*dh;
+        t0 = tk;
+        count -= k;
+        run = k == run && run < DELTA_APPROX_MAX ? run * 2 : k;
+    }
+    return check_push(sc, pqnext, pqend, 1, t0);
+}
+
 // Schedule steps using delta kinematics
 static int32_t
 _stepcompress_push_delta(
@@ -567,8 +1040,27 @@ _stepcompress_push_delta(
     // Calculate each step time
     clock_offset += 0.5;
     height += (sdir ? .5 : -.5);
-    uint64_t *qnext = sc->queue_next, *qend = sc->queue_end;
-    if (!accel) {
+    uint64_t *qnext, *qend;
+    ret = queue_reserve(sc, count, &qnext, &qend);
+    if (ret)
+        return ret;
+    if (sc->delta_approx_error && (accel || movexy_r)) {
+        // Approximate the step times
+        struct delta_steps ds = {
+            clock_offset, movexy_r*startxy_sd, movez_r*startxy_sd, arm_sd2
+            , movexy_r, movez_r, 0., 0., sdir };
+        if (!accel) {
+            ds.inv_cruise_sv = 1. / start_sv;
+        } else {
+            double inv_accel = 1. / accel;
+            ds.clock_offset -= start_sv * inv_accel;
+            ds.start_pos += 0.5 * start_sv*start_sv * inv_accel;
+            ds.accel_multiplier = 2. * inv_accel;
+        }
+        ret = push_delta_approx(sc, &ds, height, count, &qnext, &qend);
+        if (ret)
+            return ret;
+    } else if (!accel) {
         // Move at constant velocity (zero acceleration)
         double inv_cruise_sv = 1. / start_sv;
         if (!movez_r) {
@@ -577,7 +1069,7 @@ _stepcompress_push_delta(
                 double v = safe_sqrt(arm_sd2 - height*height);
                 double pos = startxy_sd + (sdir ? -v : v);
                 uint64_t c = clock_offset + pos * inv_cruise_sv;
-                int ret = check_push(sc, &qnext, &qend, c);
+                int ret = check_push(sc, &qnext, &qend, count + 1, c);
                 if (ret)
                     return ret;
                 height += (sdir ? 1. : -1.);
@@ -587,7 +1079,7 @@ _stepcompress_push_delta(
             double pos = (sdir ? height-end_height : end_height-height);
             while (count--) {
                 uint64_t c = clock_offset + pos * inv_cruise_sv;
-                int ret = check_push(sc, &qnext, &qend, c);
+                int ret = check_push(sc, &qnext, &qend, count + 1, c);
                 if (ret)
                     return ret;
                 pos += 1.;
@@ -600,7 +1092,7 @@ _stepcompress_push_delta(
                 double v = safe_sqrt(arm_sd2 - relheight*relheight);
                 double pos = start_pos + movez_r*height + (sdir ? -v : v);
                 uint64_t c = clock_offset + pos * inv_cruise_sv;
-                int ret = check_push(sc, &qnext, &qend, c);
+                int ret = check_push(sc, &qnext, &qend, count + 1, c);
                 if (ret)
                     return ret;
                 height += (sdir ? 1. : -1.);
@@ -619,13 +1111,13 @@ _stepcompress_push_delta(
             double pos = start_pos + movez_r*height + (sdir ? -v : v);
             v = safe_sqrt(pos * accel_multiplier);
             uint64_t c = clock_offset + (accel_multiplier >= 0. ? v : -v);
-            int ret = check_push(sc, &qnext, &qend, c);
+            int ret = check_push(sc, &qnext, &qend, count + 1, c);
             if (ret)
                 return ret;
             height += (sdir ? 1. : -1.);
         }
     }
-    sc->queue_next = qnext;
+    queue_commit(sc, qnext);
     return res;
 }
 
@@ -661,6 +1153,129 @@ stepcompress_push_delta(
     return res1 + res2;
 }
 
+// Set the factors used to convert move distances, times, velocities,
+// and accelerations to step distances and clock ticks
+void
+stepcompress_set_factors(struct stepcompress *sc, double mcu_freq
+                         , double inv_step_dist, double velocity_factor
+                         , double accel_factor)
+{
+    sc->mcu_freq = mcu_freq;
+    sc->inv_step_dist = inv_step_dist;
+    sc->velocity_factor = velocity_factor;
+    sc->accel_factor = accel_factor;
+}
+
+// Schedule a constant acceleration move given in the units of the
+// caller (see stepcompress_push_const)
+static int32_t
+push_const_move(struct stepcompress *sc, int64_t commanded_pos
+                , double mcu_time, double start_pos, double dist
+                , double start_v, double accel)
+{
+    double inv_step_dist = sc->inv_step_dist;
+    return stepcompress_push_const(
+        sc, mcu_time * sc->mcu_freq
+        , (double)commanded_pos - start_pos * inv_step_dist
+        , dist * inv_step_dist, start_v * sc->velocity_factor
+        , accel * sc->accel_factor);
+}
+
+// Schedule the steps of an accel/cruise/decel move (a phase is
+// skipped if its distance is zero).  The deceleration phase starts at
+// 'decel_v' (normally the same as 'cruise_v').  The distances and times are in
+// the units of the caller (eg, mm and seconds); 'commanded_pos' is
+// the stepper position (in steps) at the start of the move.  Returns
+// the total number of steps taken.
+int32_t
+stepcompress_push_trapezoid(
+    struct stepcompress *sc, int64_t commanded_pos, double mcu_time
+    , double start_pos, double accel_d, double cruise_d, double decel_d
+    , double accel_t, double cruise_t
+    , double start_v, double cruise_v, double decel_v, double accel)
+{
+    int64_t pos = commanded_pos;
+    if (accel_d) {
+        int32_t count = push_const_move(sc, pos, mcu_time, start_pos
+                                        , accel_d, start_v, accel);
+        if (count == ERROR_RET)
+            return count;
+        pos += count;
+        start_pos += accel_d;
+        mcu_time += accel_t;
+    }
+    if (cruise_d) {
+        int32_t count = push_const_move(sc, pos, mcu_time, start_pos
+                                        , cruise_d, cruise_v, 0.);
+        if (count == ERROR_RET)
+            return count;
+        pos += count;
+        start_pos += cruise_d;
+        mcu_time += cruise_t;
+    }
+    if (decel_d) {
+        int32_t count = push_const_move(sc, pos, mcu_time, start_pos
+                                        , decel_d, decel_v, -accel);
+        if (count == ERROR_RET)
+            return count;
+        pos += count;
+    }
+    return pos - commanded_pos;
+}
+
+// Schedule the steps of an accel/cruise/decel move on a delta tower
+// (see stepcompress_push_trapezoid and stepcompress_push_delta)
+int32_t
+stepcompress_push_delta_trapezoid(
+    struct stepcompress *sc, int64_t commanded_pos, double mcu_time
+    , double accel_d, double cruise_d, double decel_d
+    , double accel_t, double cruise_t
+    , double start_v, double cruise_v, double accel
+    , double startz, double startxy_d, double arm_d
+    , double movez_r, double movexy_r)
+{
+    double inv_step_dist = sc->inv_step_dist;
+    double arm_sd = arm_d * inv_step_dist;
+    int64_t pos = commanded_pos;
+    if (accel_d) {
+        int32_t count = stepcompress_push_delta(
+            sc, mcu_time * sc->mcu_freq, accel_d * inv_step_dist
+            , start_v * sc->velocity_factor, accel * sc->accel_factor
+            , (double)pos - startz * inv_step_dist
+            , startxy_d * inv_step_dist, arm_sd, movez_r);
+        if (count == ERROR_RET)
+            return count;
+        pos += count;
+        startz += accel_d * movez_r;
+        startxy_d -= accel_d * movexy_r;
+        mcu_time += accel_t;
+    }
+    if (cruise_d) {
+        int32_t count = stepcompress_push_delta(
+            sc, mcu_time * sc->mcu_freq, cruise_d * inv_step_dist
+            , cruise_v * sc->velocity_factor, 0.
+            , (double)pos - startz * inv_step_dist
+            , startxy_d * inv_step_dist, arm_sd, movez_r);
+        if (count == ERROR_RET)
+            return count;
+        pos += count;
+        startz += cruise_d * movez_r;
+        startxy_d -= cruise_d * movexy_r;
+        mcu_time += cruise_t;
+    }
+    if (decel_d) {
+        int32_t count = stepcompress_push_delta(
+            sc, mcu_time * sc->mcu_freq, decel_d * inv_step_dist
+            , cruise_v * sc->velocity_factor, -accel * sc->accel_factor
+            , (double)pos - startz * inv_step_dist
+            , startxy_d * inv_step_dist, arm_sd, movez_r);
+        if (count == ERROR_RET)
+            return count;
+        pos += count;
+    }
+    return pos - commanded_pos;
+}
+
 
 /****************************************************************
  * Step compress synchronization
@@ -680,9 +1295,25 @@ struct steppersync {
     // Storage for associated stepcompress objects
     struct stepcompress **sc_list;
     int sc_num;
+    // Stepcompress objects with queued messages ordered by the
+    // req_clock of their first message
+    struct minheap msg_heap;
     // Storage for list of pending move clocks
     uint64_t *move_clocks;
     int num_move_clocks;
+    // Step compression worker threads
+    struct compress_worker *workers;
+    int num_workers;
+    pthread_mutex_t lock; // protects variables below
+    pthread_cond_t work_cond, done_cond;
+    uint64_t work_clock;
+    int work_gen, work_pending, work_ret, work_exit;
+};
+
+struct compress_worker {
+    struct steppersync *ss;
+    pthread_t tid;
+    int index;
 };
 
 // Allocate a new 'steppersync' object
@@ -698,21 +1329,49 @@ steppersync_alloc(struct serialqueue *sq, struct stepcompress **sc_list
     ss->sc_list = malloc(sizeof(*sc_list)*sc_num);
     memcpy(ss->sc_list, sc_list, sizeof(*sc_list)*sc_num);
     ss->sc_num = sc_num;
+    minheap_init(&ss->msg_heap);
 
     ss->move_clocks = malloc(sizeof(*ss->move_clocks)*move_num);
     memset(ss->move_clocks, 0, sizeof(*ss->move_clocks)*move_num);
     ss->num_move_clocks = move_num;
 
+    pthread_mutex_init(&ss->lock, NULL);
+    pthread_cond_init(&ss->work_cond, NULL);
+    pthread_cond_init(&ss->done_cond, NULL);
+
     return ss;
 }
 
+// Stop any step compression worker threads
+static void
+stop_workers(struct steppersync *ss)
+{
+    if (!ss->num_workers)
+        return;
+    pthread_mutex_lock(&ss->lock);
+    ss->work_exit = 1;
+    pthread_cond_broadcast(&ss->work_cond);
+    pthread_mutex_unlock(&ss->lock);
+    int i;
+    for (i=0; i<ss->num_workers; i++)
+        pthread_join(ss->workers[i].tid, NULL);
+    free(ss->workers);
+    ss->workers = NULL;
+    ss->num_workers = ss->work_exit = 0;
+}
+
 // Free memory associated with a 'steppersync' object
 void
 steppersync_free(struct steppersync *ss)
 {
     if (!ss)
         return;
+    stop_workers(ss);
+    pthread_mutex_destroy(&ss->lock);
+    pthread_cond_destroy(&ss->work_cond);
+    pthread_cond_destroy(&ss->done_cond);
     free(ss->sc_list);
+    minheap_free(&ss->msg_heap);
     free(ss->move_clocks);
     serialqueue_free_commandqueue(ss->cq);
     free(ss);
@@ -743,37 +1402,150 @@ heap_replace(struct steppersync *ss, uint64_t req_clock)
     }
 }
 
+// Minimum number of queued steps before the worker threads are used
+#define THREAD_MIN_STEPS 1024
+
+// Flush every 'stride'th stepcompress starting at 'index'
+static int
+flush_stepcompress_set(struct steppersync *ss, int index, int stride
+                       , uint64_t move_clock)
+{
+    int i, ret = 0;
+    for (i=index; i<ss->sc_num; i+=stride) {
+        int r = stepcompress_flush(ss->sc_list[i], move_clock);
+        if (r && !ret)
+            ret = r;
+    }
+    return ret;
+}
+
+// Main code for a step compression worker thread
+static void *
+compress_worker_thread(void *data)
+{
+    struct compress_worker *w = data;
+    struct steppersync *ss = w->ss;
+    pthread_mutex_lock(&ss->lock);
+    int work_gen = ss->work_gen;
+    for (;;) {
+        while (ss->work_gen == work_gen && !ss->work_exit)
+            pthread_cond_wait(&ss->work_cond, &ss->lock);
+        if (ss->work_exit)
+            break;
+        work_gen = ss->work_gen;
+        uint64_t move_clock = ss->work_clock;
+        pthread_mutex_unlock(&ss->lock);
+
+        int ret = flush_stepcompress_set(
+            ss, w->index, ss->num_workers + 1, move_clock);
+
+        pthread_mutex_lock(&ss->lock);
+        if (ret && !ss->work_ret)
+            ss->work_ret = ret;
+        if (!--ss->work_pending)
+            pthread_cond_signal(&ss->done_cond);
+    }
+    pthread_mutex_unlock(&ss->lock);
+    return NULL;
+}
+
+// Set the number of threads that compress the steps of the steppers
+// during steppersync_flush().  The calling thread always compresses
+// some of the steppers, so zero disables the worker threads.
+int
+steppersync_set_threads(struct steppersync *ss, int num_threads)
+{
+    stop_workers(ss);
+    if (num_threads > ss->sc_num - 1)
+        num_threads = ss->sc_num - 1;
+    if (num_threads <= 0)
+        return 0;
+    ss->workers = malloc(sizeof(*ss->workers) * num_threads);
+    int i;
+    for (i=0; i<num_threads; i++) {
+        struct compress_worker *w = &ss->workers[i];
+        w->ss = ss;
+        w->index = i + 1;
+        pthread_mutex_lock(&ss->lock);
+        int ret = pthread_create(&w->tid, NULL, compress_worker_thread, w);
+        if (!ret)
+            ss->num_workers++;
+        pthread_mutex_unlock(&ss->lock);
+        if (ret) {
+            errorf("steppersync_set_threads: pthread_create failed");
+            break;
+        }
+    }
+    return ss->num_workers;
+}
+
+// Flush all the stepcompress objects to the specified move_clock
+static int
+flush_stepcompress(struct steppersync *ss, uint64_t move_clock)
+{
+    // Waking the worker threads isn't worthwhile for a few steps
+    int i, queued_steps = 0;
+    for (i=0; ss->num_workers && i<ss->sc_num; i++) {
+        struct stepcompress *sc = ss->sc_list[i];
+        queued_steps += sc->queue_next - sc->queue_pos;
+    }
+    if (queued_steps < THREAD_MIN_STEPS)
+        return flush_stepcompress_set(ss, 0, 1, move_clock);
+
+    // Wake the worker threads and compress the first set in this thread
+    pthread_mutex_lock(&ss->lock);
+    ss->work_clock = move_clock;
+    ss->work_pending = ss->num_workers;
+    ss->work_ret = 0;
+    ss->work_gen++;
+    pthread_cond_broadcast(&ss->work_cond);
+    pthread_mutex_unlock(&ss->lock);
+
+    int ret = flush_stepcompress_set(ss, 0, ss->num_workers + 1, move_clock);
+
+    // Wait for the worker threads to complete
+    pthread_mutex_lock(&ss->lock);
+    while (ss->work_pending)
+        pthread_cond_wait(&ss->done_cond, &ss->lock);
+    if (!ret)
+        ret = ss->work_ret;
+    pthread_mutex_unlock(&ss->lock);
+    return ret;
+}
+
 // Find and transmit any scheduled steps prior to the given 'move_clock'
 int
 steppersync_flush(struct steppersync *ss, uint64_t move_clock)
 {
     // Flush each stepcompress to the specified move_clock
+    int ret = flush_stepcompress(ss, move_clock);
+    if (ret)
+        return ret;
     int i;
+
+    // Order commands by the reqclock of each pending command (a heap
+    // of the stepcompress objects keyed on their first message)
+    struct minheap *heap = &ss->msg_heap;
+    heap->count = 0;
     for (i=0; i<ss->sc_num; i++) {
-        int ret = stepcompress_flush(ss->sc_list[i], move_clock);
-        if (ret)
-            return ret;
+        struct stepcompress *sc = ss->sc_list[i];
+        if (!list_empty(&sc->msg_queue)) {
+            struct queue_message *m = list_first_entry(
+                &sc->msg_queue, struct queue_message, node);
+            minheap_push(heap, m->req_clock, i, sc);
+        }
     }
-
-    // Order commands by the reqclock of each pending command
     struct list_head msgs;
     list_init(&msgs);
     for (;;) {
         // Find message with lowest reqclock
-        uint64_t req_clock = MAX_CLOCK;
-        struct queue_message *qm = NULL;
-        for (i=0; i<ss->sc_num; i++) {
-            struct stepcompress *sc = ss->sc_list[i];
-            if (!list_empty(&sc->msg_queue)) {
-                struct queue_message *m = list_first_entry(
-                    &sc->msg_queue, struct queue_message, node);
-                if (m->req_clock < req_clock) {
-                    qm = m;
-                    req_clock = m->req_clock;
-                }
-            }
-        }
-        if (!qm || (qm->min_clock && req_clock > move_clock))
+        struct minheap_item *top = minheap_top(heap);
+        if (!top)
+            break;
+        struct stepcompress *sc = top->data;
+        struct queue_message *qm = list_first_entry(
+            &sc->msg_queue, struct queue_message, node);
+        if (qm->min_clock && qm->req_clock > move_clock)
             break;
 
         uint64_t next_avail = ss->move_clocks[0];
@@ -788,6 +1560,13 @@ steppersync_flush(struct steppersync *ss, uint64_t move_clock)
         // Batch this command
         list_del(&qm->node);
         list_add_tail(&qm->node, &msgs);
+        if (list_empty(&sc->msg_queue)) {
+            minheap_pop(heap);
+        } else {
+            struct queue_message *m = list_first_entry(
+                &sc->msg_queue, struct queue_message, node);
+            minheap_replace_top(heap, m->req_clock);
+        }
     }
 
     // Transmit commands
@@ -795,3 +1574,123 @@ steppersync_flush(struct steppersync *ss, uint64_t move_clock)
         serialqueue_send_batch(ss->sq, ss->cq, &msgs);
     return 0;
 }
+
+
+/****************************************************************
+ * Move block step generation
+ ****************************************************************/
+
+// The host can pass a series of planned moves to
+// steppersync_push_moves() to generate (and flush) the steps of all
+// the steppers of a cartesian or corexy printer in one call.  The
+// results are identical to generating the steps one move at a time.
+
+#define BLOCK_KIN_CARTESIAN 0
+#define BLOCK_KIN_COREXY 1
+
+struct block_move {
+    double start_pos[3], end_pos[2], axes_d[3], move_d;
+    double accel_r, cruise_r, decel_r, accel_t, cruise_t, decel_t;
+    double start_v, cruise_v, accel;
+    // Extruder steps (as calculated by the host extruder code)
+    double e_start_pos, e_accel_d, e_cruise_d, e_decel_d;
+    double e_accel_t, e_cruise_t, e_decel_t;
+    double e_start_v, e_cruise_v, e_decel_v, e_accel;
+    double e_retract_d, e_retract_v;
+};
+
+// Generate the steps of the extruder for a move
+static int32_t
+push_block_extrude(struct stepcompress *sc, int64_t commanded_pos
+                   , double mcu_time, struct block_move *m)
+{
+    int32_t count = stepcompress_push_trapezoid(
+        sc, commanded_pos, mcu_time, m->e_start_pos
+        , m->e_accel_d, m->e_cruise_d, m->e_decel_d, m->e_accel_t, m->e_cruise_t
+        , m->e_start_v, m->e_cruise_v, m->e_decel_v, m->e_accel);
+    if (count == ERROR_RET || !m->e_retract_d)
+        return count;
+    // Retraction steps
+    double start_pos = m->e_start_pos;
+    if (m->e_accel_d) {
+        start_pos += m->e_accel_d;
+        mcu_time += m->e_accel_t;
+    }
+    if (m->e_cruise_d) {
+        start_pos += m->e_cruise_d;
+        mcu_time += m->e_cruise_t;
+    }
+    if (m->e_decel_d) {
+        start_pos += m->e_decel_d;
+        mcu_time += m->e_decel_t;
+    }
+    int32_t retract_count = push_const_move(
+        sc, commanded_pos + count, mcu_time, start_pos, -m->e_retract_d
+        , m->e_retract_v, m->e_accel);
+    if (retract_count == ERROR_RET)
+        return retract_count;
+    return count + retract_count;
+}
+
+// Generate and flush the steps for a series of moves.  The
+// 'commanded_pos' array holds the position (in steps) of the three
+// kinematic steppers and the extruder and is updated on return.  The
+// move start time is read from and the end time stored in
+// 'print_time'.
+int
+steppersync_push_moves(struct steppersync *ss, int kin_type
+                       , struct stepcompress **kin_sc, struct stepcompress *ext_sc
+                       , int64_t *commanded_pos
+                       , struct block_move *moves, int move_count
+                       , double *print_time, double print_start_time
+                       , double move_flush_time, double mcu_freq)
+{
+    double move_time = *print_time;
+    int i, j;
+    for (i=0; i<move_count; i++) {
+        struct block_move *m = &moves[i];
+        double mcu_time = move_time + print_start_time;
+        double start_pos[3], axes_d[3];
+        memcpy(start_pos, m->start_pos, sizeof(start_pos));
+        memcpy(axes_d, m->axes_d, sizeof(axes_d));
+        if (kin_type == BLOCK_KIN_COREXY) {
+            double sxp = m->start_pos[0], syp = m->start_pos[1];
+            double exp = m->end_pos[0], eyp = m->end_pos[1];
+            start_pos[0] = sxp + syp;
+            start_pos[1] = sxp - syp;
+            axes_d[0] = (exp + eyp) - start_pos[0];
+            axes_d[1] = (exp - eyp) - start_pos[1];
+        }
+        for (j=0; j<3; j++) {
+            double axis_d = axes_d[j];
+            if (!axis_d)
+                continue;
+            double axis_r = fabs(axis_d) / m->move_d;
+            double cruise_v = m->cruise_v * axis_r;
+            int32_t count = stepcompress_push_trapezoid(
+                kin_sc[j], commanded_pos[j], mcu_time, start_pos[j]
+                , m->accel_r * axis_d, m->cruise_r * axis_d
+                , m->decel_r * axis_d, m->accel_t, m->cruise_t
+                , m->start_v * axis_r, cruise_v, cruise_v, m->accel * axis_r);
+            if (count == ERROR_RET)
+                return count;
+            commanded_pos[j] += count;
+        }
+        if (ext_sc) {
+            int32_t count = push_block_extrude(
+                ext_sc, commanded_pos[3], mcu_time, m);
+            if (count == ERROR_RET)
+                return count;
+            commanded_pos[3] += count;
+        }
+        // Flush the steps (as done after each move by the host)
+        move_time += m->accel_t + m->cruise_t + m->decel_t;
+        double flush_time = move_time - move_flush_time;
+        uint64_t clock = (flush_time + print_start_time) * mcu_freq;
+        int ret = steppersync_flush(ss, clock);
+        if (ret)
+            return ret;
+    }
+    *print_time = move_time;
+    return 0;
+}
@@ -11,15 +11,27 @@ import cartesian, corexy, delta, extruder
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
 # Class to track each move request
-class Move:
+class Move(object):
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'is_kinematic_move',
+        'axes_d', 'move_d', 'min_move_t', 'max_start_v2', 'max_cruise_v2',
+        'delta_v2', 'max_smoothed_v2', 'smooth_delta_v2', 'lookahead_state',
+        'accel_r', 'decel_r', 'cruise_r', 'start_v', 'cruise_v', 'end_v',
+        'accel_t', 'cruise_t', 'decel_t',
+        # Fields filled in by the extruder code
+        'extrude_r', 'extrude_max_corner_v')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        self.axes_d = axes_d = [end_pos[0] - start_pos[0]
+                                , end_pos[1] - start_pos[1]
+                                , end_pos[2] - start_pos[2]
+                                , end_pos[3] - start_pos[3]]
+        dx, dy, dz = axes_d[:3]
+        self.move_d = move_d = math.sqrt(dx*dx + dy*dy + dz*dz)
         if not move_d:
             # Extrude only move
             self.move_d = move_d = abs(axes_d[3])
@@ -33,6 +45,8 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+        # Results of the last lazy lookahead pass over this move
+        self.lookahead_state = None
     def limit_speed(self, speed, accel):
         speed2 = speed**2
         if speed2 < self.max_cruise_v2:
@@ -78,9 +92,10 @@ class Move:
         self.end_v = end_v = math.sqrt(end_v2)
         # Determine time spent in each portion of move (time is the
         # distance divided by average velocity)
-        self.accel_t = accel_r * self.move_d / ((start_v + cruise_v) * 0.5)
-        self.cruise_t = cruise_r * self.move_d / cruise_v
-        self.decel_t = decel_r * self.move_d / ((end_v + cruise_v) * 0.5)
+        move_d = self.move_d
+        self.accel_t = accel_r * move_d / ((start_v + cruise_v) * 0.5)
+        self.cruise_t = cruise_r * move_d / cruise_v
+        self.decel_t = decel_r * move_d / ((end_v + cruise_v) * 0.5)
     def move(self):
         # Generate step times for the move
         next_move_time = self.toolhead.get_next_move_time()
@@ -96,8 +111,9 @@ LOOKAHEAD_FLUSH_TIME = 0.250
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
 class MoveQueue:
-    def __init__(self, extruder_lookahead):
+    def __init__(self, extruder_lookahead, generate_moves):
         self.extruder_lookahead = extruder_lookahead
+        self.generate_moves = generate_moves
         self.queue = []
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
@@ -117,7 +133,11 @@ class MoveQueue:
         # after the last move.
         delayed = []
         next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
-        for i in range(flush_count-1, self.leftover-1, -1):
+        cached = []
+        flush_dist = flush_state = None
+        i = flush_count
+        while i > self.leftover:
+            i -= 1
             move = queue[i]
             reachable_start_v2 = next_end_v2 + move.delta_v2
             start_v2 = min(move.max_start_v2, reachable_start_v2)
@@ -132,6 +152,8 @@ class MoveQueue:
                     if update_flush_count and peak_cruise_v2:
                         flush_count = i
                         update_flush_count = False
+                        flush_state = (next_end_v2, next_smoothed_v2
+                                       , peak_cruise_v2, tuple(delayed))
                     peak_cruise_v2 = min(move.max_cruise_v2, (
                         smoothed_v2 + reachable_smoothed_v2) * .5)
                     if delayed:
@@ -152,13 +174,38 @@ class MoveQueue:
                 delayed.append((move, start_v2, next_end_v2))
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
+            if update_flush_count and not delayed:
+                # Until a flush point is found only the smoothed
+                # velocities (and whether a peak is known) determine
+                # the outcome of the remaining traversal.  If that
+                # state was seen on a previous lazy flush then reuse
+                # its result instead of walking the rest of the queue.
+                state = (start_v2, smoothed_v2, not not peak_cruise_v2)
+                lookahead_state = move.lookahead_state
+                if lookahead_state is None or lookahead_state[0] != state:
+                    cached.append((move, i, state))
+                    continue
+                flush_dist, flush_state = lookahead_state[1:]
+                if flush_dist is None or i - flush_dist < self.leftover:
+                    flush_dist = None
+                    break
+                # Resume the traversal at the move that will flush
+                next_end_v2, next_smoothed_v2, peak_cruise_v2, delayed = (
+                    flush_state)
+                delayed = list(delayed)
+                i -= flush_dist - 1
+        # Note the lookahead results for use by future lazy flushes
+        for move, pos, state in cached:
+            if update_flush_count:
+                move.lookahead_state = (state, None, None)
+            else:
+                move.lookahead_state = (state, pos - flush_count, flush_state)
         if update_flush_count:
             return
         # Allow extruder to do its lookahead
         move_count = self.extruder_lookahead(queue, flush_count, lazy)
         # Generate step times for all moves ready to be flushed
-        for move in queue[:move_count]:
-            move.move()
+        self.generate_moves(queue[:move_count])
         # Remove processed moves from the queue
         self.leftover = flush_count - move_count
         del queue[:move_count]
@@ -174,8 +221,237 @@ class MoveQueue:
             # least one move can be flushed.
             self.flush(lazy=True)
 
+BATCH_MOVES = 4096
+
+# Look-ahead queue for batch runs (file input to file output).  There
+# is no real-time deadline in these runs, so instead of a lazy flush
+# every LOOKAHEAD_FLUSH_TIME of queued moves the moves are planned in
+# blocks: the junctions of a block are calculated in one pass and the
+# look-ahead passes run once over the whole block.  A lazy flush only
+# flushes moves whose velocities can no longer change, so the planned
+# moves are the same as those of MoveQueue.
+class BatchMoveQueue(MoveQueue):
+    def __init__(self, toolhead, extruder_lookahead, generate_moves):
+        MoveQueue.__init__(self, extruder_lookahead, generate_moves)
+        self.toolhead = toolhead
+        # Position of the first queued move without a calculated junction
+        self.junction_pos = 0
+    def reset(self):
+        MoveQueue.reset(self)
+        self.junction_pos = 0
+    def set_flush_time(self, flush_time):
+        pass
+    def calc_junctions(self):
+        # Same calculation as Move.calc_junction() for each new move
+        queue = self.queue
+        toolhead = self.toolhead
+        extruder_junction = toolhead.extruder.calc_junction
+        junction_deviation = toolhead.junction_deviation
+        sqrt = math.sqrt
+        # The first move after a full flush has no previous move
+        for i in range(max(self.junction_pos, 1), len(queue)):
+            move = queue[i]
+            prev_move = queue[i-1]
+            axes_d = move.axes_d
+            prev_axes_d = prev_move.axes_d
+            if (axes_d[2] or prev_axes_d[2] or move.accel != prev_move.accel
+                or not move.is_kinematic_move
+                or not prev_move.is_kinematic_move):
+                continue
+            extruder_v2 = extruder_junction(prev_move, move)
+            junction_cos_theta = -((axes_d[0] * prev_axes_d[0]
+                                    + axes_d[1] * prev_axes_d[1])
+                                   / (move.move_d * prev_move.move_d))
+            if junction_cos_theta > 0.999999:
+                continue
+            junction_cos_theta = max(junction_cos_theta, -0.999999)
+            sin_theta_d2 = sqrt(0.5*(1.0-junction_cos_theta))
+            R = junction_deviation * sin_theta_d2 / (1. - sin_theta_d2)
+            move.max_start_v2 = max_start_v2 = min(
+                R * move.accel, move.max_cruise_v2, prev_move.max_cruise_v2
+                , extruder_v2, prev_move.max_start_v2 + prev_move.delta_v2)
+            move.max_smoothed_v2 = min(
+                max_start_v2
+                , prev_move.max_smoothed_v2 + prev_move.smooth_delta_v2)
+        self.junction_pos = len(queue)
+    def flush(self, lazy=False):
+        self.calc_junctions()
+        MoveQueue.flush(self, lazy)
+        self.junction_pos = len(self.queue)
+    def add_move(self, move):
+        queue = self.queue
+        queue.append(move)
+        if len(queue) - self.junction_pos >= BATCH_MOVES:
+            self.flush(lazy=True)
+
+# Class to track print times in place of generating steps
+class PrintAnalysis:
+    def __init__(self, toolhead):
+        self.move_count = 0
+        self.start_time = self.end_time = None
+        # A layer starts at the first extruding move at a new height
+        self.layer_z = None
+        self.layers = []
+        self.toolhead = toolhead
+        toolhead.move_queue.generate_moves = self.generate_moves
+    def generate_moves(self, moves):
+        # Account for a block of flushed moves at once (instead of
+        # going through Move.move() and the mcu flush of each move)
+        if not moves:
+            return
+        toolhead = self.toolhead
+        print_time = move_time = toolhead.get_next_move_time()
+        layers = self.layers
+        layer = layer_z = None
+        if layers:
+            layer = layers[-1]
+            layer_z = self.layer_z
+        for move in moves:
+            end_pos = move.end_pos
+            if layer is None:
+                self.start_time = move_time
+                layer = [end_pos[2], move_time, 0]
+                layers.append(layer)
+            elif (end_pos[2] != layer_z and move.axes_d[3] > 0.
+                  and move.is_kinematic_move):
+                self.layer_z = layer_z = end_pos[2]
+                layer = [layer_z, move_time, 0]
+                layers.append(layer)
+            layer[2] += 1
+            move_time += move.accel_t + move.cruise_t + move.decel_t
+        self.move_count += len(moves)
+        self.end_time = move_time
+        toolhead.update_move_time(move_time - print_time)
+    def log_report(self):
+        if self.start_time is None:
+            logging.info("Print analysis: no moves")
+            return
+        lines = ["Print analysis: print_time=%.3f moves=%d layers=%d" % (
+            self.end_time - self.start_time, self.move_count,
+            len(self.layers))]
+        layers = self.layers
+        for i, (z, start_time, move_count) in enumerate(layers):
+            end_time = self.end_time
+            if i + 1 < len(layers):
+                end_time = layers[i+1][1]
+            lines.append("layer=%d z=%.3f start=%.3f time=%.3f moves=%d" % (
+                i, z, start_time - self.start_time, end_time - start_time,
+                move_count))
+        logging.info("\n".join(lines))
+
 STALL_TIME = 0.100
 
+# Extruder fields of a block move that does not extrude
+NO_EXTRUDE_STEPS = (0.,) * 13
+
+# Return the fields of 'struct block_move' (see stepcompress.c) for
+# each of the given moves
+def get_move_block_data(moves, extruder):
+    data = []
+    for move in moves:
+        sp, ep, axes_d = move.start_pos, move.end_pos, move.axes_d
+        data.extend((sp[0], sp[1], sp[2], ep[0], ep[1],
+                     axes_d[0], axes_d[1], axes_d[2], move.move_d,
+                     move.accel_r, move.cruise_r, move.decel_r,
+                     move.accel_t, move.cruise_t, move.decel_t,
+                     move.start_v, move.cruise_v, move.accel))
+        if axes_d[3]:
+            data.extend(extruder.calc_move_steps(move))
+        else:
+            data.extend(NO_EXTRUDE_STEPS)
+    return data
+
+# Adaptive buffer time tuning parameters
+BUFFER_CHECK_TIME = 0.100
+BUFFER_ADJUST_TIME = 1.000
+BUFFER_SAFETY_FACTOR = 2.
+BUFFER_PEAK_DECAY = 0.9
+BUFFER_RELAX_RATE = 0.98
+BUFFER_STALL_BACKOFF = 1.5
+
+# Class to tune buffer_time_low/high from the measured host latencies
+class BufferTimeController:
+    def __init__(self, toolhead, config):
+        self.toolhead = toolhead
+        self.reactor = toolhead.reactor
+        self.serial = toolhead.printer.mcu.serial
+        # The configured buffer times are the upper bounds
+        self.max_low = toolhead.buffer_time_low
+        self.high_gap = toolhead.buffer_time_high - self.max_low
+        self.min_low = config.getfloat(
+            'buffer_time_low_min', 0.250, above=0., maxval=self.max_low)
+        # Peak measurements (decayed on each adjustment)
+        self.lateness = self.flush_time = self.serial_time = 0.
+        self.last_print_stall = 0
+        self.adjust_count = 0
+        self.reason = "none"
+        self.check_count = 0
+        self.next_check_time = 0.
+        # The checks only run while the toolhead is active
+        self.check_timer = self.reactor.register_timer(self._check_handler)
+        # Time every look-ahead flush (including the lazy flushes of
+        # MoveQueue.add_move)
+        move_queue = toolhead.move_queue
+        self.queue_flush = move_queue.flush
+        move_queue.flush = self._timed_flush
+    def _timed_flush(self, lazy=False):
+        flush_start = self.reactor.monotonic()
+        self.queue_flush(lazy)
+        self.flush_time = max(self.flush_time,
+                              self.reactor.monotonic() - flush_start)
+    def start(self):
+        self.next_check_time = self.reactor.monotonic() + BUFFER_CHECK_TIME
+        self.reactor.update_timer(self.check_timer, self.next_check_time)
+    def stop(self):
+        self.reactor.update_timer(self.check_timer, self.reactor.NEVER)
+    def _check_handler(self, eventtime):
+        # Measure how late the reactor ran this timer
+        curtime = self.reactor.monotonic()
+        self.lateness = max(self.lateness, curtime - self.next_check_time)
+        self.serial_time = max(self.serial_time, self.serial.get_ready_time())
+        self.check_count += 1
+        if self.check_count * BUFFER_CHECK_TIME >= BUFFER_ADJUST_TIME:
+            self.check_count = 0
+            self._adjust()
+        self.next_check_time = curtime + BUFFER_CHECK_TIME
+        return self.next_check_time
+    def _adjust(self):
+        toolhead = self.toolhead
+        low = toolhead.buffer_time_low
+        causes = [(self.lateness, "lateness"), (self.flush_time, "flush"),
+                  (self.serial_time, "serial")]
+        need_time = sum([t for t, c in causes])
+        target = self.min_low + BUFFER_SAFETY_FACTOR * need_time
+        reason = max(causes)[1]
+        if toolhead.print_stall != self.last_print_stall:
+            # Buffer under ran - back off regardless of the measurements
+            self.last_print_stall = toolhead.print_stall
+            target = max(target, low * BUFFER_STALL_BACKOFF)
+            reason = "stall"
+        if target < low:
+            target = max(target, low * BUFFER_RELAX_RATE)
+            reason = "relax"
+        target = min(max(target, self.min_low), self.max_low)
+        if target != low:
+            toolhead.buffer_time_low = target
+            toolhead.buffer_time_high = target + self.high_gap
+            self.adjust_count += 1
+            self.reason = reason
+            if reason != "relax":
+                logging.info("Buffer time adjusted to low=%.3f high=%.3f (%s)"
+                             % (target, target + self.high_gap, reason))
+        self.lateness *= BUFFER_PEAK_DECAY
+        self.flush_time *= BUFFER_PEAK_DECAY
+        self.serial_time *= BUFFER_PEAK_DECAY
+    def stats(self, eventtime):
+        return (" buffer_time_low=%.3f buffer_time_high=%.3f"
+                " buffer_adjust=%d buffer_reason=%s"
+                " host_lateness=%.3f flush_time=%.3f serial_time=%.3f" % (
+                    self.toolhead.buffer_time_low,
+                    self.toolhead.buffer_time_high, self.adjust_count,
+                    self.reason, self.lateness, self.flush_time,
+                    self.serial_time))
+
 # Main code to track events (and their timing) on the printer toolhead
 class ToolHead:
     def __init__(self, printer, config):
@@ -195,8 +471,31 @@ class ToolHead:
             , above=0., maxval=self.max_accel)
         self.junction_deviation = config.getfloat(
             'junction_deviation', 0.02, above=0.)
-        self.move_queue = MoveQueue(self.extruder.lookahead)
+        if (printer.gcode.is_fileinput and printer.mcu.is_fileoutput()
+            and config.getboolean('batch_planning', True)):
+            self.move_queue = BatchMoveQueue(self, self.extruder.lookahead,
+                                             self._generate_moves)
+        else:
+            self.move_queue = MoveQueue(self.extruder.lookahead,
+                                        self._generate_moves)
         self.commanded_pos = [0., 0., 0., 0.]
+        # Generation of the steps of flushed moves in a single C call
+        self.move_block = None
+        if (config.getboolean('block_step_generation', True)
+            and hasattr(self.kin, 'get_move_block')):
+            kin_type, kin_steppers = self.kin.get_move_block()
+            ext_stepper = None
+            if isinstance(self.extruder, extruder.PrinterExtruder):
+                ext_stepper = self.extruder.stepper.mcu_stepper
+            self.move_block = printer.mcu.create_move_block(
+                kin_type, kin_steppers, ext_stepper)
+        # Merging of nearly collinear moves
+        self.fuse_deviation = config.getfloat(
+            'fuse_deviation', 0., minval=0.)
+        self.fused_move = None
+        self.fused_speed = 0.
+        self.fused_points = []
+        self.fused_count = 0
         # Print time tracking
         self.buffer_time_low = config.getfloat(
             'buffer_time_low', 1.000, above=0.)
@@ -214,6 +513,9 @@ class ToolHead:
         self.forced_synch = False
         self.flush_timer = self.reactor.register_timer(self._flush_handler)
         self.move_queue.set_flush_time(self.buffer_time_high)
+        self.buffer_control = None
+        if config.getboolean('buffer_time_adaptive', False):
+            self.buffer_control = BufferTimeController(self, config)
         # Motor off tracking
         self.motor_off_time = config.getfloat(
             'motor_off_time', 600.000, minval=0.)
@@ -243,11 +545,40 @@ class ToolHead:
                 self.printer.mcu.set_print_start_time(curtime)
                 self.print_time = self.buffer_time_start
                 self._reset_motor_off()
+                if self.buffer_control is not None:
+                    self.buffer_control.start()
             self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
             self.synch_print_time = False
         return self.print_time
+    def _generate_moves(self, moves):
+        if self.move_block is None:
+            for move in moves:
+                move.move()
+            return
+        kin, extruder = self.kin, self.extruder
+        block = []
+        for move in moves:
+            if (kin.is_motor_enable_move(move)
+                or (move.axes_d[3] and extruder.need_motor_enable)):
+                # Let the kinematic code enable the motors
+                self._generate_move_block(block)
+                block = []
+                move.move()
+            else:
+                block.append(move)
+        self._generate_move_block(block)
+    def _generate_move_block(self, moves):
+        if not moves:
+            return
+        print_time = self.get_next_move_time()
+        data = get_move_block_data(moves, self.extruder)
+        self.print_time = self.move_block.generate(
+            data, len(moves), print_time, self.move_flush_time)
+        # The steps of each move were flushed as update_move_time() does
+        self.printer.mcu.flush_moves(self.print_time - self.move_flush_time)
     def _flush_lookahead(self, must_synch=False):
         synch_print_time = self.synch_print_time
+        self._flush_fused_move()
         self.move_queue.flush()
         if synch_print_time or must_synch:
             self.synch_print_time = True
@@ -263,6 +594,8 @@ class ToolHead:
         self.need_check_stall = -1.
         self.forced_synch = False
         self._reset_motor_off()
+        if self.buffer_control is not None:
+            self.buffer_control.stop()
     def _check_stall(self):
         eventtime = self.reactor.monotonic()
         if not self.print_time:
@@ -329,20 +662,88 @@ class ToolHead:
         self._flush_lookahead()
         self.commanded_pos[:] = newpos
         self.kin.set_position(newpos)
+    def _check_move(self, move):
+        if move.is_kinematic_move:
+            self.kin.check_move(move)
+        if move.axes_d[3]:
+            self.extruder.check_move(move)
+    def _can_fuse(self, newpos, speed):
+        # Check if the pending move can be extended to newpos
+        fused_move = self.fused_move
+        if speed != self.fused_speed:
+            return False
+        start_pos = fused_move.start_pos
+        end_pos = fused_move.end_pos
+        axes_d = [newpos[i] - end_pos[i] for i in (0, 1, 2, 3)]
+        move_d = math.sqrt(axes_d[0]**2 + axes_d[1]**2 + axes_d[2]**2)
+        if not move_d:
+            return False
+        # Extrude ratio must match (using the same tolerance as the
+        # extruder lookahead)
+        fused_r = fused_move.axes_d[3] / fused_move.move_d
+        extrude_r = axes_d[3] / move_d
+        if cmp(fused_r, 0.) != cmp(extrude_r, 0.):
+            return False
+        if ((abs(extrude_r) > abs(fused_r) * extruder.EXTRUDE_DIFF_IGNORE
+             or abs(fused_r) > abs(extrude_r) * extruder.EXTRUDE_DIFF_IGNORE)
+            and abs(move_d * fused_r - axes_d[3]) >= .001):
+            return False
+        # All intermediate points must be within fuse_deviation of the
+        # new line and must progress along it
+        line_d = [newpos[i] - start_pos[i] for i in (0, 1, 2)]
+        line_len2 = line_d[0]**2 + line_d[1]**2 + line_d[2]**2
+        if (axes_d[0] * line_d[0] + axes_d[1] * line_d[1]
+            + axes_d[2] * line_d[2]) <= 0.:
+            return False
+        max_dev2 = self.fuse_deviation**2
+        last_t = 0.
+        for pos in self.fused_points + [end_pos]:
+            pos_d = [pos[i] - start_pos[i] for i in (0, 1, 2)]
+            t = (pos_d[0] * line_d[0] + pos_d[1] * line_d[1]
+                 + pos_d[2] * line_d[2]) / line_len2
+            if t <= last_t or t >= 1.:
+                return False
+            last_t = t
+            dev2 = ((pos_d[0] - t * line_d[0])**2
+                    + (pos_d[1] - t * line_d[1])**2
+                    + (pos_d[2] - t * line_d[2])**2)
+            if dev2 > max_dev2:
+                return False
+        return True
+    def _flush_fused_move(self):
+        move = self.fused_move
+        if move is None:
+            return
+        self.fused_move = None
+        self.move_queue.add_move(move)
     def move(self, newpos, speed):
         speed = min(speed, self.max_speed)
+        if self.fused_move is not None:
+            if self._can_fuse(newpos, speed):
+                move = Move(self, self.fused_move.start_pos, newpos, speed)
+                self._check_move(move)
+                self.fused_points.append(self.fused_move.end_pos)
+                self.fused_move = move
+                self.fused_count += 1
+                self.commanded_pos[:] = newpos
+                return
+            self._flush_fused_move()
         move = Move(self, self.commanded_pos, newpos, speed)
         if not move.move_d:
             return
-        if move.is_kinematic_move:
-            self.kin.check_move(move)
-        if move.axes_d[3]:
-            self.extruder.check_move(move)
+        self._check_move(move)
         self.commanded_pos[:] = newpos
-        self.move_queue.add_move(move)
+        if self.fuse_deviation and move.is_kinematic_move:
+            # Hold the move to see if following moves can be merged
+            self.fused_move = move
+            self.fused_speed = speed
+            self.fused_points = []
+        else:
+            self.move_queue.add_move(move)
         if self.print_time > self.need_check_stall:
             self._check_stall()
     def home(self, homing_state):
+        self._flush_fused_move()
         self.kin.home(homing_state)
     def dwell(self, delay):
         self.get_last_move_time()
@@ -373,11 +774,16 @@ class ToolHead:
                 eventtime, print_time))
         else:
             is_active = eventtime < self.last_print_end_time + 60.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
-            print_time, buffer_time, self.print_stall)
+        out = ("print_time=%.3f buffer_time=%.3f print_stall=%d"
+               " fused_moves=%d" % (
+                   print_time, buffer_time, self.print_stall, self.fused_count))
+        if self.buffer_control is not None:
+            out += self.buffer_control.stats(eventtime)
+        return is_active, out
     def force_shutdown(self):
         try:
             self.printer.mcu.force_shutdown()
+            self.fused_move = None
             self.move_queue.reset()
             self.reset_print_time()
         except:
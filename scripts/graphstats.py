@@ -96,9 +96,41 @@ def plot_mcu(data, maxbw, outname):
     ax1.grid(True)
     plt.savefig(outname)
 
+def plot_steppers(data, outname):
+    # Generate the queue_step command rate of each stepper
+    suffix = '_queue_step'
+    names = sorted([k[:-len(suffix)] for k in data[0] if k.endswith(suffix)])
+    times = []
+    rates = dict([(name, []) for name in names])
+    lastd = data[0]
+    for d in data[1:]:
+        timedelta = d['#sampletime'] - lastd['#sampletime']
+        if timedelta <= 0.:
+            continue
+        times.append(datetime.datetime.utcfromtimestamp(d['#sampletime']))
+        for name in names:
+            key = name + suffix
+            delta = float(d.get(key, 0)) - float(lastd.get(key, 0))
+            rates[name].append(max(delta, 0.) / timedelta)
+        lastd = d
+
+    # Build plot
+    fig, ax1 = plt.subplots()
+    ax1.set_title("Stepper queue_step command rate")
+    ax1.set_xlabel('Time')
+    ax1.set_ylabel('Commands per second')
+    for name in names:
+        ax1.plot_date(times, rates[name], '-', label=name)
+    ax1.legend(loc='best')
+    ax1.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    ax1.grid(True)
+    plt.savefig(outname)
+
 def main():
     usage = "%prog [options] <logfile> <outname>"
     opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--steppers", action="store_true", dest="steppers",
+                    help="graph the command rate of each stepper")
     options, args = opts.parse_args()
     if len(args) != 2:
         opts.error("Incorrect number of arguments")
@@ -106,7 +138,10 @@ def main():
     data = parse_log(logname)
     if not data:
         return
-    plot_mcu(data, MAXBANDWIDTH, outname)
+    if options.steppers:
+        plot_steppers(data, outname)
+    else:
+        plot_mcu(data, MAXBANDWIDTH, outname)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Script to load and summarize a binary step trace recorded by the host
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, struct, mmap
+import numpy
+
+# Format of the trace file (see steptrace_header and steptrace_block in
+# klippy/stepcompress.c)
+MAGIC = "KLSTEPTR"
+HEADER_FORMAT = "=8sIIQd"
+BLOCK_FORMAT = "=IIII"
+
+class error(Exception):
+    pass
+
+# Find the (data offset, count, oid, dir) of each block of the trace
+def parse_blocks(data, header_size, data_size):
+    block_size = struct.calcsize(BLOCK_FORMAT)
+    blocks = []
+    pos = header_size
+    end = header_size + data_size
+    while pos + block_size <= end:
+        oid, sdir, count, pad = struct.unpack_from(BLOCK_FORMAT, data, pos)
+        pos += block_size
+        if pos + count * 8 > end:
+            # Partially written block - only keep the recorded steps
+            count = (end - pos) // 8
+        blocks.append((pos, count, oid, sdir))
+        pos += count * 8
+    return blocks
+
+# Load a step trace into NumPy arrays.  Returns a dictionary with the
+# mcu frequency and 'oid', 'clock', and 'dir' arrays (with one entry
+# per step, in the order the steps were scheduled by the host).
+def load_trace(filename):
+    f = open(filename, 'rb')
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    header_len = struct.calcsize(HEADER_FORMAT)
+    if len(data) < header_len:
+        raise error("File too small to be a step trace")
+    magic, version, header_size, data_size, mcu_freq = struct.unpack_from(
+        HEADER_FORMAT, data, 0)
+    if magic != MAGIC or version != 1:
+        raise error("Not a step trace file (or unsupported version)")
+    data_size = min(data_size, len(data) - header_size)
+    blocks = parse_blocks(data, header_size, data_size)
+    # Build the step arrays directly from the mapped file (all fields
+    # in the file are 64bit aligned)
+    words = numpy.frombuffer(data, dtype=numpy.uint64, count=len(data) // 8)
+    offsets = numpy.array([b[0] // 8 for b in blocks], dtype=numpy.int64)
+    counts = numpy.array([b[1] for b in blocks], dtype=numpy.int64)
+    oids = numpy.array([b[2] for b in blocks], dtype=numpy.uint32)
+    dirs = numpy.array([b[3] for b in blocks], dtype=numpy.uint8)
+    starts = numpy.cumsum(counts) - counts
+    index = (numpy.repeat(offsets - starts, counts)
+             + numpy.arange(int(counts.sum()), dtype=numpy.int64))
+    clock = words[index]
+    return {'mcu_freq': mcu_freq,
+            'oid': numpy.repeat(oids, counts),
+            'clock': clock,
+            'dir': numpy.repeat(dirs, counts)}
+
+# Return the trace arrays of a single stepper (in step order)
+def get_stepper(trace, oid):
+    mask = trace['oid'] == oid
+    return trace['clock'][mask], trace['dir'][mask]
+
+def main():
+    usage = "%prog [options] <trace file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-o", "--oid", type="int", dest="oid",
+                    help="only report the stepper with the given oid")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    trace = load_trace(args[0])
+    freq = trace['mcu_freq']
+    oids = numpy.unique(trace['oid'])
+    if options.oid is not None:
+        oids = [options.oid]
+    print "steps:%d mcu_freq:%.0f" % (len(trace['clock']), freq)
+    for oid in oids:
+        clock, sdir = get_stepper(trace, oid)
+        if not len(clock):
+            continue
+        pos = numpy.where(sdir, 1, -1).sum()
+        dir_changes = numpy.count_nonzero(numpy.diff(sdir.astype(numpy.int8)))
+        min_interval = 0.
+        if len(clock) > 1:
+            intervals = numpy.diff(clock.astype(numpy.int64))
+            min_interval = intervals.min() / freq
+        print ("oid:%3d steps:%8d position:%8d dir_changes:%6d"
+               " first:%.6f last:%.6f min_interval:%.9f" % (
+                   oid, len(clock), pos, dir_changes,
+                   clock[0] / freq, clock[-1] / freq, min_interval))
+
+if __name__ == '__main__':
+    main()
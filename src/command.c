@@ -6,6 +6,7 @@
 
 #include <stdarg.h> // va_start
 #include <string.h> // memcpy
+#include "autoconf.h" // CONFIG_SERIAL_REORDER_SIZE
 #include "board/io.h" // readb
 #include "board/misc.h" // crc16_ccitt
 #include "board/pgm.h" // READP
@@ -24,8 +25,15 @@
 #define MESSAGE_SEQ_MASK 0x0f
 #define MESSAGE_DEST 0x10
 #define MESSAGE_SYNC 0x7E
+#define MESSAGE_EXT_SEQ 0x80
+#define MESSAGE_EXT_SEQ_MASK 0x7f
+#define MESSAGE_EXT_WINDOW 32
 
-static uint8_t next_sequence = MESSAGE_DEST;
+static uint8_t next_sequence, seq_is_ext;
+
+#if CONFIG_SERIAL_REORDER_SIZE
+DECL_CONSTANT(SERIAL_EXT_WINDOW, MESSAGE_EXT_WINDOW);
+#endif
 
 
 /****************************************************************
@@ -184,7 +192,10 @@ _sendf(uint8_t parserid, ...)
     // Send message to serial port
     uint8_t msglen = p+MESSAGE_TRAILER_SIZE - buf;
     buf[MESSAGE_POS_LEN] = msglen;
-    buf[MESSAGE_POS_SEQ] = next_sequence;
+    if (CONFIG_SERIAL_REORDER_SIZE && seq_is_ext)
+        buf[MESSAGE_POS_SEQ] = MESSAGE_EXT_SEQ | next_sequence;
+    else
+        buf[MESSAGE_POS_SEQ] = MESSAGE_DEST | (next_sequence & MESSAGE_SEQ_MASK);
     uint16_t crc = crc16_ccitt(buf, p-buf);
     *p++ = crc>>8;
     *p++ = crc;
@@ -205,6 +216,107 @@ sendf_shutdown(void)
 DECL_SHUTDOWN(sendf_shutdown);
 
 
+/****************************************************************
+ * Message block sequencing
+ ****************************************************************/
+
+// In the "extended sequence" mode the host uses 7bit sequence numbers
+// (with the MESSAGE_EXT_SEQ bit set) and may send up to
+// MESSAGE_EXT_WINDOW blocks without an ack.  Blocks that arrive after
+// a lost block are held in the reorder buffer so that the host only
+// needs to retransmit the lost block.
+
+static char reorder_buf[CONFIG_SERIAL_REORDER_SIZE];
+static uint16_t reorder_len;
+static uint8_t reorder_last_seq, reorder_need_nak;
+
+// Remove the first block from the reorder buffer
+static void
+reorder_pop(uint8_t len)
+{
+    reorder_len -= len;
+    memmove(reorder_buf, &reorder_buf[len], reorder_len);
+}
+
+// Store a block that arrived ahead of the next expected block
+static void
+reorder_add(char *buf, uint8_t msglen, uint8_t delta)
+{
+    uint8_t last_delta = ((reorder_last_seq - next_sequence)
+                          & MESSAGE_EXT_SEQ_MASK);
+    if (reorder_len && delta <= last_delta)
+        // Blocks are stored in sequence order (duplicates are dropped)
+        return;
+    if (reorder_len + msglen > sizeof(reorder_buf))
+        return;
+    memcpy(&reorder_buf[reorder_len], buf, msglen);
+    reorder_len += msglen;
+    reorder_last_seq = buf[MESSAGE_POS_SEQ] & MESSAGE_EXT_SEQ_MASK;
+}
+
+// Return the first block of the reorder buffer if it is the next
+// expected block
+static char *
+reorder_get(void)
+{
+    while (reorder_len) {
+        uint8_t msgseq = reorder_buf[MESSAGE_POS_SEQ] & MESSAGE_EXT_SEQ_MASK;
+        uint8_t delta = (msgseq - next_sequence) & MESSAGE_EXT_SEQ_MASK;
+        if (!delta)
+            return reorder_buf;
+        if (delta <= MESSAGE_EXT_WINDOW) {
+            // Still waiting for an earlier block - request it
+            if (reorder_need_nak) {
+                reorder_need_nak = 0;
+                sendf("");
+            }
+            return NULL;
+        }
+        // Block was already received again - discard it
+        reorder_pop(reorder_buf[MESSAGE_POS_LEN]);
+    }
+    return NULL;
+}
+
+// Check the sequence number of a received block.  Returns non-zero if
+// it is the next expected block.
+static int
+command_check_sequence(char *buf, uint8_t msglen)
+{
+    uint8_t msgseq = buf[MESSAGE_POS_SEQ];
+    if (!CONFIG_SERIAL_REORDER_SIZE || !(msgseq & MESSAGE_EXT_SEQ)) {
+        // Host is using the 4bit sequence numbers
+        seq_is_ext = 0;
+        reorder_len = 0;
+        return !((msgseq ^ next_sequence) & MESSAGE_SEQ_MASK);
+    }
+    msgseq &= MESSAGE_EXT_SEQ_MASK;
+    if (!seq_is_ext) {
+        // Host is switching to extended sequence numbers
+        if ((msgseq ^ next_sequence) & MESSAGE_SEQ_MASK)
+            return 0;
+        seq_is_ext = 1;
+        next_sequence = msgseq;
+        return 1;
+    }
+    uint8_t delta = (msgseq - next_sequence) & MESSAGE_EXT_SEQ_MASK;
+    if (!delta)
+        return 1;
+    if (delta <= MESSAGE_EXT_WINDOW)
+        reorder_add(buf, msglen, delta);
+    return 0;
+}
+
+// Note the next expected block as received (and ack it)
+static void
+command_ack_sequence(void)
+{
+    next_sequence = (next_sequence + 1) & MESSAGE_EXT_SEQ_MASK;
+    reorder_need_nak = 1;
+    sendf(""); // An empty message with a new sequence number is an ack
+}
+
+
 /****************************************************************
  * Command routing
  ****************************************************************/
@@ -230,6 +342,13 @@ static char *
 command_get_message(void)
 {
     static uint8_t sync_state;
+    if (CONFIG_SERIAL_REORDER_SIZE && seq_is_ext) {
+        char *buf = reorder_get();
+        if (buf) {
+            command_ack_sequence();
+            return buf;
+        }
+    }
     uint8_t buf_len;
     char *buf = console_get_input(&buf_len);
     if (buf_len && sync_state & CF_NEED_SYNC)
@@ -241,7 +360,8 @@ command_get_message(void)
     if (msglen < MESSAGE_MIN || msglen > MESSAGE_MAX)
         goto error;
     uint8_t msgseq = buf[MESSAGE_POS_SEQ];
-    if ((msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST)
+    if ((msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST
+        && !(CONFIG_SERIAL_REORDER_SIZE && msgseq & MESSAGE_EXT_SEQ))
         goto error;
     if (buf_len < msglen)
         // Need more data
@@ -255,13 +375,12 @@ command_get_message(void)
         goto error;
     sync_state &= ~CF_NEED_VALID;
     // Check sequence number
-    if (msgseq != next_sequence) {
+    if (!command_check_sequence(buf, msglen)) {
         // Lost message - discard messages until it is retransmitted
         console_pop_input(msglen);
         goto nak;
     }
-    next_sequence = ((msgseq + 1) & MESSAGE_SEQ_MASK) | MESSAGE_DEST;
-    sendf(""); // An empty message with a new sequence number is an ack
+    command_ack_sequence();
     return buf;
 
 error:
@@ -309,6 +428,9 @@ command_task(void)
         void (*func)(uint32_t*) = READP(cp->func);
         func(args);
     }
-    console_pop_input(msglen);
+    if (CONFIG_SERIAL_REORDER_SIZE && buf == reorder_buf)
+        reorder_pop(msglen);
+    else
+        console_pop_input(msglen);
 }
 DECL_TASK(command_task);
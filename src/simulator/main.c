@@ -6,9 +6,12 @@
 
 #include <fcntl.h>
 #include <stdio.h>
+#include <string.h> // memmove
+#include <time.h> // clock_gettime
 #include <unistd.h>
 #include "board/misc.h" // timer_from_us
 #include "board/irq.h" // irq_disable
+#include "command.h" // DECL_CONSTANT
 #include "sched.h" // sched_main
 
 
@@ -52,10 +55,13 @@ irq_restore(irqstatus_t flag)
  * Timers
  ****************************************************************/
 
+// The simulator clock runs at 1Mhz (from the host's monotonic clock)
+DECL_CONSTANT(CLOCK_FREQ, 1000000);
+
 uint32_t
 timer_from_us(uint32_t us)
 {
-    return 0; // XXX
+    return us;
 }
 
 uint8_t
@@ -72,7 +78,9 @@ timer_periodic(void)
 uint32_t
 timer_read_time(void)
 {
-    return 0; // XXX
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000000 + ts.tv_nsec / 1000;
 }
 
 
@@ -80,30 +88,45 @@ timer_read_time(void)
  * Turn stdin/stdout into serial console
  ****************************************************************/
 
-// XXX
+static char receive_buf[4096];
+static int receive_pos;
+static char transmit_buf[96];
+
+// Return a buffer (and length) containing any incoming messages
 char *
 console_get_input(uint8_t *plen)
 {
-    *plen = 0;
-    return NULL;
+    int ret = read(STDIN_FILENO, &receive_buf[receive_pos]
+                   , sizeof(receive_buf) - receive_pos);
+    if (ret > 0)
+        receive_pos += ret;
+    *plen = receive_pos > 255 ? 255 : receive_pos;
+    return receive_buf;
 }
 
+// Remove from the receive buffer the given number of bytes
 void
 console_pop_input(uint8_t len)
 {
+    receive_pos -= len;
+    memmove(receive_buf, &receive_buf[len], receive_pos);
 }
 
 // Return an output buffer that the caller may fill with transmit messages
 char *
 console_get_output(uint8_t len)
 {
-    return NULL;
+    if (len > sizeof(transmit_buf))
+        return NULL;
+    return transmit_buf;
 }
 
 // Accept the given number of bytes added to the transmit buffer
 void
 console_push_output(uint8_t len)
 {
+    int ret = write(STDOUT_FILENO, transmit_buf, len);
+    (void)ret; // XXX - write errors are ignored
 }
 
 
@@ -21,6 +21,9 @@
 struct stepper_move {
     uint32_t interval;
     int16_t add;
+#if CONFIG_STEPPER_CUBIC
+    int16_t add2;
+#endif
     uint16_t count;
     struct stepper_move *next;
     uint8_t flags;
@@ -32,6 +35,9 @@ struct stepper {
     struct timer time;
     uint32_t interval;
     int16_t add;
+#if CONFIG_STEPPER_CUBIC
+    int16_t add2;
+#endif
 #if CONFIG_NO_UNSTEP_DELAY
     uint16_t count;
 #define next_step_time time.waketime
@@ -51,7 +57,7 @@ struct stepper {
 enum { POSITION_BIAS=0x40000000 };
 
 enum { SF_LAST_DIR=1<<0, SF_NEXT_DIR=1<<1, SF_INVERT_STEP=1<<2, SF_HAVE_ADD=1<<3,
-       SF_LAST_RESET=1<<4, SF_NO_NEXT_CHECK=1<<5 };
+       SF_LAST_RESET=1<<4, SF_NO_NEXT_CHECK=1<<5, SF_HAVE_ADD2=1<<6 };
 
 // Setup a stepper for the next move in its queue
 static uint_fast8_t
@@ -68,11 +74,25 @@ stepper_load_next(struct stepper *s)
 
     s->next_step_time += m->interval;
     s->time.waketime = s->next_step_time;
+#if CONFIG_STEPPER_CUBIC
+    s->add = m->add + m->add2;
+    s->add2 = m->add2;
+#else
     s->add = m->add;
+#endif
     s->interval = m->interval + m->add;
     if (CONFIG_NO_UNSTEP_DELAY) {
         // On slow mcus see if the add can be optimized away
+#if CONFIG_STEPPER_CUBIC
+        uint8_t flags = s->flags & ~(SF_HAVE_ADD | SF_HAVE_ADD2);
+        if (m->add2)
+            flags |= SF_HAVE_ADD | SF_HAVE_ADD2;
+        else if (m->add)
+            flags |= SF_HAVE_ADD;
+        s->flags = flags;
+#else
         s->flags = m->add ? s->flags | SF_HAVE_ADD : s->flags & ~SF_HAVE_ADD;
+#endif
         s->count = m->count;
     } else {
         // On faster mcus, it is necessary to schedule unstep events
@@ -110,8 +130,13 @@ stepper_event(struct timer *t)
             s->count = count;
             s->time.waketime += s->interval;
             gpio_out_toggle(s->step_pin);
-            if (s->flags & SF_HAVE_ADD)
+            if (s->flags & SF_HAVE_ADD) {
                 s->interval += s->add;
+#if CONFIG_STEPPER_CUBIC
+                if (s->flags & SF_HAVE_ADD2)
+                    s->add += s->add2;
+#endif
+            }
             return SF_RESCHEDULE;
         }
         uint_fast8_t ret = stepper_load_next(s);
@@ -133,6 +158,9 @@ stepper_event(struct timer *t)
     if (likely(s->count)) {
         s->next_step_time += s->interval;
         s->interval += s->add;
+#if CONFIG_STEPPER_CUBIC
+        s->add += s->add2;
+#endif
         s->time.waketime = s->next_step_time;
         return SF_RESCHEDULE;
     }
@@ -167,17 +195,12 @@ stepper_oid_lookup(uint8_t oid)
     return oid_lookup(oid, command_config_stepper);
 }
 
-// Schedule a set of steps with a given timing
-void
-command_queue_step(uint32_t *args)
+// Add a move to the stepper's queue of moves
+static void
+queue_step(struct stepper *s, struct stepper_move *m)
 {
-    struct stepper *s = stepper_oid_lookup(args[0]);
-    struct stepper_move *m = move_alloc();
-    m->interval = args[1];
-    m->count = args[2];
     if (!m->count)
         shutdown("Invalid count parameter");
-    m->add = args[3];
     m->next = NULL;
     m->flags = 0;
 
@@ -207,9 +230,41 @@ command_queue_step(uint32_t *args)
     }
     irq_enable();
 }
+
+// Schedule a set of steps with a given timing
+void
+command_queue_step(uint32_t *args)
+{
+    struct stepper *s = stepper_oid_lookup(args[0]);
+    struct stepper_move *m = move_alloc();
+    m->interval = args[1];
+    m->count = args[2];
+    m->add = args[3];
+#if CONFIG_STEPPER_CUBIC
+    m->add2 = 0;
+#endif
+    queue_step(s, m);
+}
 DECL_COMMAND(command_queue_step,
              "queue_step oid=%c interval=%u count=%hu add=%hi");
 
+#if CONFIG_STEPPER_CUBIC
+// Schedule a set of steps whose 'add' changes by 'add2' on each step
+void
+command_queue_step_cubic(uint32_t *args)
+{
+    struct stepper *s = stepper_oid_lookup(args[0]);
+    struct stepper_move *m = move_alloc();
+    m->interval = args[1];
+    m->count = args[2];
+    m->add = args[3];
+    m->add2 = args[4];
+    queue_step(s, m);
+}
+DECL_COMMAND(command_queue_step_cubic,
+             "queue_step_cubic oid=%c interval=%u count=%hu add=%hi add2=%hi");
+#endif
+
 // Set the direction of the next queued step
 void
 command_set_next_step_dir(uint32_t *args)